@@ -6,28 +6,45 @@ Obsługuje:
 - Uwierzytelnianie certyfikatem X.509 (XAdES-BES)
 - Wyszukiwanie faktur (query metadata)
 - Pobieranie XML faktur
+- Klient asynchroniczny (AsyncKSeFClient, asyncio + httpx)
 
 Autor: IT TASK FORCE Piotr Mierzenski - https://ittf.pl
 """
 
+import asyncio
 import base64
+import bisect
+import contextlib
 import datetime
+import email.utils
 import hashlib
+import io
 import json
 import logging
 import os
+import queue
+import random
 import re
+import shutil
+import socket
+import sqlite3
 import sys
+import threading
 import time
 import uuid
 import warnings
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import Optional
 
 import requests
+import urllib3
 from cryptography.utils import CryptographyDeprecationWarning
 warnings.filterwarnings("ignore", category=CryptographyDeprecationWarning)
 from cryptography import x509
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec, padding
@@ -38,6 +55,11 @@ try:
 except ImportError:
     etree = None  # Opcjonalne — wymagane tylko dla auth certyfikatem
 
+try:
+    import httpx
+except ImportError:
+    httpx = None  # Opcjonalne — wymagane tylko dla AsyncKSeFClient
+
 # ---------------------------------------------------------------------------
 # Stałe
 # ---------------------------------------------------------------------------
@@ -46,15 +68,76 @@ KSEF_URLS = {
     "test": "https://api-test.ksef.mf.gov.pl/v2",
     "demo": "https://api-demo.ksef.mf.gov.pl/v2",
     "prod": "https://api.ksef.mf.gov.pl/v2",
+    # Lokalny serwer testowy (ksef_mock.py) — testy obciążeniowe bez produkcji
+    "local": os.environ.get("KSEF_LOCAL_URL") or "http://127.0.0.1:8089/v2",
 }
 
 AUTH_TOKEN_NS = "http://ksef.mf.gov.pl/auth/token/2.0"
 XMLDSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
 XADES_NS = "http://uri.etsi.org/01903/v1.3.2#"
 
+# Odpytywanie statusu uwierzytelnienia: krótki pierwszy odstęp, wzrost
+# geometryczny do AUTH_POLL_MAX_INTERVAL_S, łącznie najwyżej AUTH_POLL_TIMEOUT_S
 MAX_AUTH_POLL_ATTEMPTS = 30
-AUTH_POLL_INTERVAL_S = 1.0
+AUTH_POLL_INTERVAL_S = 0.25
+AUTH_POLL_BACKOFF = 1.6
+AUTH_POLL_MAX_INTERVAL_S = 4.0
+AUTH_POLL_TIMEOUT_S = 30.0
 REQUEST_TIMEOUT_S = 30
+DEFAULT_POOL_SIZE = 10
+
+# Budżety żądań po stronie klienta: klasa endpointu -> (żądań/s, pojemność kubełka)
+DEFAULT_RATE_LIMITS = {
+    "query": (2.0, 4),
+    "download": (8.0, 16),
+    "auth": (2.0, 4),
+}
+MAX_THROTTLE_RETRIES = 10
+DEFAULT_RETRY_AFTER_S = 5.0
+
+# Ponawianie błędów przejściowych (połączenie, timeout, 502/503/504)
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BASE_S = 0.5
+DEFAULT_RETRY_MAX_S = 30.0
+DEFAULT_RETRY_BUDGET = 100
+
+# Lokalny indeks pobranych faktur (w katalogu docelowym)
+INDEX_FILENAME = ".ksef_index.sqlite"
+
+# Synchronizacja przyrostowa: zakładka wstecz od punktu kontrolnego (PermanentStorage)
+DEFAULT_INCREMENTAL_OVERLAP_MIN = 10
+
+# Limit wyników zapytania o metadane (isTruncated) — okno dzielone na podokna
+KSEF_QUERY_RESULT_LIMIT = 10000
+TRUNCATION_SPLIT_WORKERS = 4
+MIN_SPLIT_WINDOW = datetime.timedelta(seconds=1)
+
+# Cache sesji: odnowienie accessToken, gdy do wygaśnięcia zostało mniej niż
+SESSION_REFRESH_MARGIN_S = 120
+
+# Cache klucza publicznego KSeF: odświeżanie w tle po tylu godzinach lub na tyle
+# dni przed końcem ważności certyfikatu
+PUBLIC_KEY_CACHE_MAX_AGE_H = 24
+PUBLIC_KEY_REFRESH_BEFORE_D = 7
+
+# Ile stron metadanych pobierać z wyprzedzeniem w tle (0 = bez wyprzedzenia)
+DEFAULT_PREFETCH_PAGES = 2
+
+# Pobieranie XML strumieniowo: rozmiar porcji zapisywanej do pliku tymczasowego
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Eksport paczek faktur (POST /invoices/exports): odpytywanie statusu i
+# równoległe pobieranie części paczki
+EXPORT_POLL_INITIAL_S = 1.0
+EXPORT_POLL_MAX_INTERVAL_S = 10.0
+EXPORT_TIMEOUT_S = 900
+DEFAULT_EXPORT_PARTS = 4
+EXPORT_METADATA_FILENAME = "_metadata.json"
+
+# Metryki: kubełki histogramów czasu (s) i zajętości kolejek
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
 
 
 # ---------------------------------------------------------------------------
@@ -71,346 +154,1422 @@ class KSeFError(Exception):
 
 
 # ---------------------------------------------------------------------------
-# Klient KSeF
+# Limitowanie żądań (token bucket + HTTP 429)
 # ---------------------------------------------------------------------------
 
-class KSeFClient:
-    """Klient systemu KSeF obsługujący token i certyfikat."""
+def _endpoint_bucket(endpoint: str) -> str:
+    """Klasa endpointu KSeF dla limitera: query, download, auth lub other."""
+    if endpoint.startswith("/invoices/query"):
+        return "query"
+    if endpoint.startswith("/invoices/ksef/"):
+        return "download"
+    if endpoint.startswith("/invoices/exports"):
+        # Części paczki to pobrania, zlecenie i status eksportu — jak zapytania
+        return "download" if "/parts/" in endpoint else "query"
+    if endpoint.startswith("/auth") or endpoint.startswith("/security"):
+        return "auth"
+    return "other"
+
+
+def _retry_after_seconds(value: Optional[str], default: float = DEFAULT_RETRY_AFTER_S) -> float:
+    """Parsuj nagłówek Retry-After (sekundy lub data HTTP)."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Token bucket per klasa endpointu, wstrzymywany po HTTP 429.
+
+    Każdy kubełek ma własny budżet (żądań/s i pojemność). ``reserve()``
+    rezerwuje token i zwraca czas oczekiwania — tokeny mogą zejść poniżej
+    zera, więc równoległe wątki ustawiają się w kolejce zamiast budzić
+    się jednocześnie. ``pause()`` zatrzymuje kubełek na czas z Retry-After;
+    po pauzie kubełek startuje pusty i wraca do nominalnej szybkości.
+    Klasy bez budżetu nie są limitowane, ale respektują pauzę.
+
+    Bezpieczny wątkowo; jedna instancja może obsługiwać wielu klientów.
+    """
+
+    def __init__(self, limits: dict = None, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets: dict = {}
+        for name, (rate, burst) in (DEFAULT_RATE_LIMITS if limits is None else limits).items():
+            self._buckets[name] = self._new_bucket(rate, burst)
+
+    def _new_bucket(self, rate: Optional[float], burst: Optional[float]) -> dict:
+        return {
+            "rate": rate,
+            "burst": burst,
+            "tokens": burst if burst else 0.0,
+            "updated": self._clock(),
+            "paused_until": 0.0,
+            "throttled": 0,
+            "waited_s": 0.0,
+        }
+
+    def _bucket(self, name: str) -> dict:
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = self._new_bucket(None, None)
+        return bucket
+
+    @staticmethod
+    def _refill(bucket: dict, now: float) -> None:
+        if bucket["rate"]:
+            elapsed = max(0.0, now - bucket["updated"])
+            bucket["tokens"] = min(bucket["burst"], bucket["tokens"] + elapsed * bucket["rate"])
+        bucket["updated"] = max(now, bucket["updated"])
+
+    def reserve(self, name: str) -> float:
+        """Zarezerwuj jedno żądanie; zwraca ile sekund trzeba odczekać."""
+        with self._lock:
+            now = self._clock()
+            bucket = self._bucket(name)
+            self._refill(bucket, now)
+            wait = max(0.0, bucket["paused_until"] - now)
+            if bucket["rate"]:
+                bucket["tokens"] -= 1
+                if bucket["tokens"] < 0:
+                    wait = max(wait, bucket["updated"] - now - bucket["tokens"] / bucket["rate"])
+            bucket["waited_s"] += wait
+            return wait
+
+    def acquire(self, name: str) -> float:
+        """Zarezerwuj żądanie i zaczekaj (blokująco); zwraca czas oczekiwania."""
+        wait = self.reserve(name)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, name: str, seconds: float) -> None:
+        """Wstrzymaj kubełek na ``seconds`` (odpowiedź HTTP 429)."""
+        with self._lock:
+            now = self._clock()
+            bucket = self._bucket(name)
+            self._refill(bucket, now)
+            until = now + max(0.0, seconds)
+            bucket["throttled"] += 1
+            if until > bucket["paused_until"]:
+                bucket["paused_until"] = until
+                # Po pauzie bez zapasu — wznowienie z nominalną szybkością, nie burstem
+                bucket["tokens"] = min(bucket["tokens"], 0.0)
+                bucket["updated"] = until
+
+    def state(self) -> dict:
+        """Stan kubełków: tokeny, pauza, szacowany czas oczekiwania, liczba 429."""
+        with self._lock:
+            now = self._clock()
+            result = {}
+            for name, bucket in self._buckets.items():
+                self._refill(bucket, now)
+                paused_for = max(0.0, bucket["paused_until"] - now)
+                wait = paused_for
+                if bucket["rate"] and bucket["tokens"] < 1:
+                    wait = max(wait, bucket["updated"] - now + (1 - bucket["tokens"]) / bucket["rate"])
+                result[name] = {
+                    "rate": bucket["rate"],
+                    "burst": bucket["burst"],
+                    "tokens": round(bucket["tokens"], 3),
+                    "paused_for_s": round(paused_for, 3),
+                    "wait_s": round(wait, 3),
+                    "throttled": bucket["throttled"],
+                    "waited_s": round(bucket["waited_s"], 3),
+                }
+            return result
+
+
+def parse_rate_limits(specs: list) -> dict:
+    """Parsuj ``["query=2/4", "download=8"]`` do słownika budżetów RateLimiter."""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for spec in specs or []:
+        name, sep, value = spec.partition("=")
+        if not sep or not name:
+            raise ValueError(f"Nieprawidlowy limit: '{spec}' (oczekiwano KLASA=ZADAN_NA_S[/POJEMNOSC])")
+        rate_str, _, burst_str = value.partition("/")
+        rate = float(rate_str)
+        if rate <= 0:
+            limits[name] = (None, None)
+            continue
+        burst = float(burst_str) if burst_str else max(1.0, rate)
+        limits[name] = (rate, burst)
+    return limits
+
+
+# ---------------------------------------------------------------------------
+# Ponawianie błędów przejściowych
+# ---------------------------------------------------------------------------
+
+class RetryPolicy:
+    """Ponawianie błędów przejściowych: exponential backoff z jitterem.
+
+    Ponawiane są wyłącznie żądania idempotentne (GET, DELETE oraz jawnie
+    oznaczone, np. zapytanie o metadane) po błędzie połączenia, timeoucie
+    lub HTTP 502/503/504. Opóźnienie to losowa wartość z przedziału
+    [0, min(max_delay, base_delay * 2^próba)] ("full jitter"). Budżet
+    ogranicza łączną liczbę ponowień w przebiegu — przy awarii KSeF
+    przebieg kończy się szybko zamiast ponawiać każdą fakturę.
+
+    Bezpieczna wątkowo.
+    """
 
     def __init__(
         self,
-        nip: str,
-        environment: str = "prod",
-        timeout: int = REQUEST_TIMEOUT_S,
-        logger: logging.Logger = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_delay: float = DEFAULT_RETRY_BASE_S,
+        max_delay: float = DEFAULT_RETRY_MAX_S,
+        budget: Optional[int] = DEFAULT_RETRY_BUDGET,
+        status_codes: tuple = RETRYABLE_STATUS_CODES,
     ):
-        if environment not in KSEF_URLS:
-            raise ValueError(f"Nieznane srodowisko: {environment}. Dostepne: {list(KSEF_URLS.keys())}")
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.status_codes = status_codes
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> Optional[int]:
+        with self._lock:
+            return None if self.budget is None else max(0, self.budget - self.retries)
+
+    def next_delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """Zużyj ponowienie z budżetu i zwróć opóźnienie; None = nie ponawiać."""
+        if attempt >= self.max_retries:
+            return None
+        with self._lock:
+            if self.budget is not None and self.retries >= self.budget:
+                return None
+            self.retries += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
 
-        self.nip = nip
 
-        # Walidacja NIP
-        if not re.fullmatch(r'\d{10}', nip):
-            raise ValueError(f"Nieprawidlowy NIP: oczekiwano 10 cyfr, otrzymano '{nip}'")
+# ---------------------------------------------------------------------------
+# Metryki (format Prometheus)
+# ---------------------------------------------------------------------------
 
-        # Suma kontrolna NIP (modulo 11, wagi: 6,5,7,2,3,4,5,6,7)
-        weights = (6, 5, 7, 2, 3, 4, 5, 6, 7)
-        checksum = sum(int(nip[i]) * weights[i] for i in range(9)) % 11
-        if checksum != int(nip[9]):
-            raise ValueError(f"Nieprawidlowa suma kontrolna NIP: {nip}")
+# nazwa -> (typ, opis, kubełki histogramu)
+METRIC_DEFINITIONS = {
+    "ksef_invoices_total": (
+        "counter", "Faktury wg wyniku: downloaded, skipped, failed", None),
+    "ksef_downloaded_bytes_total": (
+        "counter", "Bajty zapisanych plików XML", None),
+    "ksef_http_responses_total": (
+        "counter", "Odpowiedzi API KSeF wg endpointu i kodu HTTP (error = błąd połączenia)", None),
+    "ksef_retries_total": (
+        "counter", "Ponowienia błędów przejściowych wg endpointu", None),
+    "ksef_http_request_duration_seconds": (
+        "histogram", "Czas żądania HTTP do KSeF (do nagłówków odpowiedzi) wg endpointu", LATENCY_BUCKETS_S),
+    "ksef_auth_duration_seconds": (
+        "histogram", "Czas pełnego uwierzytelnienia (challenge, status, redeem)", LATENCY_BUCKETS_S),
+    "ksef_page_fetch_duration_seconds": (
+        "histogram", "Czas pobrania strony metadanych (z ponowieniami i limitem)", LATENCY_BUCKETS_S),
+    "ksef_pdf_parse_duration_seconds": (
+        "histogram", "Czas parsowania XML faktury do PDF", LATENCY_BUCKETS_S),
+    "ksef_pdf_render_duration_seconds": (
+        "histogram", "Czas budowania pliku PDF", LATENCY_BUCKETS_S),
+    "ksef_queue_depth": (
+        "histogram", "Zajętość kolejki (prefetch, pdf) przy odbiorze/dodaniu elementu", QUEUE_DEPTH_BUCKETS),
+}
 
-        self.environment = environment
-        self.base_url = KSEF_URLS[environment]
-        self.timeout = timeout
-        self.logger = logger or logging.getLogger(__name__)
+# Identyfikatory w ścieżce zamieniane na szablon — ograniczona liczba serii
+_AUTH_ENDPOINTS = ("/auth/challenge", "/auth/ksef-token", "/auth/xades-signature")
 
-        self.authentication_token: Optional[str] = None
-        self.access_token: Optional[str] = None
-        self.refresh_token: Optional[str] = None
-        self.reference_number: Optional[str] = None
 
-        self._session = requests.Session()
-        self._session.headers.update({"Accept": "application/json"})
+def _metric_endpoint(endpoint: str) -> str:
+    """Etykieta endpointu: ścieżka bez query string i numerów KSeF/referencyjnych."""
+    path = endpoint.split("?", 1)[0]
+    if path.startswith("/invoices/ksef/"):
+        return "/invoices/ksef/{ksefNumber}"
+    if path.startswith("/auth/") and path.count("/") == 2 and path not in _AUTH_ENDPOINTS:
+        return "/auth/{referenceNumber}"
+    if path.startswith("/invoices/exports/"):
+        return "/invoices/exports/{referenceNumber}" + ("/parts" if "/parts/" in path else "")
+    return path
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._session.close()
-        return False
+def _prom_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(value) if isinstance(value, int) else repr(float(value))
 
-    # ------------------------------------------------------------------
-    # Żądania HTTP
-    # ------------------------------------------------------------------
 
-    def _request(
-        self,
-        method: str,
-        endpoint: str,
-        json_data: dict = None,
-        xml_data: str = None,
-        with_auth: bool = True,
-    ) -> dict:
-        url = f"{self.base_url}{endpoint}"
-        headers = {}
+def _prom_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(val).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for key, val in labels
+    )
+    return "{" + ",".join(f'{key}="{val}"' for key, val in escaped) + "}"
 
-        if xml_data:
-            headers["Content-Type"] = "application/xml; charset=utf-8"
-        else:
-            headers["Content-Type"] = "application/json"
 
-        if with_auth:
-            token = self.access_token or self.authentication_token
-            if token:
-                headers["Authorization"] = f"Bearer {token}"
+class Metrics:
+    """Liczniki i histogramy w formacie tekstowym Prometheus (bez zależności).
 
-        self.logger.debug("KSeF %s %s", method, url)
+    Jeden rejestr na proces, współdzielony przez klientów wszystkich NIP-ów;
+    etykiety ``nip``/``env`` dokłada widok z ``bind()``. Eksport: ``render()``,
+    ``write_textfile()`` (textfile collector node_exportera — tryb cron)
+    oraz ``serve()`` (HTTP /metrics — tryb ciągły).
 
-        try:
-            if method == "GET":
-                resp = self._session.get(url, headers=headers, timeout=self.timeout)
-            elif method == "POST":
-                if xml_data:
-                    resp = self._session.post(url, headers=headers, data=xml_data.encode("utf-8"), timeout=self.timeout)
-                else:
-                    resp = self._session.post(url, headers=headers, json=json_data, timeout=self.timeout)
-            elif method == "DELETE":
-                resp = self._session.delete(url, headers=headers, timeout=self.timeout)
-            else:
-                raise ValueError(f"Nieobslugiwana metoda HTTP: {method}")
-        except requests.RequestException as exc:
-            raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+    Bezpieczny wątkowo.
+    """
 
-        if resp.status_code >= 400:
-            msg = f"KSeF API HTTP {resp.status_code}"
-            data = {}
-            try:
-                data = resp.json()
-                exc_info = data.get("exception", {})
-                detail_list = exc_info.get("exceptionDetailList", [])
-                if detail_list:
-                    msg = detail_list[0].get("exceptionDescription", msg)
-            except ValueError:
-                data = {"raw": resp.text[:500]}
-            raise KSeFError(msg, resp.status_code, data)
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (nazwa, etykiety) -> wartość licznika lub [kubełki narastająco, suma, liczba]
+        self._values = {}
+
+    def bind(self, **labels) -> "_BoundMetrics":
+        """Widok rejestru dokładający stałe etykiety (np. nip, env)."""
+        return _BoundMetrics(self, labels)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self) -> str:
+        """Wszystkie serie w formacie tekstowym Prometheus 0.0.4."""
+        with self._lock:
+            snapshot = sorted(
+                (key, [list(val[0]), val[1], val[2]] if isinstance(val, list) else val)
+                for key, val in self._values.items()
+            )
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+            series = [(labels, val) for (metric, labels), val in snapshot if metric == name]
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, val in series:
+                if kind == "counter":
+                    lines.append(f"{name}{_prom_labels(labels)} {_prom_number(val)}")
+                    continue
+                counts, total, count = val
+                for bound, bucket_count in zip(buckets + (float("inf"),), counts + [count]):
+                    le = labels + (("le", _prom_number(bound)),)
+                    lines.append(f"{name}_bucket{_prom_labels(le)} {bucket_count}")
+                lines.append(f"{name}_sum{_prom_labels(labels)} {_prom_number(total)}")
+                lines.append(f"{name}_count{_prom_labels(labels)} {count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def write_textfile(self, path) -> None:
+        """Zapisz metryki atomowo (plik tymczasowy + rename) — node_exporter nie czyta połowy pliku."""
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(self.render(), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "") -> ThreadingHTTPServer:
+        """Udostępnij GET /metrics w wątku w tle; zatrzymanie: ``shutdown()`` zwróconego serwera."""
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        server.daemon_threads = True
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, name="ksef-metrics", daemon=True).start()
+        return server
+
+
+class _BoundMetrics:
+    """Widok ``Metrics`` ze stałymi etykietami (metryki jednego klienta KSeF)."""
+
+    def __init__(self, registry: Metrics, labels: dict):
+        self.registry = registry
+        self.labels = labels
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.registry.inc(name, value, **self.labels, **labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.registry.observe(name, value, **self.labels, **labels)
+
+    @contextlib.contextmanager
+    def timed(self, name: str, **labels):
+        """Zmierz czas bloku ``with`` w histogramie ``name``."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
 
-        if not resp.text:
-            return {}
 
-        ct = resp.headers.get("Content-Type", "")
-        if "application/json" in ct:
-            return resp.json()
-        return {"raw_content": resp.text}
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    # ------------------------------------------------------------------
-    # Challenge (wspólny dla obu metod)
-    # ------------------------------------------------------------------
+    def log_message(self, format, *args):
+        # Scrape co kilkanaście sekund — bez zaśmiecania logu
+        pass
 
-    def _get_challenge(self) -> dict:
-        return self._request(
-            "POST",
-            "/auth/challenge",
-            json_data={
-                "contextIdentifier": {
-                    "type": "onip",
-                    "identifier": self.nip,
-                }
-            },
-            with_auth=False,
-        )
 
-    # ------------------------------------------------------------------
-    # Polling + redeem (wspólne)
-    # ------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+# Śledzenie żądań (trace_hooks, --trace-file)
+# ---------------------------------------------------------------------------
 
-    def _poll_auth_status(self) -> None:
-        for attempt in range(MAX_AUTH_POLL_ATTEMPTS):
-            resp = self._request("GET", f"/auth/{self.reference_number}")
-            status = resp.get("status", {})
-            code = status.get("code") or resp.get("processingCode")
+# Nagłówki odpowiedzi z identyfikatorem żądania po stronie KSeF / bramy API
+TRACE_REQUEST_ID_HEADERS = ("x-request-id", "x-correlation-id", "x-ms-request-id")
 
-            if code == 200:
-                self.logger.info("Autoryzacja zakończona pomyślnie")
-                return
-            if code == 100:
-                self.logger.info("Autoryzacja w toku (%d/%d)...", attempt + 1, MAX_AUTH_POLL_ATTEMPTS)
-                time.sleep(AUTH_POLL_INTERVAL_S)
-                continue
+# Nagłówki nigdy nie zapisywane w śladzie
+_REDACTED_HEADERS = ("authorization", "cookie", "set-cookie", "proxy-authorization")
 
-            desc = status.get("description", "Nieznany błąd")
-            raise KSeFError(f"Blad autoryzacji: kod {code} - {desc}", response_data=resp)
+# Czasy DNS/TCP/TLS bieżącego żądania wątku — wypełniane przez połączenia urllib3
+_TRACE_CONTEXT = threading.local()
 
-        raise KSeFError("Timeout oczekiwania na autoryzacje")
 
-    def _redeem_token(self) -> None:
-        resp = self._request("POST", "/auth/token/redeem")
-        at = resp.get("accessToken")
-        rt = resp.get("refreshToken")
-        self.access_token = at.get("token") if isinstance(at, dict) else at
-        self.refresh_token = rt.get("token") if isinstance(rt, dict) else rt
+def _redact_headers(headers) -> dict:
+    """Nagłówki do śladu: tokeny (Authorization, cookie) zastąpione znacznikiem."""
+    redacted = {}
+    for name, value in (headers or {}).items():
+        if name.lower() in _REDACTED_HEADERS or "token" in name.lower():
+            scheme = value.split(" ", 1)[0] if name.lower() == "authorization" and " " in value else ""
+            value = f"{scheme} <redacted>".strip()
+        redacted[name] = value
+    return redacted
 
-    # ------------------------------------------------------------------
-    # Auth: Token KSeF
-    # ------------------------------------------------------------------
 
-    def authenticate_token(self, ksef_token: str) -> None:
-        """Uwierzytelnianie tokenem KSeF (RSA-OAEP SHA-256)."""
-        self.logger.info("Uwierzytelnianie tokenem KSeF dla NIP %s...", self.nip)
+def _trace_ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
 
-        challenge_resp = self._get_challenge()
-        challenge = challenge_resp.get("challenge")
-        timestamp_ms = challenge_resp.get("timestampMs")
 
-        if not challenge or timestamp_ms is None:
-            raise KSeFError("Brak challenge/timestamp z KSeF", response_data=challenge_resp)
+class _TracedConnectionMixin:
+    """Pomiar DNS, TCP i TLS nowego połączenia dla spanu bieżącego wątku.
 
-        # Pobierz klucz publiczny KSeF do szyfrowania tokenu
-        public_key = self._fetch_token_encryption_key()
+    Bez aktywnego spanu (brak trace_hooks) — zwykłe połączenie urllib3.
+    Połączenie z puli (keep-alive) nie ma tych czasów — span pokazuje wtedy
+    same TTFB/total.
+    """
 
-        # Szyfrowanie: {token}|{timestampMs} -> RSA-OAEP SHA-256 -> Base64
-        plaintext = f"{ksef_token}|{timestamp_ms}".encode("utf-8")
-        encrypted = public_key.encrypt(
-            plaintext,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
-        encrypted_b64 = base64.b64encode(encrypted).decode("utf-8")
+    def _new_conn(self):
+        timings = getattr(_TRACE_CONTEXT, "timings", None)
+        if timings is None:
+            return super()._new_conn()
+        started = time.perf_counter()
+        try:
+            # Osobne rozwiązanie nazwy tylko dla pomiaru; create_connection
+            # trafia już w cache resolvera. Błąd zgłosi właściwe połączenie.
+            socket.getaddrinfo(self._dns_host, self.port, type=socket.SOCK_STREAM)
+        except OSError:
+            pass
+        resolved = time.perf_counter()
+        sock = super()._new_conn()
+        timings["dns"] = resolved - started
+        timings["connect"] = time.perf_counter() - resolved
+        return sock
 
-        # Wysłanie
-        resp = self._request(
-            "POST",
-            "/auth/ksef-token",
-            json_data={
-                "challenge": challenge,
-                "contextIdentifier": {"type": "Nip", "value": self.nip},
-                "encryptedToken": encrypted_b64,
-            },
-            with_auth=False,
-        )
 
-        self.authentication_token = resp.get("authenticationToken", {}).get("token")
-        self.reference_number = resp.get("referenceNumber")
+class _TracedHTTPConnection(_TracedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
 
-        if not self.authentication_token:
-            raise KSeFError("Brak authenticationToken w odpowiedzi", response_data=resp)
 
-        self._poll_auth_status()
-        self._redeem_token()
-        self.logger.info("Uwierzytelnianie tokenem zakończone — accessToken uzyskany")
+class _TracedHTTPSConnection(_TracedConnectionMixin, urllib3.connection.HTTPSConnection):
 
-    def _fetch_token_encryption_key(self):
-        """Pobierz klucz publiczny KSeF do szyfrowania tokenów."""
-        resp = self._request("GET", "/security/public-key-certificates", with_auth=False)
+    def connect(self):
+        timings = getattr(_TRACE_CONTEXT, "timings", None)
+        if timings is None:
+            return super().connect()
+        started = time.perf_counter()
+        super().connect()
+        # connect() = _new_conn() (DNS + TCP) + handshake TLS
+        timings["tls"] = time.perf_counter() - started - timings.get("dns", 0) - timings.get("connect", 0)
 
-        certs = resp if isinstance(resp, list) else resp.get("certificates", [])
-        if not certs:
-            raise KSeFError("Brak certyfikatow publicznych KSeF")
 
-        for cert_info in certs:
-            usage = cert_info.get("usage", [])
-            if "KsefTokenEncryption" in usage:
-                cert_b64 = cert_info["certificate"]
-                cert_der = base64.b64decode(cert_b64)
-                cert = x509.load_der_x509_certificate(cert_der, default_backend())
-                return cert.public_key()
+class _TracedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
 
-        # Fallback — pierwszy aktywny certyfikat
-        cert_b64 = certs[0].get("certificate") or certs[0].get("publicKey")
-        if not cert_b64:
-            raise KSeFError("Nie mozna wyodrebnic klucza publicznego KSeF")
 
-        cert_der = base64.b64decode(cert_b64)
-        cert = x509.load_der_x509_certificate(cert_der, default_backend())
-        return cert.public_key()
+class _TracedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
 
-    # ------------------------------------------------------------------
-    # Auth: Certyfikat X.509 (XAdES-BES)
-    # ------------------------------------------------------------------
 
-    def authenticate_certificate(
-        self,
-        cert_path: str,
-        key_path: str,
-        key_password: str = None,
-    ) -> None:
-        """Uwierzytelnianie certyfikatem X.509 z podpisem XAdES-BES."""
-        if etree is None:
-            raise KSeFError(
-                "Brak biblioteki lxml — wymagana do podpisu XAdES. "
-                "Zainstaluj: pip install lxml>=4.9"
-            )
+class _TracingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter z połączeniami mierzącymi DNS/TCP/TLS dla trace_hooks."""
 
-        self.logger.info("Uwierzytelnianie certyfikatem dla NIP %s...", self.nip)
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TracedHTTPConnectionPool,
+            "https": _TracedHTTPSConnectionPool,
+        }
 
-        # Wczytaj certyfikat i klucz prywatny
-        certificate = self._load_certificate(cert_path)
-        private_key = self._load_private_key(key_path, key_password)
 
-        # Challenge
-        challenge_resp = self._get_challenge()
-        challenge = challenge_resp.get("challenge")
-        timestamp = challenge_resp.get("timestamp")
+def _httpx_trace(timings: dict):
+    """Rozszerzenie ``trace`` httpx (httpcore): czasy TCP/TLS/TTFB żądania async.
 
-        if not challenge:
-            raise KSeFError("Brak challenge z KSeF", response_data=challenge_resp)
+    httpcore nie raportuje osobno DNS — zawiera się w ``connect``.
+    """
+    started = time.perf_counter()
+    marks = {}
+    phases = {"connect_tcp": "connect", "start_tls": "tls"}
+
+    async def _trace(event: str, info: dict) -> None:
+        now = time.perf_counter()
+        name, _, stage = event.rpartition(".")
+        step = name.rsplit(".", 1)[-1]
+        if stage == "started":
+            marks[step] = now
+        elif stage == "complete" and step in phases and step in marks:
+            timings[phases[step]] = now - marks[step]
+        elif stage == "complete" and step == "receive_response_headers":
+            timings["ttfb"] = now - started
+
+    return _trace
+
+
+class TraceWriter:
+    """Hook dla ``trace_hooks`` zapisujący spany do pliku.
+
+    Domyślnie JSONL (jeden span na linię, dopisywany na bieżąco); plik
+    z rozszerzeniem ``.har`` — archiwum HAR 1.2 zapisywane przy ``close()``
+    (same spany HTTP, do otwarcia w narzędziach deweloperskich przeglądarki).
+    Tokeny są usuwane z nagłówków już w spanie. Bezpieczny wątkowo.
+    """
 
-        # Buduj i podpisz XML
-        xml_content = self._build_auth_token_request_xml(challenge, timestamp)
-        signed_xml = self._sign_xml_xades(xml_content, certificate, private_key)
+    def __init__(self, path):
+        self.path = Path(path)
+        self.har = self.path.suffix.lower() == ".har"
+        self._lock = threading.Lock()
+        self._entries = []
+        self._file = None if self.har else open(self.path, "a", encoding="utf-8")
+
+    def __call__(self, span: dict) -> None:
+        with self._lock:
+            if self.har:
+                if span["kind"] == "http":
+                    self._entries.append(_har_entry(span))
+            elif self._file is not None:
+                self._file.write(json.dumps(span, ensure_ascii=False) + "\n")
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.har:
+                har = {"log": {
+                    "version": "1.2",
+                    "creator": {"name": "ksef_client", "version": "2.0"},
+                    "entries": sorted(self._entries, key=lambda entry: entry["startedDateTime"]),
+                }}
+                tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps(har, ensure_ascii=False, indent=1), encoding="utf-8")
+                os.replace(tmp_path, self.path)
+
+
+def _har_entry(span: dict) -> dict:
+    """Span HTTP jako wpis HAR 1.2 (czasy w ms, -1 = nie dotyczy)."""
+    t = span["timings"]
+    dns, connect, tls = (t.get(key) for key in ("dns", "connect", "tls"))
+    total = t.get("total") or 0
+    ttfb = t.get("ttfb") if t.get("ttfb") is not None else total
+    setup = sum(v for v in (dns, connect, tls) if v is not None)
+    response_headers = span.get("response_headers") or {}
+    size = span.get("response_size")
+    return {
+        "startedDateTime": span["start"],
+        "time": total,
+        "request": {
+            "method": span["method"],
+            "url": span["url"],
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": k, "value": v} for k, v in span["request_headers"].items()],
+            "queryString": [],
+            "cookies": [],
+            "headersSize": -1,
+            "bodySize": -1,
+        },
+        "response": {
+            "status": span.get("status") or 0,
+            "statusText": span.get("error") or "",
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": k, "value": v} for k, v in response_headers.items()],
+            "cookies": [],
+            "content": {"size": size or 0, "mimeType": response_headers.get("Content-Type", "")},
+            "redirectURL": "",
+            "headersSize": -1,
+            "bodySize": -1 if size is None else size,
+        },
+        "cache": {},
+        "timings": {
+            "blocked": -1,
+            "dns": -1 if dns is None else dns,
+            # HAR: connect obejmuje też TLS
+            "connect": -1 if connect is None else connect + (tls or 0),
+            "ssl": -1 if tls is None else tls,
+            "send": 0,
+            "wait": max(0.0, round(ttfb - setup, 3)),
+            "receive": max(0.0, round(total - ttfb, 3)),
+        },
+        "_nip": span["nip"],
+        "_env": span["env"],
+        "_phase": span["phase"],
+        "_attempt": span["attempt"],
+        "_requestId": span.get("request_id"),
+    }
 
-        # Wyślij podpisany XML
-        resp = self._request(
-            "POST",
-            "/auth/xades-signature",
-            xml_data=signed_xml,
-            with_auth=False,
-        )
 
-        self.authentication_token = resp.get("authenticationToken", {}).get("token")
-        self.reference_number = resp.get("referenceNumber")
+# ---------------------------------------------------------------------------
+# Odpytywanie statusu uwierzytelnienia
+# ---------------------------------------------------------------------------
 
-        if not self.authentication_token:
-            raise KSeFError("Brak authenticationToken w odpowiedzi", response_data=resp)
+class AuthPoller:
+    """Adaptacyjny harmonogram odpytywania GET /auth/{referenceNumber}.
 
-        self._poll_auth_status()
-        self._redeem_token()
-        self.logger.info("Uwierzytelnianie certyfikatem zakończone — accessToken uzyskany")
+    Pierwsze zapytanie po typowym czasie autoryzacji w danym środowisku
+    (średnia krocząca z poprzednich uwierzytelnień, zapisywana w
+    ``state_dir``), bez historii — od razu. Kolejne odstępy rosną
+    geometrycznie od ``initial_s`` do ``max_interval_s``; podpowiedź serwera
+    (``Retry-After``) ma pierwszeństwo. Jeden obiekt może obsługiwać wielu
+    klientów (bezpieczny wątkowo).
+    """
 
-    def _load_certificate(self, cert_path: str) -> x509.Certificate:
-        path = Path(cert_path)
-        if not path.exists():
-            raise KSeFError(f"Certyfikat nie znaleziony: {cert_path}")
+    STATE_FILENAME = ".ksef_auth_latency.json"
+    EWMA_ALPHA = 0.3
+    # Pierwsze zapytanie nieco przed typowym czasem — lepiej raz za wcześnie niż za późno
+    FIRST_POLL_FRACTION = 0.8
 
-        data = path.read_bytes()
+    def __init__(
+        self,
+        state_dir=None,
+        initial_s: float = None,
+        factor: float = AUTH_POLL_BACKOFF,
+        max_interval_s: float = AUTH_POLL_MAX_INTERVAL_S,
+        timeout_s: float = AUTH_POLL_TIMEOUT_S,
+        max_attempts: int = MAX_AUTH_POLL_ATTEMPTS,
+    ):
+        self.initial_s = AUTH_POLL_INTERVAL_S if initial_s is None else initial_s
+        self.factor = factor
+        self.max_interval_s = max_interval_s
+        self.timeout_s = timeout_s
+        self.max_attempts = max_attempts
+        self.path = Path(state_dir) / self.STATE_FILENAME if state_dir else None
+        self._lock = threading.Lock()
+        self._latency = self._load()
+
+    def _load(self) -> dict:
+        if self.path is None or not self.path.is_file():
+            return {}
         try:
-            return x509.load_pem_x509_certificate(data, default_backend())
-        except ValueError:
-            return x509.load_der_x509_certificate(data, default_backend())
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            return {env: float(v["latency_s"]) for env, v in data.items()}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            return {}
 
-    def _load_private_key(self, key_path: str, password: str = None):
-        path = Path(key_path)
-        if not path.exists():
-            raise KSeFError(f"Klucz prywatny nie znaleziony: {key_path}")
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        data = {env: {"latency_s": round(v, 3)} for env, v in self._latency.items()}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
 
-        data = path.read_bytes()
-        pwd = password.encode("utf-8") if password else None
+    def expected_latency(self, environment: str) -> Optional[float]:
+        with self._lock:
+            return self._latency.get(environment)
 
-        try:
-            return serialization.load_pem_private_key(data, password=pwd, backend=default_backend())
-        except TypeError:
-            # Klucz zaszyfrowany, hasło nie podane — pytaj interaktywnie
-            if pwd is None:
-                import getpass
-                try:
-                    pwd_input = getpass.getpass("Haslo klucza prywatnego: ")
-                    return serialization.load_pem_private_key(
-                        data, password=pwd_input.encode("utf-8"), backend=default_backend()
-                    )
-                except (ValueError, TypeError) as exc2:
-                    raise KSeFError(f"Bledne haslo klucza prywatnego: {exc2}")
-            raise KSeFError("Klucz prywatny jest zaszyfrowany - podaj haslo (--password, --password-enc lub --password-file)")
-        except (ValueError, TypeError) as exc:
-            raise KSeFError(f"Blad ladowania klucza prywatnego: {exc}")
+    def schedule(self, environments) -> list:
+        """Odstępy (s) przed kolejnymi zapytaniami o status.
 
-    def _build_auth_token_request_xml(self, challenge: str, timestamp: str = None) -> str:
-        root = etree.Element("AuthTokenRequest", nsmap={None: AUTH_TOKEN_NS})
+        Dla kilku środowisk naraz pierwszy odstęp wg najszybszego z nich
+        (bez historii dla któregokolwiek — 0).
+        """
+        learned = [self.expected_latency(env) for env in set(environments)]
+        if learned and all(v is not None for v in learned):
+            first = min(min(learned) * self.FIRST_POLL_FRACTION, self.max_interval_s)
+        else:
+            first = 0.0
+        delays = [first]
+        interval = self.initial_s
+        while len(delays) < self.max_attempts:
+            delays.append(interval)
+            interval = min(interval * self.factor, self.max_interval_s)
+        return delays
+
+    def record(self, environment: str, elapsed_s: float) -> None:
+        """Zapamiętaj czas do zakończenia autoryzacji (średnia krocząca)."""
+        with self._lock:
+            previous = self._latency.get(environment)
+            if previous is None:
+                self._latency[environment] = elapsed_s
+            else:
+                self._latency[environment] = previous + self.EWMA_ALPHA * (elapsed_s - previous)
+            self._save()
 
-        ch = etree.SubElement(root, "Challenge")
-        ch.text = challenge
 
-        ctx = etree.SubElement(root, "ContextIdentifier")
-        nip_el = etree.SubElement(ctx, "Nip")
-        nip_el.text = self.nip
+def poll_auth_statuses(clients: list, poller: AuthPoller = None) -> dict:
+    """Odpytuj status uwierzytelnienia wielu klientów we wspólnym harmonogramie.
 
-        sub = etree.SubElement(root, "SubjectIdentifierType")
-        sub.text = "certificateSubject"
+    Klienci (``KSeFClient``) po ``start_token_authentication`` lub
+    ``start_certificate_authentication``. W każdej rundzie pytamy o status
+    wszystkich oczekujących, potem jedna wspólna przerwa — N uwierzytelnień
+    kosztuje tyle czasu co najwolniejsze, a nie sumę.
 
-        return '<?xml version="1.0" encoding="utf-8"?>' + etree.tostring(root, encoding="unicode")
+    Returns:
+        {klient: None (zakończone) lub KSeFError}
+    """
+    if not clients:
+        return {}
+    poller = poller or clients[0].auth_poller
+    results = {}
+    pending = list(clients)
+    started = time.monotonic()
+    hint = None
+
+    for attempt, delay in enumerate(poller.schedule([c.environment for c in clients]), start=1):
+        elapsed = time.monotonic() - started
+        if hint is not None:
+            delay = hint
+        delay = min(delay, poller.timeout_s - elapsed)
+        if delay < 0:
+            break
+        if delay:
+            time.sleep(delay)
 
-    def _sign_xml_xades(
+        hints = []
+        for client in list(pending):
+            try:
+                resp, headers = client._request("GET", f"/auth/{client.reference_number}", with_headers=True)
+                done = client._check_auth_status(resp)
+            except KSeFError as exc:
+                results[client] = exc
+                pending.remove(client)
+                continue
+
+            elapsed = time.monotonic() - started
+            if done:
+                client.logger.info("Autoryzacja zakończona pomyślnie")
+                poller.record(client.environment, elapsed)
+                results[client] = None
+                pending.remove(client)
+            else:
+                client.logger.info("Autoryzacja w toku (%d, %.1f s)...", attempt, elapsed)
+                if headers.get("Retry-After"):
+                    hints.append(_retry_after_seconds(headers.get("Retry-After"), poller.initial_s))
+
+        if not pending:
+            return results
+        hint = min(hints) if hints else None
+
+    for client in pending:
+        results[client] = KSeFError("Timeout oczekiwania na autoryzacje")
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Certyfikaty klucza publicznego KSeF (szyfrowanie tokenu)
+# ---------------------------------------------------------------------------
+
+def _token_encryption_certificate(resp, usage: str = "KsefTokenEncryption") -> x509.Certificate:
+    """Wybierz certyfikat KsefTokenEncryption (lub innego ``usage``) z odpowiedzi /security/public-key-certificates."""
+    certs = resp if isinstance(resp, list) else resp.get("certificates", [])
+    if not certs:
+        raise KSeFError("Brak certyfikatow publicznych KSeF")
+
+    for cert_info in certs:
+        if usage in cert_info.get("usage", []):
+            cert_der = base64.b64decode(cert_info["certificate"])
+            return x509.load_der_x509_certificate(cert_der, default_backend())
+
+    # Fallback — pierwszy aktywny certyfikat
+    cert_b64 = certs[0].get("certificate") or certs[0].get("publicKey")
+    if not cert_b64:
+        raise KSeFError("Nie mozna wyodrebnic klucza publicznego KSeF")
+
+    cert_der = base64.b64decode(cert_b64)
+    return x509.load_der_x509_certificate(cert_der, default_backend())
+
+
+def _certificate_validity(cert: x509.Certificate) -> tuple:
+    """(od, do) ważności certyfikatu jako datetime UTC."""
+    if hasattr(cert, "not_valid_after_utc"):
+        return cert.not_valid_before_utc, cert.not_valid_after_utc
+    # cryptography < 42 — naiwne datetime w UTC
+    return (cert.not_valid_before.replace(tzinfo=datetime.timezone.utc),
+            cert.not_valid_after.replace(tzinfo=datetime.timezone.utc))
+
+
+class PublicKeyCache:
+    """Cache klucza publicznego KSeF do szyfrowania tokenów, per środowisko.
+
+    Jedna instancja obsługuje wszystkich klientów w procesie; z ``state_dir``
+    odpowiedź KSeF jest zapisywana na dysk i używana w kolejnych przebiegach.
+    Klucz z certyfikatu, który wygasł, nie jest zwracany. Gdy certyfikat
+    zbliża się do końca ważności (``refresh_before``) lub wpis jest starszy
+    niż ``max_age``, klient dostaje klucz z cache, a świeża lista jest
+    pobierana w tle.
+    """
+
+    STATE_FILENAME = ".ksef_public_keys.json"
+
+    def __init__(
+        self,
+        state_dir=None,
+        max_age: datetime.timedelta = datetime.timedelta(hours=PUBLIC_KEY_CACHE_MAX_AGE_H),
+        refresh_before: datetime.timedelta = datetime.timedelta(days=PUBLIC_KEY_REFRESH_BEFORE_D),
+    ):
+        self.path = Path(state_dir) / self.STATE_FILENAME if state_dir else None
+        self.max_age = max_age
+        self.refresh_before = refresh_before
+        self._lock = threading.Lock()
+        self._raw = self._load()
+        # środowisko -> (klucz publiczny, ważny od, ważny do, pobrano)
+        self._keys = {}
+        self._refreshing = set()
+
+    def _load(self) -> dict:
+        if self.path is None or not self.path.is_file():
+            return {}
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(self._raw), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def _entry(self, environment: str) -> Optional[tuple]:
+        """Sparsowany wpis (z pamięci lub — raz na proces — z pliku)."""
+        entry = self._keys.get(environment)
+        if entry is not None:
+            return entry
+        raw = self._raw.get(environment)
+        if not raw:
+            return None
+        try:
+            cert = _token_encryption_certificate(raw["certificates"])
+            fetched_at = _parse_ksef_datetime(raw["fetched_at"])
+        except (KSeFError, KeyError, TypeError, ValueError):
+            return None
+        entry = (cert.public_key(), *_certificate_validity(cert), fetched_at)
+        self._keys[environment] = entry
+        return entry
+
+    def lookup(self, environment: str) -> tuple:
+        """(klucz publiczny lub None, czy odświeżyć w tle)."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            entry = self._entry(environment)
+        if entry is None:
+            return None, False
+        public_key, valid_from, valid_to, fetched_at = entry
+        if not (valid_from <= now < valid_to):
+            return None, False
+        stale = (valid_to - now) < self.refresh_before or fetched_at is None or (now - fetched_at) > self.max_age
+        return public_key, stale
+
+    def store(self, environment: str, resp):
+        """Zapamiętaj odpowiedź /security/public-key-certificates; zwraca klucz publiczny."""
+        cert = _token_encryption_certificate(resp)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificates = resp if isinstance(resp, list) else resp.get("certificates", [])
+        entry = (cert.public_key(), *_certificate_validity(cert), now)
+        with self._lock:
+            self._keys[environment] = entry
+            self._raw[environment] = {"fetched_at": now.isoformat(), "certificates": certificates}
+            self._save()
+        return entry[0]
+
+    def invalidate(self, environment: str) -> None:
+        with self._lock:
+            self._keys.pop(environment, None)
+            self._raw.pop(environment, None)
+            self._save()
+
+    def refresh_in_background(self, environment: str, fetch, logger: logging.Logger = None) -> None:
+        """Pobierz świeżą listę certyfikatów w wątku (``fetch()`` zwraca odpowiedź KSeF)."""
+        with self._lock:
+            if environment in self._refreshing:
+                return
+            self._refreshing.add(environment)
+
+        def _refresh():
+            try:
+                self.store(environment, fetch())
+            except KSeFError as exc:
+                (logger or logging.getLogger(__name__)).debug("Odświeżanie certyfikatów KSeF: %s", exc)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(environment)
+
+        threading.Thread(target=_refresh, name="ksef-public-keys", daemon=True).start()
+
+
+# Cache współdzielony przez klientów w procesie (bez zapisu na dysk)
+_SHARED_PUBLIC_KEY_CACHE = PublicKeyCache()
+
+
+# ---------------------------------------------------------------------------
+# Klient KSeF — część wspólna
+# ---------------------------------------------------------------------------
+
+def new_http_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """Sesja requests z pulą połączeń na ``pool_size`` równoległych żądań.
+
+    Pula dopasowana do liczby wątków — inaczej urllib3 odrzuca nadmiarowe
+    połączenia i każdy wątek płaci za nowy TLS handshake.
+    """
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json"})
+    # Połączenia mierzą DNS/TCP/TLS tylko przy aktywnym śledzeniu (trace_hooks)
+    adapter = _TracingHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _api_error(status_code: int, data: dict) -> KSeFError:
+    """Zbuduj KSeFError z odpowiedzi błędu KSeF API (exceptionDetailList)."""
+    msg = f"KSeF API HTTP {status_code}"
+    exc_info = data.get("exception", {}) if isinstance(data, dict) else {}
+    detail_list = exc_info.get("exceptionDetailList", [])
+    if detail_list:
+        msg = detail_list[0].get("exceptionDescription", msg)
+    return KSeFError(msg, status_code, data)
+
+
+class _KSeFClientBase:
+    """Logika wspólna dla KSeFClient i AsyncKSeFClient (bez operacji sieciowych).
+
+    Walidacja NIP, stan tokenów, budowa payloadów oraz kryptografia
+    (szyfrowanie tokenu RSA-OAEP, podpis XAdES-BES).
+    """
+
+    def __init__(
+        self,
+        nip: str,
+        environment: str = "prod",
+        timeout: int = REQUEST_TIMEOUT_S,
+        logger: logging.Logger = None,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        auth_poller: AuthPoller = None,
+        public_key_cache: PublicKeyCache = None,
+        metrics: Metrics = None,
+    ):
+        if environment not in KSEF_URLS:
+            raise ValueError(f"Nieznane srodowisko: {environment}. Dostepne: {list(KSEF_URLS.keys())}")
+
+        self.nip = nip
+
+        # Walidacja NIP
+        if not re.fullmatch(r'\d{10}', nip):
+            raise ValueError(f"Nieprawidlowy NIP: oczekiwano 10 cyfr, otrzymano '{nip}'")
+
+        # Suma kontrolna NIP (modulo 11, wagi: 6,5,7,2,3,4,5,6,7)
+        weights = (6, 5, 7, 2, 3, 4, 5, 6, 7)
+        checksum = sum(int(nip[i]) * weights[i] for i in range(9)) % 11
+        if checksum != int(nip[9]):
+            raise ValueError(f"Nieprawidlowa suma kontrolna NIP: {nip}")
+
+        self.environment = environment
+        self.base_url = KSEF_URLS[environment]
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.authentication_token: Optional[str] = None
+        self.access_token: Optional[str] = None
+        self.refresh_token: Optional[str] = None
+        self.reference_number: Optional[str] = None
+        self.access_token_valid_until: Optional[datetime.datetime] = None
+        self.refresh_token_valid_until: Optional[datetime.datetime] = None
+
+        # Tokeny czytane równolegle przez wątki pobierające (--concurrency)
+        self._token_lock = threading.Lock()
+
+        # Limiter może być współdzielony przez wielu klientów (ten sam budżet API)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.auth_poller = auth_poller or AuthPoller()
+        self.public_key_cache = public_key_cache or _SHARED_PUBLIC_KEY_CACHE
+        # Rejestr metryk zwykle wspólny dla procesu (ksef_sync.py); serie z etykietami NIP/środowiska
+        self.metrics = (metrics or Metrics()).bind(nip=nip, env=environment)
+        # Wywoływane z każdym zakończonym spanem żądania (np. TraceWriter); pusta lista = bez kosztu
+        self.trace_hooks = []
+
+    def _on_throttled(self, bucket: str, resp_headers) -> None:
+        """Obsłuż HTTP 429: wstrzymaj kubełek na czas z Retry-After."""
+        delay = _retry_after_seconds(resp_headers.get("Retry-After"))
+        self.rate_limiter.pause(bucket, delay)
+        self.logger.warning("KSeF HTTP 429 (%s) — wstrzymanie na %.1f s", bucket, delay)
+
+    def _retry_delay(self, attempt: int, idempotent: bool, reason: str, endpoint: str,
+                     resp_headers=None) -> Optional[float]:
+        """Opóźnienie przed ponowieniem błędu przejściowego; None = zgłoś błąd."""
+        if not idempotent:
+            return None
+        retry_after = None
+        if resp_headers is not None and resp_headers.get("Retry-After"):
+            retry_after = _retry_after_seconds(resp_headers.get("Retry-After"))
+        delay = self.retry_policy.next_delay(attempt, retry_after)
+        if delay is not None:
+            self.metrics.inc("ksef_retries_total", endpoint=_metric_endpoint(endpoint))
+            self.logger.warning("KSeF %s: %s — ponowienie %d/%d za %.1f s",
+                                endpoint, reason, attempt + 1, self.retry_policy.max_retries, delay)
+        return delay
+
+    def _observe_response(self, endpoint: str, status, started: float) -> None:
+        """Metryki jednej próby żądania HTTP (``status`` "error" = błąd połączenia)."""
+        path = _metric_endpoint(endpoint)
+        self.metrics.inc("ksef_http_responses_total", endpoint=path, code=str(status))
+        self.metrics.observe("ksef_http_request_duration_seconds", time.monotonic() - started, endpoint=path)
+
+    # ------------------------------------------------------------------
+    # Śledzenie żądań
+    # ------------------------------------------------------------------
+
+    # Czasy DNS/TCP/TLS z połączeń urllib3 (klient synchroniczny)
+    _TRACE_THREAD_TIMINGS = True
+
+    @contextlib.contextmanager
+    def _trace_span(self, kind: str, method: str, url: str, endpoint: str, headers=None, attempt: int = 0):
+        """Span żądania przekazywany do ``trace_hooks`` po zakończeniu bloku.
+
+        ``kind`` "http" — jedna próba żądania (DNS/TCP/TLS/TTFB/total),
+        "download" — całe pobranie XML do pliku, z treścią i ponowieniami.
+        Bez hooków zwraca None. Czasy w spanie w milisekundach.
+        """
+        if not self.trace_hooks:
+            yield None
+            return
+        timings = {}
+        span = {
+            "kind": kind,
+            "phase": _endpoint_bucket(endpoint),
+            "nip": self.nip,
+            "env": self.environment,
+            "method": method,
+            "url": url,
+            "endpoint": _metric_endpoint(endpoint),
+            "attempt": attempt,
+            "start": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "thread": threading.current_thread().name,
+            "request_headers": _redact_headers(headers),
+            "status": None,
+            "request_id": None,
+            "response_size": None,
+            "response_headers": {},
+            "error": None,
+            "timings": timings,
+        }
+        thread_timings = kind == "http" and self._TRACE_THREAD_TIMINGS
+        previous = getattr(_TRACE_CONTEXT, "timings", None)
+        if thread_timings:
+            _TRACE_CONTEXT.timings = timings
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as exc:
+            span["error"] = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            timings["total"] = time.perf_counter() - started
+            if thread_timings:
+                _TRACE_CONTEXT.timings = previous
+            span["timings"] = {key: _trace_ms(timings.get(key)) for key in ("dns", "connect", "tls", "ttfb", "total")}
+            for hook in list(self.trace_hooks):
+                try:
+                    hook(span)
+                except Exception as exc:
+                    # Śledzenie nie może przerwać przebiegu
+                    self.logger.debug("Hook śledzenia %r: %s", hook, exc)
+
+    @staticmethod
+    def _trace_response(span: Optional[dict], resp, size: Optional[int] = None, ttfb: Optional[float] = None) -> None:
+        """Uzupełnij span o odpowiedź; ``size`` None — z Content-Length (treść strumieniowa)."""
+        if span is None:
+            return
+        headers = resp.headers
+        if size is None and headers.get("Content-Length", "").isdigit():
+            size = int(headers["Content-Length"])
+        span["status"] = resp.status_code
+        span["response_headers"] = _redact_headers(headers)
+        span["request_id"] = next((headers[name] for name in TRACE_REQUEST_ID_HEADERS if name in headers), None)
+        span["response_size"] = size
+        if ttfb is not None:
+            span["timings"]["ttfb"] = ttfb
+
+    # ------------------------------------------------------------------
+    # Stan sesji
+    # ------------------------------------------------------------------
+
+    def _bearer_token(self) -> Optional[str]:
+        with self._token_lock:
+            return self.access_token or self.authentication_token
+
+    def _require_access_token(self) -> str:
+        with self._token_lock:
+            access_token = self.access_token
+        if not access_token:
+            raise KSeFError("Brak aktywnej sesji - najpierw uwierzytelnij sie")
+        return access_token
+
+    def _auth_headers(self, content_type: str = "application/json", with_auth: bool = True,
+                      bearer: str = None) -> dict:
+        headers = {"Content-Type": content_type}
+        if with_auth:
+            token = bearer or self._bearer_token()
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+        return headers
+
+    def _store_auth_init(self, resp: dict) -> None:
+        """Zapisz authenticationToken/referenceNumber z odpowiedzi ksef-token/xades-signature."""
+        with self._token_lock:
+            self.authentication_token = resp.get("authenticationToken", {}).get("token")
+            self.reference_number = resp.get("referenceNumber")
+
+        if not self.authentication_token:
+            raise KSeFError("Brak authenticationToken w odpowiedzi", response_data=resp)
+
+    @staticmethod
+    def _token_parts(value) -> tuple:
+        """(token, validUntil) z pola accessToken/refreshToken odpowiedzi KSeF."""
+        if isinstance(value, dict):
+            return value.get("token"), _parse_ksef_datetime(value.get("validUntil"))
+        return value, None
+
+    def _store_redeemed_tokens(self, resp: dict) -> None:
+        access_token, access_valid_until = self._token_parts(resp.get("accessToken"))
+        refresh_token, refresh_valid_until = self._token_parts(resp.get("refreshToken"))
+        with self._token_lock:
+            self.access_token = access_token
+            self.access_token_valid_until = access_valid_until
+            self.refresh_token = refresh_token
+            self.refresh_token_valid_until = refresh_valid_until
+
+    def _store_refreshed_token(self, resp: dict) -> None:
+        """Zapisz nowy accessToken z /auth/token/refresh (refreshToken bez zmian)."""
+        access_token, access_valid_until = self._token_parts(resp.get("accessToken"))
+        if not access_token:
+            raise KSeFError("Brak accessToken w odpowiedzi refresh", response_data=resp)
+        with self._token_lock:
+            self.access_token = access_token
+            self.access_token_valid_until = access_valid_until
+
+    def _clear_tokens(self) -> None:
+        with self._token_lock:
+            self.access_token = None
+            self.authentication_token = None
+            self.refresh_token = None
+            self.reference_number = None
+            self.access_token_valid_until = None
+            self.refresh_token_valid_until = None
+
+    @staticmethod
+    def _valid_for(valid_until: Optional[datetime.datetime], margin_s: float) -> bool:
+        if valid_until is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return valid_until - now > datetime.timedelta(seconds=margin_s)
+
+    def export_session(self) -> dict:
+        """Stan sesji do zapisania w cache (tokeny i ich ważność)."""
+        with self._token_lock:
+            return {
+                "nip": self.nip,
+                "environment": self.environment,
+                "access_token": self.access_token,
+                "access_token_valid_until": (
+                    self.access_token_valid_until.isoformat() if self.access_token_valid_until else None
+                ),
+                "refresh_token": self.refresh_token,
+                "refresh_token_valid_until": (
+                    self.refresh_token_valid_until.isoformat() if self.refresh_token_valid_until else None
+                ),
+            }
+
+    def restore_session(self, data: dict) -> bool:
+        """Przywróć tokeny z cache; False gdy cache dotyczy innego NIP/środowiska."""
+        if not data or data.get("nip") != self.nip or data.get("environment") != self.environment:
+            return False
+        with self._token_lock:
+            self.access_token = data.get("access_token")
+            self.access_token_valid_until = _parse_ksef_datetime(data.get("access_token_valid_until"))
+            self.refresh_token = data.get("refresh_token")
+            self.refresh_token_valid_until = _parse_ksef_datetime(data.get("refresh_token_valid_until"))
+        return True
+
+    def _reusable_session(self, margin_s: float = SESSION_REFRESH_MARGIN_S) -> Optional[str]:
+        """'access' — accessToken ważny, 'refresh' — do odnowienia, None — pełne uwierzytelnienie."""
+        with self._token_lock:
+            if self.access_token and self._valid_for(self.access_token_valid_until, margin_s):
+                return "access"
+            if self.refresh_token and self._valid_for(self.refresh_token_valid_until, margin_s):
+                return "refresh"
+        return None
+
+    @staticmethod
+    def _auth_status_code(resp: dict):
+        status = resp.get("status", {})
+        return status.get("code") or resp.get("processingCode")
+
+    def _check_auth_status(self, resp: dict) -> bool:
+        """True — autoryzacja zakończona, False — w toku; KSeFError przy odmowie."""
+        code = self._auth_status_code(resp)
+        if code == 200:
+            return True
+        if code == 100:
+            return False
+        desc = resp.get("status", {}).get("description", "Nieznany błąd")
+        raise KSeFError(f"Blad autoryzacji: kod {code} - {desc}", response_data=resp)
+
+    # ------------------------------------------------------------------
+    # Payloady
+    # ------------------------------------------------------------------
+
+    def _challenge_payload(self) -> dict:
+        return {
+            "contextIdentifier": {
+                "type": "onip",
+                "identifier": self.nip,
+            }
+        }
+
+    @staticmethod
+    def _query_datetime(value, end: bool) -> datetime.datetime:
+        """Data lub data/czas zakresu zapytania jako datetime w UTC.
+
+        Sama data oznacza cały dzień (00:00:00 dla początku, 23:59:59 dla końca),
+        datetime bez strefy traktowany jest jako UTC.
+        """
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                return value.replace(tzinfo=datetime.timezone.utc)
+            return value.astimezone(datetime.timezone.utc)
+        day_time = datetime.time(23, 59, 59) if end else datetime.time(0, 0, 0)
+        return datetime.datetime.combine(value, day_time, tzinfo=datetime.timezone.utc)
+
+    def _query_payload(
+        self,
+        subject_type: str,
+        date_from,
+        date_to,
+        date_type: str,
+        page_size: int,
+        page_offset: int,
+        sort_order: str = None,
+    ) -> tuple:
+        """Zwraca (query string, body JSON) dla /invoices/query/metadata.
+
+        ``date_from``/``date_to`` to ``datetime.date`` (całe dni) lub
+        ``datetime.datetime`` (dokładny moment, np. punkt kontrolny synchronizacji).
+        """
+        if date_to is None:
+            date_to = datetime.date.today()
+        if date_from is None:
+            date_from = date_to - datetime.timedelta(days=30)
+
+        precise = isinstance(date_from, datetime.datetime) or isinstance(date_to, datetime.datetime)
+        range_from = self._query_datetime(date_from, end=False)
+        range_to = self._query_datetime(date_to, end=True)
+
+        # KSeF limit: max 90 dni (dla samych dat — 90 pełnych dni różnicy)
+        max_range = datetime.timedelta(days=90)
+        range_start = range_from if precise else range_from.replace(hour=23, minute=59, second=59)
+        if (range_to - range_start) > max_range:
+            self.logger.warning("Zakres dat przekracza 90 dni — ograniczam")
+            range_from = range_to - max_range
+            if not precise:
+                range_from = range_from.replace(hour=0, minute=0, second=0)
+
+        fmt = {"timespec": "milliseconds" if precise else "seconds"}
+
+        data = {
+            "subjectType": subject_type,
+            "dateRange": {
+                "dateType": date_type,
+                "from": range_from.isoformat(**fmt),
+                "to": range_to.isoformat(**fmt),
+            },
+        }
+
+        qs = f"?pageSize={min(page_size, 250)}&pageOffset={page_offset}"
+        if sort_order:
+            qs += f"&sortOrder={sort_order}"
+        return qs, data
+
+    def _export_payload(self, subject_type: str, date_from, date_to, date_type: str, public_key,
+                        key: bytes, iv: bytes) -> dict:
+        """Body dla POST /invoices/exports — filtry jak w zapytaniu, klucz AES zaszyfrowany RSA-OAEP."""
+        _, filters = self._query_payload(subject_type, date_from, date_to, date_type, 10, 0)
+        encrypted_key = public_key.encrypt(
+            key,
+            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
+        )
+        return {
+            "encryption": {
+                "encryptedSymmetricKey": base64.b64encode(encrypted_key).decode("ascii"),
+                "initializationVector": base64.b64encode(iv).decode("ascii"),
+            },
+            "filters": filters,
+        }
+
+    # ------------------------------------------------------------------
+    # Auth: Token KSeF — kryptografia
+    # ------------------------------------------------------------------
+
+    def _ksef_token_payload(self, challenge_resp: dict, ksef_token: str, public_key) -> dict:
+        """Zaszyfruj token (RSA-OAEP SHA-256) i zbuduj body dla /auth/ksef-token."""
+        challenge = challenge_resp.get("challenge")
+        timestamp_ms = challenge_resp.get("timestampMs")
+
+        if not challenge or timestamp_ms is None:
+            raise KSeFError("Brak challenge/timestamp z KSeF", response_data=challenge_resp)
+
+        # Szyfrowanie: {token}|{timestampMs} -> RSA-OAEP SHA-256 -> Base64
+        plaintext = f"{ksef_token}|{timestamp_ms}".encode("utf-8")
+        encrypted = public_key.encrypt(
+            plaintext,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None,
+            ),
+        )
+        encrypted_b64 = base64.b64encode(encrypted).decode("utf-8")
+
+        return {
+            "challenge": challenge,
+            "contextIdentifier": {"type": "Nip", "value": self.nip},
+            "encryptedToken": encrypted_b64,
+        }
+
+    def _on_token_auth_rejected(self, exc: KSeFError) -> None:
+        """Odrzucony token: klucz z cache mógł zostać wymieniony — następnym razem pobierz świeży."""
+        if 400 <= exc.status_code < 500:
+            self.public_key_cache.invalidate(self.environment)
+
+    @staticmethod
+    def _public_key_from_certificates(resp):
+        """Wybierz klucz publiczny KsefTokenEncryption z listy certyfikatów KSeF."""
+        return _token_encryption_certificate(resp).public_key()
+
+    # ------------------------------------------------------------------
+    # Auth: Certyfikat X.509 (XAdES-BES) — kryptografia
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _require_lxml() -> None:
+        if etree is None:
+            raise KSeFError(
+                "Brak biblioteki lxml — wymagana do podpisu XAdES. "
+                "Zainstaluj: pip install lxml>=4.9"
+            )
+
+    def _signed_auth_request(self, challenge_resp: dict, certificate: x509.Certificate, private_key) -> str:
+        """Zbuduj i podpisz AuthTokenRequest dla /auth/xades-signature."""
+        challenge = challenge_resp.get("challenge")
+        timestamp = challenge_resp.get("timestamp")
+
+        if not challenge:
+            raise KSeFError("Brak challenge z KSeF", response_data=challenge_resp)
+
+        # Buduj i podpisz XML
+        xml_content = self._build_auth_token_request_xml(challenge, timestamp)
+        return self._sign_xml_xades(xml_content, certificate, private_key)
+
+    def _load_certificate(self, cert_path: str) -> x509.Certificate:
+        path = Path(cert_path)
+        if not path.exists():
+            raise KSeFError(f"Certyfikat nie znaleziony: {cert_path}")
+
+        data = path.read_bytes()
+        try:
+            return x509.load_pem_x509_certificate(data, default_backend())
+        except ValueError:
+            return x509.load_der_x509_certificate(data, default_backend())
+
+    def _load_private_key(self, key_path: str, password: str = None):
+        path = Path(key_path)
+        if not path.exists():
+            raise KSeFError(f"Klucz prywatny nie znaleziony: {key_path}")
+
+        data = path.read_bytes()
+        pwd = password.encode("utf-8") if password else None
+
+        try:
+            return serialization.load_pem_private_key(data, password=pwd, backend=default_backend())
+        except TypeError:
+            # Klucz zaszyfrowany, hasło nie podane — pytaj interaktywnie
+            if pwd is None:
+                import getpass
+                try:
+                    pwd_input = getpass.getpass("Haslo klucza prywatnego: ")
+                    return serialization.load_pem_private_key(
+                        data, password=pwd_input.encode("utf-8"), backend=default_backend()
+                    )
+                except (ValueError, TypeError) as exc2:
+                    raise KSeFError(f"Bledne haslo klucza prywatnego: {exc2}")
+            raise KSeFError("Klucz prywatny jest zaszyfrowany - podaj haslo (--password, --password-enc lub --password-file)")
+        except (ValueError, TypeError) as exc:
+            raise KSeFError(f"Blad ladowania klucza prywatnego: {exc}")
+
+    def _build_auth_token_request_xml(self, challenge: str, timestamp: str = None) -> str:
+        root = etree.Element("AuthTokenRequest", nsmap={None: AUTH_TOKEN_NS})
+
+        ch = etree.SubElement(root, "Challenge")
+        ch.text = challenge
+
+        ctx = etree.SubElement(root, "ContextIdentifier")
+        nip_el = etree.SubElement(ctx, "Nip")
+        nip_el.text = self.nip
+
+        sub = etree.SubElement(root, "SubjectIdentifierType")
+        sub.text = "certificateSubject"
+
+        return '<?xml version="1.0" encoding="utf-8"?>' + etree.tostring(root, encoding="unicode")
+
+    def _sign_xml_xades(
         self,
         xml_content: str,
         certificate: x509.Certificate,
@@ -538,90 +1697,1063 @@ class KSeFClient:
         component_size = (key_size + 7) // 8
         return r.to_bytes(component_size, "big") + s.to_bytes(component_size, "big")
 
-    # ------------------------------------------------------------------
-    # Operacje na fakturach
-    # ------------------------------------------------------------------
 
-    def query_invoices(
-        self,
-        subject_type: str = "Subject2",
-        date_from: datetime.date = None,
-        date_to: datetime.date = None,
-        date_type: str = "Invoicing",
+# ---------------------------------------------------------------------------
+# Klient KSeF
+# ---------------------------------------------------------------------------
+
+class KSeFClient(_KSeFClientBase):
+    """Klient systemu KSeF obsługujący token i certyfikat."""
+
+    def __init__(
+        self,
+        nip: str,
+        environment: str = "prod",
+        timeout: int = REQUEST_TIMEOUT_S,
+        logger: logging.Logger = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        auth_poller: AuthPoller = None,
+        public_key_cache: PublicKeyCache = None,
+        session: requests.Session = None,
+        metrics: Metrics = None,
+    ):
+        super().__init__(nip, environment, timeout, logger, rate_limiter, retry_policy, auth_poller,
+                         public_key_cache, metrics)
+
+        # Sesja HTTP może być współdzielona przez wielu klientów (ksef_sync.py) —
+        # wtedy zamyka ją właściciel, nie klient
+        self._owns_session = session is None
+        self._session = session if session is not None else new_http_session(pool_size)
+
+        # Cache sesji (SessionCache) i pełne ponowne uwierzytelnienie — używane
+        # przy wznowieniu sesji i po HTTP 401 w trakcie przebiegu
+        self.session_cache = None
+        self.reauthenticate = None
+        self._renew_lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        """Zamknij pulę połączeń (jeśli nie jest współdzielona)."""
+        if self._owns_session:
+            self._session.close()
+
+    # ------------------------------------------------------------------
+    # Żądania HTTP
+    # ------------------------------------------------------------------
+
+    def _request(
+        self,
+        method: str,
+        endpoint: str,
+        json_data: dict = None,
+        xml_data: str = None,
+        with_auth: bool = True,
+        idempotent: bool = None,
+        bearer: str = None,
+        with_headers: bool = False,
+    ):
+        """Żądanie JSON/XML do API KSeF; z ``with_headers`` zwraca (dane, nagłówki)."""
+        url = f"{self.base_url}{endpoint}"
+        content_type = "application/xml; charset=utf-8" if xml_data else "application/json"
+        headers = self._auth_headers(content_type, with_auth, bearer)
+
+        self.logger.debug("KSeF %s %s", method, url)
+
+        if method == "POST":
+            if xml_data:
+                kwargs = {"data": xml_data.encode("utf-8")}
+            else:
+                kwargs = {"json": json_data}
+        elif method in ("GET", "DELETE"):
+            kwargs = {}
+        else:
+            raise ValueError(f"Nieobslugiwana metoda HTTP: {method}")
+
+        try:
+            resp = self._send(method, url, endpoint, idempotent, headers=headers, **kwargs)
+        except requests.RequestException as exc:
+            raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+
+        if resp.status_code >= 400:
+            try:
+                data = resp.json()
+            except ValueError:
+                data = {"raw": resp.text[:500]}
+            raise _api_error(resp.status_code, data)
+
+        if not resp.text:
+            data = {}
+        elif "application/json" in resp.headers.get("Content-Type", ""):
+            data = resp.json()
+        else:
+            data = {"raw_content": resp.text}
+        return (data, resp.headers) if with_headers else data
+
+    def _send(self, method: str, url: str, endpoint: str, idempotent: bool = None, **kwargs) -> requests.Response:
+        """Wyślij żądanie w ramach limitu, z obsługą HTTP 429 i ponawianiem błędów przejściowych."""
+        bucket = _endpoint_bucket(endpoint)
+        if idempotent is None:
+            idempotent = method in ("GET", "DELETE")
+        throttled = 0
+        attempt = 0
+        renewed = False
+        while True:
+            self.rate_limiter.acquire(bucket)
+            started = time.monotonic()
+            try:
+                with self._trace_span("http", method, url, endpoint, kwargs.get("headers"), attempt) as span:
+                    resp = self._session.request(method, url, timeout=self.timeout, **kwargs)
+                    if span is not None:
+                        # elapsed = do nagłówków odpowiedzi (z nawiązaniem połączenia)
+                        self._trace_response(span, resp, None if kwargs.get("stream") else len(resp.content),
+                                             resp.elapsed.total_seconds())
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as exc:
+                # ChunkedEncodingError: połączenie zerwane w trakcie treści (bez stream=True czytanej tutaj)
+                self._observe_response(endpoint, "error", started)
+                delay = self._retry_delay(attempt, idempotent, type(exc).__name__, endpoint)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._observe_response(endpoint, resp.status_code, started)
+
+            # accessToken wygasł lub unieważniony (np. z cache) — odnów raz i ponów
+            if resp.status_code == 401 and not renewed:
+                headers = kwargs.get("headers") or {}
+                used_token = headers.get("Authorization", "")[len("Bearer "):]
+                # Porównanie z bieżącym tokenem pod blokadą — w _renew_session
+                new_token = self._renew_session(used_token) if used_token else None
+                if new_token:
+                    renewed = True
+                    resp.close()
+                    headers["Authorization"] = f"Bearer {new_token}"
+                    continue
+
+            if resp.status_code == 429 and throttled < MAX_THROTTLE_RETRIES:
+                throttled += 1
+                self._on_throttled(bucket, resp.headers)
+                resp.close()
+                continue
+
+            if resp.status_code in self.retry_policy.status_codes:
+                delay = self._retry_delay(attempt, idempotent, f"HTTP {resp.status_code}", endpoint, resp.headers)
+                if delay is not None:
+                    resp.close()
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+
+            return resp
+
+    # ------------------------------------------------------------------
+    # Challenge (wspólny dla obu metod)
+    # ------------------------------------------------------------------
+
+    def _get_challenge(self) -> dict:
+        return self._request(
+            "POST",
+            "/auth/challenge",
+            json_data=self._challenge_payload(),
+            with_auth=False,
+        )
+
+    # ------------------------------------------------------------------
+    # Polling + redeem (wspólne)
+    # ------------------------------------------------------------------
+
+    def _poll_auth_status(self) -> None:
+        error = poll_auth_statuses([self], self.auth_poller)[self]
+        if error is not None:
+            raise error
+
+    def _redeem_token(self) -> None:
+        resp = self._request("POST", "/auth/token/redeem")
+        self._store_redeemed_tokens(resp)
+
+    def finish_authentication(self) -> None:
+        """Wymień authenticationToken na accessToken po zakończonej autoryzacji.
+
+        Dla uwierzytelnień rozpoczętych przez ``start_*_authentication``
+        i odpytanych wspólnie przez ``poll_auth_statuses``.
+        """
+        self._redeem_token()
+        self.logger.info("Uwierzytelnianie zakończone — accessToken uzyskany")
+
+    # ------------------------------------------------------------------
+    # Odnawianie sesji
+    # ------------------------------------------------------------------
+
+    def refresh_access_token(self) -> None:
+        """Odnów accessToken refresh tokenem (POST /auth/token/refresh)."""
+        with self._token_lock:
+            refresh_token = self.refresh_token
+        if not refresh_token:
+            raise KSeFError("Brak refresh tokenu - najpierw uwierzytelnij sie")
+        resp = self._request("POST", "/auth/token/refresh", bearer=refresh_token)
+        self._store_refreshed_token(resp)
+        self.logger.info("accessToken odnowiony refresh tokenem")
+
+    def _save_session(self) -> None:
+        if self.session_cache is not None:
+            self.session_cache.save(self.export_session())
+
+    def resume_session(self) -> bool:
+        """Wznów sesję: ważny accessToken lub odnowienie refresh tokenem.
+
+        Tokeny z pamięci (klient używany ponownie, np. ksef_sync.py --serve),
+        a gdy ich brak — z cache sesji.
+
+        Returns:
+            False gdy potrzebne jest pełne uwierzytelnienie
+        """
+        with self._token_lock:
+            in_memory = bool(self.access_token or self.refresh_token)
+        if not in_memory and (self.session_cache is None or not self.restore_session(self.session_cache.load())):
+            return False
+
+        state = self._reusable_session()
+        if state == "access":
+            self.logger.info("Sesja KSeF z cache (accessToken ważny do %s)",
+                             self.access_token_valid_until.isoformat(timespec="seconds"))
+            return True
+        if state == "refresh":
+            try:
+                self.refresh_access_token()
+            except KSeFError as exc:
+                self.logger.info("Odnowienie sesji z cache nieudane: %s", exc)
+            else:
+                self._save_session()
+                return True
+
+        self._clear_tokens()
+        return False
+
+    def _current_access_token(self) -> Optional[str]:
+        with self._token_lock:
+            return self.access_token
+
+    def _renew_session(self, failed_token: str) -> Optional[str]:
+        """Odnów sesję po HTTP 401: refresh token, a gdy to nie wystarczy — pełne uwierzytelnienie.
+
+        Porównanie ``failed_token`` z bieżącym accessTokenem odbywa się pod
+        ``_renew_lock`` (odczyt tokenów pod ``_token_lock``), więc wątki, które
+        dostały 401 na tym samym tokenie, odnawiają sesję dokładnie raz.
+
+        Returns:
+            accessToken do ponowienia żądania albo None (401 nie dotyczył
+            accessTokenu lub odnowienie się nie powiodło)
+        """
+        with self._renew_lock:
+            with self._token_lock:
+                access_token = self.access_token
+                refresh_token = self.refresh_token
+                foreign = failed_token in (self.refresh_token, self.authentication_token)
+            if failed_token != access_token:
+                # Inny wątek już odnowił sesję — albo 401 dla tokenu innego niż accessToken
+                return None if foreign else access_token
+
+            self.logger.warning("KSeF HTTP 401 — odnawianie sesji")
+            if refresh_token:
+                try:
+                    self.refresh_access_token()
+                    self._save_session()
+                    return self._current_access_token()
+                except KSeFError as exc:
+                    self.logger.info("Odnowienie refresh tokenem nieudane: %s", exc)
+
+            if self.reauthenticate is None:
+                return None
+            self._clear_tokens()
+            try:
+                self.reauthenticate()
+            except KSeFError as exc:
+                self.logger.error("Ponowne uwierzytelnienie nieudane: %s", exc)
+                return None
+            self._save_session()
+            return self._current_access_token()
+
+    # ------------------------------------------------------------------
+    # Auth: Token KSeF
+    # ------------------------------------------------------------------
+
+    def authenticate_token(self, ksef_token: str) -> None:
+        """Uwierzytelnianie tokenem KSeF (RSA-OAEP SHA-256)."""
+        with self.metrics.timed("ksef_auth_duration_seconds", method="token"):
+            self.start_token_authentication(ksef_token)
+            self._poll_auth_status()
+            self._redeem_token()
+        self.logger.info("Uwierzytelnianie tokenem zakończone — accessToken uzyskany")
+
+    def start_token_authentication(self, ksef_token: str) -> None:
+        """Wyślij zaszyfrowany token (bez oczekiwania na status autoryzacji)."""
+        self.logger.info("Uwierzytelnianie tokenem KSeF dla NIP %s...", self.nip)
+
+        challenge_resp = self._get_challenge()
+
+        # Pobierz klucz publiczny KSeF do szyfrowania tokenu
+        public_key = self._fetch_token_encryption_key()
+
+        # Wysłanie
+        try:
+            resp = self._request(
+                "POST",
+                "/auth/ksef-token",
+                json_data=self._ksef_token_payload(challenge_resp, ksef_token, public_key),
+                with_auth=False,
+            )
+        except KSeFError as exc:
+            self._on_token_auth_rejected(exc)
+            raise
+        self._store_auth_init(resp)
+
+    def _fetch_token_encryption_key(self):
+        """Klucz publiczny KSeF do szyfrowania tokenów (z cache, gdy ważny)."""
+        public_key, stale = self.public_key_cache.lookup(self.environment)
+        if public_key is None:
+            resp = self._request("GET", "/security/public-key-certificates", with_auth=False)
+            return self.public_key_cache.store(self.environment, resp)
+        if stale:
+            self.public_key_cache.refresh_in_background(
+                self.environment,
+                lambda: self._request("GET", "/security/public-key-certificates", with_auth=False),
+                self.logger,
+            )
+        return public_key
+
+    # ------------------------------------------------------------------
+    # Auth: Certyfikat X.509 (XAdES-BES)
+    # ------------------------------------------------------------------
+
+    def authenticate_certificate(
+        self,
+        cert_path: str,
+        key_path: str,
+        key_password: str = None,
+    ) -> None:
+        """Uwierzytelnianie certyfikatem X.509 z podpisem XAdES-BES."""
+        with self.metrics.timed("ksef_auth_duration_seconds", method="cert"):
+            self.start_certificate_authentication(cert_path, key_path, key_password)
+            self._poll_auth_status()
+            self._redeem_token()
+        self.logger.info("Uwierzytelnianie certyfikatem zakończone — accessToken uzyskany")
+
+    def start_certificate_authentication(
+        self,
+        cert_path: str,
+        key_path: str,
+        key_password: str = None,
+    ) -> None:
+        """Wyślij podpisany XAdES (bez oczekiwania na status autoryzacji)."""
+        self._require_lxml()
+
+        self.logger.info("Uwierzytelnianie certyfikatem dla NIP %s...", self.nip)
+
+        # Wczytaj certyfikat i klucz prywatny
+        certificate = self._load_certificate(cert_path)
+        private_key = self._load_private_key(key_path, key_password)
+
+        # Challenge + podpisany XML
+        challenge_resp = self._get_challenge()
+        signed_xml = self._signed_auth_request(challenge_resp, certificate, private_key)
+
+        # Wyślij podpisany XML
+        resp = self._request(
+            "POST",
+            "/auth/xades-signature",
+            xml_data=signed_xml,
+            with_auth=False,
+        )
+        self._store_auth_init(resp)
+
+    # ------------------------------------------------------------------
+    # Operacje na fakturach
+    # ------------------------------------------------------------------
+
+    def query_invoices(
+        self,
+        subject_type: str = "Subject2",
+        date_from: datetime.date = None,
+        date_to: datetime.date = None,
+        date_type: str = "Invoicing",
         page_size: int = 100,
         page_offset: int = 0,
+        sort_order: str = None,
     ) -> dict:
         """Wyszukiwanie faktur w KSeF.
 
         Args:
             subject_type: 'Subject1' (wystawione), 'Subject2' (otrzymane)
-            date_from: Data od (domyślnie: 30 dni wstecz)
-            date_to: Data do (domyślnie: dziś)
+            date_from: Data od (domyślnie: 30 dni wstecz); datetime = dokładny moment
+            date_to: Data do (domyślnie: dziś); datetime = dokładny moment
             date_type: 'Invoicing', 'Issue' lub 'PermanentStorage'
             page_size: Wyników na stronę (max 250)
             page_offset: Offset strony
+            sort_order: 'Asc' lub 'Desc' (domyślnie: kolejność KSeF)
         """
-        if not self.access_token:
-            raise KSeFError("Brak aktywnej sesji - najpierw uwierzytelnij sie")
+        self._require_access_token()
+        qs, data = self._query_payload(
+            subject_type, date_from, date_to, date_type, page_size, page_offset, sort_order
+        )
+        # Zapytanie o metadane nie zmienia stanu — bezpieczne do ponowienia
+        return self._request("POST", f"/invoices/query/metadata{qs}", json_data=data, idempotent=True)
 
-        if date_to is None:
-            date_to = datetime.date.today()
-        if date_from is None:
-            date_from = date_to - datetime.timedelta(days=30)
+    def download_invoice_xml(self, ksef_number: str) -> bytes:
+        """Pobierz XML faktury z KSeF.
 
-        # KSeF limit: max 90 dni
-        max_range = datetime.timedelta(days=90)
-        if (date_to - date_from) > max_range:
-            self.logger.warning("Zakres dat przekracza 90 dni — ograniczam")
-            date_from = date_to - max_range
+        Args:
+            ksef_number: Numer KSeF faktury
 
-        data = {
-            "subjectType": subject_type,
-            "dateRange": {
-                "dateType": date_type,
-                "from": f"{date_from.isoformat()}T00:00:00+00:00",
-                "to": f"{date_to.isoformat()}T23:59:59+00:00",
-            },
+        Returns:
+            Surowe bajty XML (zachowuje oryginalne kodowanie dla hash QR)
+        """
+        access_token = self._require_access_token()
+
+        url = f"{self.base_url}/invoices/ksef/{ksef_number}"
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/octet-stream",
         }
 
-        qs = f"?pageSize={min(page_size, 250)}&pageOffset={page_offset}"
-        return self._request("POST", f"/invoices/query/metadata{qs}", json_data=data)
+        try:
+            resp = self._send("GET", url, f"/invoices/ksef/{ksef_number}", headers=headers)
+        except requests.RequestException as exc:
+            raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+        if resp.status_code >= 400:
+            raise KSeFError(f"Blad pobierania faktury: HTTP {resp.status_code}", resp.status_code)
+
+        return resp.content
+
+    def download_invoice_xml_to(self, ksef_number: str, xml_path, expected_sha256: str = None,
+                                keep_content: bool = False) -> tuple:
+        """Pobierz XML faktury strumieniowo do pliku (stała pamięć, zapis atomowy).
+
+        Treść trafia do pliku tymczasowego w katalogu docelowym, SHA-256 i
+        rozmiar liczone są w locie. Po sprawdzeniu skrótu (``expected_sha256``,
+        hex — np. ``invoiceHash`` z metadanych) plik jest przemianowywany na
+        ``xml_path``. Zerwane połączenie w trakcie treści jest ponawiane
+        według RetryPolicy. ``keep_content`` zachowuje też treść w pamięci
+        (np. dla generatora PDF — bez ponownego odczytu pliku).
+
+        Returns:
+            (sha256 hex, rozmiar w bajtach) zapisanego pliku; z ``keep_content``
+            (sha256 hex, rozmiar, treść)
+        """
+        endpoint = f"/invoices/ksef/{ksef_number}"
+        url = f"{self.base_url}{endpoint}"
+        with self._trace_span("download", "GET", url, endpoint) as span:
+            attempt = 0
+            while True:
+                headers = {
+                    "Authorization": f"Bearer {self._require_access_token()}",
+                    "Accept": "application/octet-stream",
+                }
+                try:
+                    resp = self._send("GET", url, endpoint, headers=headers, stream=True)
+                except requests.RequestException as exc:
+                    raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+                with resp:
+                    if resp.status_code >= 400:
+                        raise KSeFError(f"Blad pobierania faktury: HTTP {resp.status_code}", resp.status_code)
+                    try:
+                        with AtomicFileWriter(xml_path, keep_content) as out:
+                            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                out.write(chunk)
+                            sha256, size = out.commit(expected_sha256)
+                            if span is not None:
+                                span.update(status=resp.status_code, response_size=size, attempt=attempt)
+                            return (sha256, size, out.content) if keep_content else (sha256, size)
+                    except requests.RequestException as exc:
+                        delay = self._retry_delay(attempt, True, type(exc).__name__, endpoint)
+                        if delay is None:
+                            raise KSeFError(f"Przerwane pobieranie faktury: {exc}")
+                attempt += 1
+                time.sleep(delay)
+
+    # ------------------------------------------------------------------
+    # Eksport paczek faktur
+    # ------------------------------------------------------------------
+
+    def start_invoice_export(
+        self,
+        subject_type: str = "Subject2",
+        date_from: datetime.date = None,
+        date_to: datetime.date = None,
+        date_type: str = "Invoicing",
+    ) -> tuple:
+        """Zleć eksport paczki faktur z zakresu dat (POST /invoices/exports).
+
+        Paczka jest szyfrowana AES-256-CBC kluczem wygenerowanym tutaj;
+        KSeF dostaje go zaszyfrowanego certyfikatem SymmetricKeyEncryption.
+
+        Returns:
+            (referenceNumber, klucz AES, IV)
+        """
+        self._require_access_token()
+        key, iv = os.urandom(32), os.urandom(16)
+        certificates = self._request("GET", "/security/public-key-certificates", with_auth=False)
+        public_key = _token_encryption_certificate(certificates, "SymmetricKeyEncryption").public_key()
+        data = self._export_payload(subject_type, date_from, date_to, date_type, public_key, key, iv)
+        resp = self._request("POST", "/invoices/exports", json_data=data)
+        reference_number = resp.get("referenceNumber")
+        if not reference_number:
+            raise KSeFError("Brak referenceNumber w odpowiedzi eksportu", response_data=resp)
+        self.logger.info("Eksport faktur zlecony: %s", reference_number)
+        return reference_number, key, iv
+
+    def invoice_export_status(self, reference_number: str, with_headers: bool = False):
+        """Status eksportu (GET /invoices/exports/{referenceNumber})."""
+        return self._request("GET", f"/invoices/exports/{reference_number}", with_headers=with_headers)
+
+    def wait_for_invoice_export(self, reference_number: str, timeout: float = EXPORT_TIMEOUT_S) -> dict:
+        """Odpytuj status eksportu do zakończenia (kod 200); zwraca opis paczki (``package``).
+
+        Odstęp rośnie geometrycznie do EXPORT_POLL_MAX_INTERVAL_S, Retry-After
+        z odpowiedzi ma pierwszeństwo.
+        """
+        deadline = time.monotonic() + timeout
+        interval = EXPORT_POLL_INITIAL_S
+        while True:
+            resp, headers = self.invoice_export_status(reference_number, with_headers=True)
+            status = resp.get("status", {})
+            code = status.get("code")
+            if code == 200:
+                return resp.get("package") or {}
+            if code != 100:
+                raise KSeFError(f"Eksport {reference_number}: kod {code} - {status.get('description', '')}",
+                                response_data=resp)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise KSeFError(f"Eksport {reference_number}: przekroczono czas oczekiwania ({timeout:.0f} s)")
+            delay = _retry_after_seconds(headers.get("Retry-After"), interval)
+            time.sleep(min(delay, remaining))
+            interval = min(interval * 2, EXPORT_POLL_MAX_INTERVAL_S)
+
+    def download_export_part(self, reference_number: str, part: dict, path, key: bytes, iv: bytes) -> int:
+        """Pobierz część paczki eksportu, sprawdź skróty i odszyfruj ją strumieniowo do ``path``.
+
+        Adres części jest podpisany (bez tokenu KSeF). Zaszyfrowana treść
+        jest sprawdzana z ``encryptedPartHash``, odszyfrowana z ``partHash``;
+        plik powstaje atomowo. Zerwana transmisja ponawiana według RetryPolicy.
+
+        Returns:
+            Rozmiar odszyfrowanej części w bajtach
+        """
+        from cryptography.hazmat.primitives import padding as sym_padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        endpoint = f"/invoices/exports/{reference_number}/parts/{part.get('ordinalNumber')}"
+        url = part["url"]
+        expected_encrypted = _expected_sha256({"invoiceHash": part.get("encryptedPartHash")})
+        expected_plain = _expected_sha256({"invoiceHash": part.get("partHash")})
+        with self._trace_span("download", part.get("method", "GET"), url, endpoint) as span:
+            attempt = 0
+            while True:
+                try:
+                    resp = self._send(part.get("method", "GET"), url, endpoint, idempotent=True,
+                                      headers={"Accept": "application/octet-stream"}, stream=True)
+                except requests.RequestException as exc:
+                    raise KSeFError(f"Blad polaczenia przy pobieraniu czesci paczki: {exc}")
+                with resp:
+                    if resp.status_code >= 400:
+                        raise KSeFError(f"Blad pobierania czesci paczki: HTTP {resp.status_code}", resp.status_code)
+                    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+                    unpadder = sym_padding.PKCS7(128).unpadder()
+                    encrypted_hash = hashlib.sha256()
+                    try:
+                        with AtomicFileWriter(path) as out:
+                            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                encrypted_hash.update(chunk)
+                                out.write(unpadder.update(decryptor.update(chunk)))
+                            if expected_encrypted and encrypted_hash.hexdigest() != expected_encrypted:
+                                raise KSeFError(f"Niezgodny SHA-256 zaszyfrowanej czesci {part.get('ordinalNumber')}"
+                                                f" eksportu {reference_number}")
+                            try:
+                                out.write(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+                            except ValueError as exc:
+                                raise KSeFError(f"Nie mozna odszyfrowac czesci paczki: {exc}")
+                            _, size = out.commit(expected_plain)
+                            if span is not None:
+                                span.update(status=resp.status_code, response_size=size, attempt=attempt)
+                            return size
+                    except requests.RequestException as exc:
+                        delay = self._retry_delay(attempt, True, type(exc).__name__, endpoint)
+                        if delay is None:
+                            raise KSeFError(f"Przerwane pobieranie czesci paczki: {exc}")
+                attempt += 1
+                time.sleep(delay)
+
+    def terminate_session(self) -> None:
+        """Zakończ sesję KSeF."""
+        if self.access_token:
+            try:
+                self._request("DELETE", "/auth/sessions/current")
+            except KSeFError as e:
+                self.logger.debug("Zamykanie sesji: %s", e)
+            self._clear_tokens()
+
+
+# ---------------------------------------------------------------------------
+# Klient KSeF — asyncio
+# ---------------------------------------------------------------------------
+
+class AsyncKSeFClient(_KSeFClientBase):
+    """Asynchroniczny klient KSeF (asyncio + httpx) o API zgodnym z KSeFClient.
+
+    Przeznaczony do obsługi wielu kontekstów NIP na jednej pętli zdarzeń.
+    Jedna instancja = jedna sesja KSeF; pobrania XML mogą biec równolegle
+    w ramach limitu ``max_connections``.
+
+    Przykład::
+
+        async with AsyncKSeFClient("1234567890") as client:
+            await client.authenticate_token(token)
+            result = await client.query_invoices()
+            xml = await client.download_invoice_xml(result["invoices"][0]["ksefNumber"])
+            await client.terminate_session()
+    """
+
+    # Czasy połączeń z rozszerzenia trace httpx, nie z kontekstu wątku
+    _TRACE_THREAD_TIMINGS = False
+
+    def __init__(
+        self,
+        nip: str,
+        environment: str = "prod",
+        timeout: int = REQUEST_TIMEOUT_S,
+        logger: logging.Logger = None,
+        max_connections: int = DEFAULT_POOL_SIZE,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        auth_poller: AuthPoller = None,
+        public_key_cache: PublicKeyCache = None,
+        metrics: Metrics = None,
+    ):
+        if httpx is None:
+            raise KSeFError(
+                "Brak biblioteki httpx — wymagana dla AsyncKSeFClient. "
+                "Zainstaluj: pip install httpx"
+            )
+        super().__init__(nip, environment, timeout, logger, rate_limiter, retry_policy, auth_poller,
+                         public_key_cache, metrics)
+
+        self._client = httpx.AsyncClient(
+            headers={"Accept": "application/json"},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        # Zadania w tle (odświeżanie certyfikatów KSeF) — referencje, by GC ich nie przerwał
+        self._background_tasks = set()
+
+        # Pełne ponowne uwierzytelnienie po HTTP 401 (korutyna, np.
+        # ``lambda: client.authenticate_token(token)``) — jak KSeFClient.reauthenticate
+        self.reauthenticate = None
+        self._renew_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+        return False
+
+    async def aclose(self) -> None:
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self._client.aclose()
+
+    # ------------------------------------------------------------------
+    # Żądania HTTP
+    # ------------------------------------------------------------------
+
+    async def _request(
+        self,
+        method: str,
+        endpoint: str,
+        json_data: dict = None,
+        xml_data: str = None,
+        with_auth: bool = True,
+        idempotent: bool = None,
+        bearer: str = None,
+        with_headers: bool = False,
+    ):
+        if method not in ("GET", "POST", "DELETE"):
+            raise ValueError(f"Nieobslugiwana metoda HTTP: {method}")
+
+        url = f"{self.base_url}{endpoint}"
+        content_type = "application/xml; charset=utf-8" if xml_data else "application/json"
+        headers = self._auth_headers(content_type, with_auth, bearer)
+
+        self.logger.debug("KSeF %s %s", method, url)
+
+        kwargs = {}
+        if method == "POST":
+            if xml_data:
+                kwargs["content"] = xml_data.encode("utf-8")
+            else:
+                kwargs["json"] = json_data
+
+        try:
+            resp = await self._send(method, url, endpoint, idempotent, headers=headers, **kwargs)
+        except httpx.HTTPError as exc:
+            raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+
+        if resp.status_code >= 400:
+            try:
+                data = resp.json()
+            except ValueError:
+                data = {"raw": resp.text[:500]}
+            raise _api_error(resp.status_code, data)
+
+        if not resp.text:
+            data = {}
+        elif "application/json" in resp.headers.get("Content-Type", ""):
+            data = resp.json()
+        else:
+            data = {"raw_content": resp.text}
+        return (data, resp.headers) if with_headers else data
+
+    async def _send(self, method: str, url: str, endpoint: str, idempotent: bool = None, stream: bool = False,
+                    **kwargs):
+        """Wyślij żądanie w ramach limitu, z obsługą HTTP 429 i ponawianiem błędów przejściowych."""
+        bucket = _endpoint_bucket(endpoint)
+        if idempotent is None:
+            idempotent = method in ("GET", "DELETE")
+        throttled = 0
+        attempt = 0
+        renewed = False
+        while True:
+            wait = self.rate_limiter.reserve(bucket)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            started = time.monotonic()
+            try:
+                with self._trace_span("http", method, url, endpoint, kwargs.get("headers"), attempt) as span:
+                    extensions = {"trace": _httpx_trace(span["timings"])} if span is not None else None
+                    if stream:
+                        # Treść czytana przez wywołującego (aiter_bytes); zamyka on odpowiedź
+                        request = self._client.build_request(method, url, extensions=extensions, **kwargs)
+                        resp = await self._client.send(request, stream=True)
+                    else:
+                        resp = await self._client.request(method, url, extensions=extensions, **kwargs)
+                    self._trace_response(span, resp, None if stream else len(resp.content))
+            except httpx.TransportError as exc:
+                self._observe_response(endpoint, "error", started)
+                delay = self._retry_delay(attempt, idempotent, type(exc).__name__, endpoint)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._observe_response(endpoint, resp.status_code, started)
+
+            # accessToken wygasł lub unieważniony — odnów raz i ponów
+            if resp.status_code == 401 and not renewed:
+                headers = kwargs.get("headers") or {}
+                used_token = headers.get("Authorization", "")[len("Bearer "):]
+                new_token = await self._renew_session(used_token) if used_token else None
+                if new_token:
+                    renewed = True
+                    await resp.aclose()
+                    headers["Authorization"] = f"Bearer {new_token}"
+                    continue
+
+            if resp.status_code == 429 and throttled < MAX_THROTTLE_RETRIES:
+                throttled += 1
+                self._on_throttled(bucket, resp.headers)
+                await resp.aclose()
+                continue
+
+            if resp.status_code in self.retry_policy.status_codes:
+                delay = self._retry_delay(attempt, idempotent, f"HTTP {resp.status_code}", endpoint, resp.headers)
+                if delay is not None:
+                    await resp.aclose()
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+
+            return resp
+
+    async def _renew_session(self, failed_token: str) -> Optional[str]:
+        """Odnów sesję po HTTP 401 (patrz KSeFClient._renew_session).
+
+        Zadania, które dostały 401 na tym samym accessTokenie, czekają na
+        ``_renew_lock`` — odnowienie wykonuje tylko pierwsze, pozostałe
+        ponawiają żądanie z nowym tokenem. 401 dla refresh tokenu lub tokenu
+        uwierzytelniania (żądania samego odnawiania) kończy się bez blokady —
+        ``asyncio.Lock`` nie jest reentrant.
+        """
+        with self._token_lock:
+            if failed_token in (self.refresh_token, self.authentication_token):
+                return None
+        async with self._renew_lock:
+            with self._token_lock:
+                access_token = self.access_token
+                refresh_token = self.refresh_token
+            if failed_token != access_token:
+                # Inne zadanie już odnowiło sesję
+                return access_token
+
+            self.logger.warning("KSeF HTTP 401 — odnawianie sesji")
+            if refresh_token:
+                try:
+                    await self.refresh_access_token()
+                    with self._token_lock:
+                        return self.access_token
+                except KSeFError as exc:
+                    self.logger.info("Odnowienie refresh tokenem nieudane: %s", exc)
+
+            if self.reauthenticate is None:
+                return None
+            self._clear_tokens()
+            try:
+                await self.reauthenticate()
+            except KSeFError as exc:
+                self.logger.error("Ponowne uwierzytelnienie nieudane: %s", exc)
+                return None
+            with self._token_lock:
+                return self.access_token
+
+    async def _get_challenge(self) -> dict:
+        return await self._request(
+            "POST",
+            "/auth/challenge",
+            json_data=self._challenge_payload(),
+            with_auth=False,
+        )
+
+    # ------------------------------------------------------------------
+    # Polling + redeem (wspólne)
+    # ------------------------------------------------------------------
+
+    async def _poll_auth_status(self) -> None:
+        """Harmonogram AuthPoller z asyncio.sleep — wiele klientów odpytuje się równolegle w pętli."""
+        poller = self.auth_poller
+        started = time.monotonic()
+        hint = None
+        for attempt, delay in enumerate(poller.schedule([self.environment]), start=1):
+            elapsed = time.monotonic() - started
+            if hint is not None:
+                delay = hint
+            delay = min(delay, poller.timeout_s - elapsed)
+            if delay < 0:
+                break
+            if delay:
+                await asyncio.sleep(delay)
+
+            resp, headers = await self._request("GET", f"/auth/{self.reference_number}", with_headers=True)
+            elapsed = time.monotonic() - started
+            if self._check_auth_status(resp):
+                self.logger.info("Autoryzacja zakończona pomyślnie")
+                # Zapis historii na dysk poza pętlą zdarzeń
+                await asyncio.to_thread(poller.record, self.environment, elapsed)
+                return
+            self.logger.info("Autoryzacja w toku (%d, %.1f s)...", attempt, elapsed)
+            retry_after = headers.get("Retry-After")
+            hint = _retry_after_seconds(retry_after, poller.initial_s) if retry_after else None
+
+        raise KSeFError("Timeout oczekiwania na autoryzacje")
+
+    async def _redeem_token(self) -> None:
+        resp = await self._request("POST", "/auth/token/redeem")
+        self._store_redeemed_tokens(resp)
+
+    async def refresh_access_token(self) -> None:
+        """Odnów accessToken refresh tokenem (patrz KSeFClient.refresh_access_token)."""
+        with self._token_lock:
+            refresh_token = self.refresh_token
+        if not refresh_token:
+            raise KSeFError("Brak refresh tokenu - najpierw uwierzytelnij sie")
+        resp = await self._request("POST", "/auth/token/refresh", bearer=refresh_token)
+        self._store_refreshed_token(resp)
+
+    # ------------------------------------------------------------------
+    # Auth
+    # ------------------------------------------------------------------
+
+    async def authenticate_token(self, ksef_token: str) -> None:
+        """Uwierzytelnianie tokenem KSeF (RSA-OAEP SHA-256)."""
+        with self.metrics.timed("ksef_auth_duration_seconds", method="token"):
+            self.logger.info("Uwierzytelnianie tokenem KSeF dla NIP %s...", self.nip)
+
+            challenge_resp = await self._get_challenge()
+            public_key = await self._fetch_token_encryption_key()
+
+            try:
+                resp = await self._request(
+                    "POST",
+                    "/auth/ksef-token",
+                    json_data=self._ksef_token_payload(challenge_resp, ksef_token, public_key),
+                    with_auth=False,
+                )
+            except KSeFError as exc:
+                await asyncio.to_thread(self._on_token_auth_rejected, exc)
+                raise
+            self._store_auth_init(resp)
+
+            await self._poll_auth_status()
+            await self._redeem_token()
+        self.logger.info("Uwierzytelnianie tokenem zakończone — accessToken uzyskany")
+
+    async def _fetch_token_encryption_key(self):
+        """Klucz publiczny KSeF do szyfrowania tokenów (z cache, gdy ważny)."""
+        public_key, stale = self.public_key_cache.lookup(self.environment)
+        if public_key is None:
+            resp = await self._request("GET", "/security/public-key-certificates", with_auth=False)
+            # PublicKeyCache zapisuje plik w state_dir — poza pętlą zdarzeń
+            return await asyncio.to_thread(self.public_key_cache.store, self.environment, resp)
+        if stale:
+            task = asyncio.get_running_loop().create_task(self._refresh_public_keys())
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        return public_key
+
+    async def _refresh_public_keys(self) -> None:
+        try:
+            resp = await self._request("GET", "/security/public-key-certificates", with_auth=False)
+            await asyncio.to_thread(self.public_key_cache.store, self.environment, resp)
+        except KSeFError as exc:
+            self.logger.debug("Odświeżanie certyfikatów KSeF: %s", exc)
+
+    async def authenticate_certificate(
+        self,
+        cert_path: str,
+        key_path: str,
+        key_password: str = None,
+    ) -> None:
+        """Uwierzytelnianie certyfikatem X.509 z podpisem XAdES-BES."""
+        with self.metrics.timed("ksef_auth_duration_seconds", method="cert"):
+            self._require_lxml()
+
+            self.logger.info("Uwierzytelnianie certyfikatem dla NIP %s...", self.nip)
+
+            certificate = self._load_certificate(cert_path)
+            private_key = self._load_private_key(key_path, key_password)
 
-    def download_invoice_xml(self, ksef_number: str) -> bytes:
-        """Pobierz XML faktury z KSeF.
+            challenge_resp = await self._get_challenge()
+            signed_xml = self._signed_auth_request(challenge_resp, certificate, private_key)
 
-        Args:
-            ksef_number: Numer KSeF faktury
+            resp = await self._request(
+                "POST",
+                "/auth/xades-signature",
+                xml_data=signed_xml,
+                with_auth=False,
+            )
+            self._store_auth_init(resp)
 
-        Returns:
-            Surowe bajty XML (zachowuje oryginalne kodowanie dla hash QR)
-        """
-        if not self.access_token:
-            raise KSeFError("Brak aktywnej sesji - najpierw uwierzytelnij sie")
+            await self._poll_auth_status()
+            await self._redeem_token()
+        self.logger.info("Uwierzytelnianie certyfikatem zakończone — accessToken uzyskany")
+
+    # ------------------------------------------------------------------
+    # Operacje na fakturach
+    # ------------------------------------------------------------------
+
+    async def query_invoices(
+        self,
+        subject_type: str = "Subject2",
+        date_from: datetime.date = None,
+        date_to: datetime.date = None,
+        date_type: str = "Invoicing",
+        page_size: int = 100,
+        page_offset: int = 0,
+        sort_order: str = None,
+    ) -> dict:
+        """Wyszukiwanie faktur w KSeF (patrz KSeFClient.query_invoices)."""
+        self._require_access_token()
+        qs, data = self._query_payload(
+            subject_type, date_from, date_to, date_type, page_size, page_offset, sort_order
+        )
+        return await self._request("POST", f"/invoices/query/metadata{qs}", json_data=data, idempotent=True)
+
+    async def download_invoice_xml(self, ksef_number: str) -> bytes:
+        """Pobierz XML faktury z KSeF (surowe bajty, jak KSeFClient.download_invoice_xml)."""
+        access_token = self._require_access_token()
 
         url = f"{self.base_url}/invoices/ksef/{ksef_number}"
         headers = {
-            "Authorization": f"Bearer {self.access_token}",
+            "Authorization": f"Bearer {access_token}",
             "Accept": "application/octet-stream",
         }
 
-        resp = self._session.get(url, headers=headers, timeout=self.timeout)
+        try:
+            resp = await self._send("GET", url, f"/invoices/ksef/{ksef_number}", headers=headers)
+        except httpx.HTTPError as exc:
+            raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
         if resp.status_code >= 400:
             raise KSeFError(f"Blad pobierania faktury: HTTP {resp.status_code}", resp.status_code)
 
         return resp.content
 
-    def terminate_session(self) -> None:
+    async def download_invoice_xml_to(self, ksef_number: str, xml_path, expected_sha256: str = None,
+                                      keep_content: bool = False) -> tuple:
+        """Pobierz XML faktury strumieniowo do pliku (jak KSeFClient.download_invoice_xml_to)."""
+        endpoint = f"/invoices/ksef/{ksef_number}"
+        url = f"{self.base_url}{endpoint}"
+        with self._trace_span("download", "GET", url, endpoint) as span:
+            attempt = 0
+            while True:
+                headers = {
+                    "Authorization": f"Bearer {self._require_access_token()}",
+                    "Accept": "application/octet-stream",
+                }
+                try:
+                    resp = await self._send("GET", url, endpoint, headers=headers, stream=True)
+                except httpx.HTTPError as exc:
+                    raise KSeFError(f"Blad polaczenia z KSeF: {exc}")
+                try:
+                    if resp.status_code >= 400:
+                        raise KSeFError(f"Blad pobierania faktury: HTTP {resp.status_code}", resp.status_code)
+                    try:
+                        with AtomicFileWriter(xml_path, keep_content) as out:
+                            async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                                out.write(chunk)
+                            sha256, size = out.commit(expected_sha256)
+                            if span is not None:
+                                span.update(status=resp.status_code, response_size=size, attempt=attempt)
+                            return (sha256, size, out.content) if keep_content else (sha256, size)
+                    except httpx.TransportError as exc:
+                        delay = self._retry_delay(attempt, True, type(exc).__name__, endpoint)
+                        if delay is None:
+                            raise KSeFError(f"Przerwane pobieranie faktury: {exc}")
+                finally:
+                    await resp.aclose()
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def download_invoices_xml(self, ksef_numbers: list, concurrency: int = DEFAULT_POOL_SIZE) -> list:
+        """Pobierz wiele faktur równolegle w ramach jednej sesji.
+
+        Returns:
+            Lista (ksef_number, bytes | KSeFError) w kolejności wejściowej.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def _one(ksef_number):
+            async with semaphore:
+                try:
+                    return ksef_number, await self.download_invoice_xml(ksef_number)
+                except KSeFError as exc:
+                    return ksef_number, exc
+
+        return list(await asyncio.gather(*(_one(nr) for nr in ksef_numbers)))
+
+    async def terminate_session(self) -> None:
         """Zakończ sesję KSeF."""
         if self.access_token:
             try:
-                self._request("DELETE", "/auth/sessions/current")
+                await self._request("DELETE", "/auth/sessions/current")
             except KSeFError as e:
                 self.logger.debug("Zamykanie sesji: %s", e)
-            self.access_token = None
-            self.authentication_token = None
-            self.refresh_token = None
-            self.reference_number = None
+            self._clear_tokens()
 
 
 # ---------------------------------------------------------------------------
@@ -667,6 +2799,47 @@ def decrypt_password(encrypted: str, key_path: str) -> str:
     return aesgcm.decrypt(nonce, ct, None).decode("utf-8")
 
 
+# ---------------------------------------------------------------------------
+# Cache sesji KSeF (zaszyfrowany AES-256-GCM)
+# ---------------------------------------------------------------------------
+
+class SessionCache:
+    """Tokeny sesji jednego NIP/środowiska zapisane na dysku między przebiegami.
+
+    Plik szyfrowany tym samym kluczem AES-256-GCM co token/hasło
+    (``encrypt_password``/``decrypt_password``). Nieczytelny lub zaszyfrowany
+    innym kluczem cache jest ignorowany — klient uwierzytelnia się od nowa.
+    """
+
+    def __init__(self, state_dir, nip: str, environment: str, key_path: str, logger: logging.Logger = None):
+        self.path = Path(state_dir) / f".ksef_session_{nip}_{environment}.enc"
+        self.key_path = key_path
+        self.logger = logger or logging.getLogger(__name__)
+
+    def load(self) -> Optional[dict]:
+        if not self.path.is_file():
+            return None
+        try:
+            return json.loads(decrypt_password(self.path.read_text(encoding="ascii").strip(), self.key_path))
+        except (OSError, ValueError, InvalidTag):
+            self.logger.warning("Cache sesji %s nieczytelny — pełne uwierzytelnienie", self.path.name)
+            return None
+
+    def save(self, data: dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="ascii") as f:
+            f.write(encrypt_password(json.dumps(data), self.key_path))
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
 # ---------------------------------------------------------------------------
 # Segregacja faktur do podfolderów ROK/MIESIAC
 # ---------------------------------------------------------------------------
@@ -714,6 +2887,363 @@ def _invoice_subdir(
     return f"{nip}/{today.year}/{today.month:02d}"
 
 
+# ---------------------------------------------------------------------------
+# Atomowy zapis pobieranych plików
+# ---------------------------------------------------------------------------
+
+def _expected_sha256(inv_meta: dict) -> Optional[str]:
+    """SHA-256 (hex) pliku faktury z metadanych KSeF (``invoiceHash``, base64), jeśli jest."""
+    value = inv_meta.get("invoiceHash") if inv_meta else None
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        digest = base64.b64decode(value, validate=True)
+    except ValueError:
+        return None
+    return digest.hex() if len(digest) == 32 else None
+
+
+class AtomicFileWriter:
+    """Zapis strumienia do pliku tymczasowego obok docelowego, z SHA-256 i rozmiarem liczonymi w locie.
+
+    ``commit()`` sprawdza skrót i zamienia plik tymczasowy na docelowy
+    (``os.replace``); wyjście z bloku ``with`` bez ``commit()`` usuwa plik
+    tymczasowy. Pod docelową nazwą nigdy nie pojawia się niepełny plik.
+    Z ``keep_content`` zapisana treść jest po ``commit()`` dostępna także
+    w ``content`` (faktury XML są małe — np. dla generatora PDF).
+    """
+
+    def __init__(self, path, keep_content: bool = False):
+        self.path = Path(path)
+        self.tmp_path = None
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.content = None
+        self._chunks = [] if keep_content else None
+        self._fh = None
+        self._committed = False
+
+    def __enter__(self):
+        # Unikalna nazwa — ten sam plik może zapisywać równolegle kilka wątków
+        # (np. faktura na granicy okien backfillu); uprawnienia wg umask jak dla write_bytes
+        self.tmp_path = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex[:12]}.part")
+        self._fh = open(self.tmp_path, "xb")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self._committed:
+            self._fh.close()
+            self.tmp_path.unlink(missing_ok=True)
+        return False
+
+    def write(self, chunk: bytes) -> None:
+        self._fh.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._chunks is not None:
+            self._chunks.append(chunk)
+
+    def commit(self, expected_sha256: str = None) -> tuple:
+        """Zamknij, sprawdź skrót i przenieś plik na miejsce docelowe.
+
+        Returns:
+            (sha256 hex, rozmiar w bajtach)
+
+        Raises:
+            KSeFError: skrót różny od ``expected_sha256`` (plik tymczasowy usuwany)
+        """
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        sha256 = self._hash.hexdigest()
+        if expected_sha256 and sha256 != expected_sha256.lower():
+            raise KSeFError(
+                f"Niezgodny SHA-256 pobranego pliku {self.path.name}: {sha256}, oczekiwano {expected_sha256}"
+            )
+        os.replace(self.tmp_path, self.path)
+        self._committed = True
+        if self._chunks is not None:
+            self.content = b"".join(self._chunks)
+            self._chunks = None
+        return sha256, self.size
+
+
+# ---------------------------------------------------------------------------
+# Indeks pobranych faktur (SQLite)
+# ---------------------------------------------------------------------------
+
+def _safe_file_name(ksef_nr: str) -> str:
+    """Nazwa pliku z numeru KSeF (bez znaków niedozwolonych w ścieżkach)."""
+    safe_name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', ksef_nr)
+    safe_name = safe_name.replace('..', '__')
+    if len(safe_name) > 200:
+        safe_name = safe_name[:200]
+    return safe_name
+
+
+def _parse_ksef_datetime(value) -> Optional[datetime.datetime]:
+    """Data/czas ISO 8601 z KSeF (np. permanentStorageDate) jako datetime w UTC.
+
+    Obsługuje sufiks ``Z`` i ułamki sekund o dowolnej długości; zwraca None
+    dla wartości pustych lub nieczytelnych.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    text = value.strip()
+    if text.endswith(("Z", "z")):
+        text = text[:-1] + "+00:00"
+    # fromisoformat przed 3.11 akceptuje tylko 3 lub 6 cyfr ułamka sekund
+    text = re.sub(r"\.(\d+)", lambda m: "." + (m.group(1) + "000000")[:6], text, count=1)
+    try:
+        parsed = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+class InvoiceIndex:
+    """Indeks pobranych faktur w pliku SQLite w katalogu docelowym.
+
+    Zastępuje sprawdzanie ``exists()`` dla każdej faktury i skanowanie
+    archiwum przez generator PDF — wyszukiwanie po numerze KSeF to jedno
+    zapytanie po kluczu głównym. Przechowuje podfolder, nazwę pliku,
+    SHA-256 i rozmiar XML, czas pobrania, status PDF oraz surowe metadane.
+
+    Zapisy nie są zatwierdzane automatycznie — wywołujący robi ``commit()``
+    po każdej stronie. Bezpieczny wątkowo (jedno połączenie + blokada).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS invoices (
+            ksef_number   TEXT PRIMARY KEY,
+            subdir        TEXT NOT NULL,
+            file_name     TEXT NOT NULL,
+            sha256        TEXT,
+            size          INTEGER,
+            downloaded_at TEXT,
+            pdf_status    TEXT,
+            metadata_json TEXT
+        );
+        CREATE INDEX IF NOT EXISTS invoices_pdf_status ON invoices (pdf_status);
+        CREATE TABLE IF NOT EXISTS sync_checkpoints (
+            nip           TEXT NOT NULL,
+            subject_type  TEXT NOT NULL,
+            checkpoint    TEXT NOT NULL,
+            updated_at    TEXT NOT NULL,
+            PRIMARY KEY (nip, subject_type)
+        );
+        CREATE TABLE IF NOT EXISTS backfill_windows (
+            nip           TEXT NOT NULL,
+            subject_type  TEXT NOT NULL,
+            date_type     TEXT NOT NULL,
+            date_from     TEXT NOT NULL,
+            date_to       TEXT NOT NULL,
+            status        TEXT NOT NULL,
+            page_offset   INTEGER NOT NULL DEFAULT 0,
+            updated_at    TEXT NOT NULL,
+            PRIMARY KEY (nip, subject_type, date_type, date_from, date_to)
+        );
+        CREATE TABLE IF NOT EXISTS index_state (
+            key           TEXT PRIMARY KEY,
+            value         TEXT NOT NULL
+        );
+    """
+
+    # index_state: jednorazowe dopisanie plików XML spoza indeksu (adopt_untracked)
+    UNTRACKED_SCAN_KEY = "untracked_scan_at"
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / INDEX_FILENAME
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    @classmethod
+    def open_existing(cls, output_dir) -> "Optional[InvoiceIndex]":
+        """Otwórz indeks tylko jeśli już istnieje w katalogu (bez tworzenia)."""
+        if not (Path(output_dir) / INDEX_FILENAME).is_file():
+            return None
+        return cls(output_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def commit(self) -> None:
+        with self._lock:
+            self._conn.commit()
+
+    def get(self, ksef_number: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM invoices WHERE ksef_number = ?", (ksef_number,)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def xml_path(self, entry: dict) -> Path:
+        return self.output_dir / entry["subdir"] / entry["file_name"]
+
+    def discard(self, ksef_number: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM invoices WHERE ksef_number = ?", (ksef_number,))
+
+    def record_download(
+        self,
+        ksef_number: str,
+        subdir: str,
+        file_name: str,
+        sha256: str,
+        size: int,
+        metadata: dict = None,
+        pdf_status: str = None,
+        downloaded_at: str = None,
+    ) -> None:
+        if downloaded_at is None:
+            downloaded_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO invoices "
+                "(ksef_number, subdir, file_name, sha256, size, downloaded_at, pdf_status, metadata_json) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    ksef_number, subdir, file_name, sha256, size, downloaded_at, pdf_status,
+                    json.dumps(metadata, ensure_ascii=False) if metadata is not None else None,
+                ),
+            )
+
+    def adopt_file(self, ksef_number: str, subdir: str, xml_path: Path, metadata: dict = None) -> None:
+        """Dodaj do indeksu XML pobrany wcześniej (archiwum sprzed indeksu)."""
+        data = xml_path.read_bytes()
+        stat = xml_path.stat()
+        pdf_status = "ok" if xml_path.with_suffix(".pdf").exists() else None
+        self.record_download(
+            ksef_number, subdir, xml_path.name,
+            hashlib.sha256(data).hexdigest(), len(data), metadata,
+            pdf_status=pdf_status,
+            downloaded_at=datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc).isoformat(timespec="seconds"),
+        )
+
+    def adopt_untracked(self, force: bool = False) -> int:
+        """Dopisz do indeksu pliki XML z katalogu, których indeks nie zna (raz na katalog).
+
+        Starsze archiwum, faktury spoza zakresu dat przebiegów z indeksem
+        i ręcznie skopiowane pliki trafiają do indeksu tylko wtedy, gdy
+        zapytanie o metadane zwróci je ponownie — bez tego generator PDF
+        czytający listę z indeksu by ich nie widział. Pełne skanowanie
+        katalogu tylko przy pierwszym wywołaniu (lub z ``force``);
+        kluczem jest nazwa pliku (numer KSeF), a gdy jest zajęta przez
+        inny plik — ścieżka względna. Pliki i katalogi ukryte są pomijane.
+
+        Returns:
+            liczba dopisanych plików
+        """
+        with self._lock:
+            done = self._conn.execute(
+                "SELECT value FROM index_state WHERE key = ?", (self.UNTRACKED_SCAN_KEY,)
+            ).fetchone()
+        if done is not None and not force:
+            return 0
+
+        known = {(e["subdir"], e["file_name"]) for e in self.entries()}
+        adopted = 0
+        for xml_path in sorted(self.output_dir.rglob("*.xml")):
+            relative = xml_path.relative_to(self.output_dir)
+            if any(part.startswith(".") for part in relative.parts):
+                continue
+            subdir = relative.parent.as_posix() if relative.parent != Path(".") else ""
+            if (subdir, xml_path.name) in known:
+                continue
+            key = xml_path.stem
+            if self.get(key) is not None:
+                key = relative.as_posix()
+            self.adopt_file(key, subdir, xml_path)
+            adopted += 1
+
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES (?, ?)",
+                               (self.UNTRACKED_SCAN_KEY, now))
+            self._conn.commit()
+        return adopted
+
+    def entries(self, pdf_pending_only: bool = False) -> list:
+        """Wpisy indeksu (opcjonalnie tylko bez wygenerowanego PDF)."""
+        query = "SELECT * FROM invoices"
+        if pdf_pending_only:
+            query += " WHERE pdf_status IS NULL OR pdf_status != 'ok'"
+        query += " ORDER BY subdir, file_name"
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(query).fetchall()]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def set_pdf_status(self, ksef_number: str, status: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE invoices SET pdf_status = ? WHERE ksef_number = ?", (status, ksef_number)
+            )
+
+    def get_checkpoint(self, nip: str, subject_type: str) -> Optional[datetime.datetime]:
+        """Punkt kontrolny synchronizacji przyrostowej (data PermanentStorage, UTC)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT checkpoint FROM sync_checkpoints WHERE nip = ? AND subject_type = ?",
+                (nip, subject_type),
+            ).fetchone()
+        return _parse_ksef_datetime(row[0]) if row is not None else None
+
+    def set_checkpoint(self, nip: str, subject_type: str, checkpoint: datetime.datetime) -> None:
+        """Zapisz punkt kontrolny (zatwierdzany razem ze stroną przez ``commit()``)."""
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_checkpoints (nip, subject_type, checkpoint, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (nip, subject_type, checkpoint.isoformat(timespec="microseconds"), now),
+            )
+
+    def get_window(self, nip: str, subject_type: str, date_type: str,
+                   date_from: datetime.date, date_to: datetime.date) -> Optional[dict]:
+        """Stan okna backfillu (status ``pending``/``done``/``error``, offset strony)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM backfill_windows WHERE nip = ? AND subject_type = ? AND date_type = ? "
+                "AND date_from = ? AND date_to = ?",
+                (nip, subject_type, date_type, date_from.isoformat(), date_to.isoformat()),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def set_window(self, nip: str, subject_type: str, date_type: str,
+                   date_from: datetime.date, date_to: datetime.date,
+                   status: str, page_offset: int) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO backfill_windows "
+                "(nip, subject_type, date_type, date_from, date_to, status, page_offset, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (nip, subject_type, date_type, date_from.isoformat(), date_to.isoformat(),
+                 status, page_offset, now),
+            )
+
+
 # ---------------------------------------------------------------------------
 # CLI — samodzielne użycie
 # ---------------------------------------------------------------------------
@@ -749,77 +3279,744 @@ def _resolve_token(args) -> str:
     sys.exit(1)
 
 
-def _download_all_invoices(client, args, logger) -> None:
-    """Download all invoices with pagination and file organization."""
-    output_dir = Path(args.output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
+def _session_keyfile(args) -> Optional[str]:
+    """Klucz AES dla cache sesji: --session-keyfile, a domyślnie klucz tokenu/hasła."""
+    return args.session_keyfile or args.token_keyfile or args.password_keyfile
 
-    date_to = datetime.date.today()
-    date_from = date_to - datetime.timedelta(days=args.days)
 
-    logger.info("Katalog docelowy: %s", output_dir.resolve())
-    logger.info("Wyszukiwanie faktur od %s do %s...", date_from, date_to)
+def _open_session(client, args, logger) -> None:
+    """Uwierzytelnij klienta — z --session-cache najpierw próba wznowienia sesji."""
+
+    def _authenticate() -> None:
+        if args.cert:
+            password = _resolve_password(args, logger)
+            client.authenticate_certificate(args.cert, args.key, password)
+        else:
+            token = _resolve_token(args)
+            client.authenticate_token(token)
 
-    total_downloaded = 0
-    total_skipped = 0
-    page_offset = 0
+    if args.session_cache:
+        client.session_cache = SessionCache(args.state_dir or args.output_dir, args.nip, args.env,
+                                            _session_keyfile(args), logger)
+        client.reauthenticate = _authenticate
 
-    while True:
-        result = client.query_invoices(
+    if not client.resume_session():
+        _authenticate()
+        client._save_session()
+
+
+def _open_trace(client, args) -> Optional[TraceWriter]:
+    """Podepnij TraceWriter z --trace-file do klienta (None bez opcji)."""
+    if not getattr(args, "trace_file", None):
+        return None
+    writer = TraceWriter(args.trace_file)
+    client.trace_hooks.append(writer)
+    return writer
+
+
+def _close_trace(client, writer: Optional[TraceWriter]) -> None:
+    if writer is not None:
+        client.trace_hooks.remove(writer)
+        writer.close()
+
+
+def _close_session(client) -> None:
+    """Zamknij sesję KSeF (z cache sesja zostaje otwarta dla kolejnego przebiegu)."""
+    if client.session_cache is not None:
+        client._save_session()
+    else:
+        client.terminate_session()
+
+
+def _save_invoice_xml(client, ksef_nr: str, xml_path: Path, inv_meta: dict = None,
+                      keep_content: bool = False) -> tuple:
+    """Pobierz XML faktury strumieniowo do pliku (wykonywane w wątku puli).
+
+    Skrót sprawdzany z ``invoiceHash`` z metadanych, jeśli KSeF go podał.
+
+    Returns:
+        (sha256 hex, rozmiar w bajtach, treść lub None bez ``keep_content``)
+    """
+    if keep_content:
+        return client.download_invoice_xml_to(ksef_nr, xml_path, _expected_sha256(inv_meta), keep_content=True)
+    return (*client.download_invoice_xml_to(ksef_nr, xml_path, _expected_sha256(inv_meta)), None)
+
+
+def _indexed_on_disk(index, ksef_nr: str, logger) -> bool:
+    """Czy faktura jest w indeksie i jej XML nadal leży na dysku.
+
+    Wpis bez pliku (usunięty lub przeniesiony ręcznie) jest usuwany
+    z indeksu, a faktura pobierana ponownie — jeden ``stat`` na fakturę
+    z indeksu zamiast ślepego zaufania wpisowi.
+    """
+    entry = index.get(ksef_nr)
+    if entry is None:
+        return False
+    if index.xml_path(entry).exists():
+        return True
+    logger.warning("Brak pliku z indeksu: %s (%s) — pobieram ponownie", ksef_nr, index.xml_path(entry))
+    index.discard(ksef_nr)
+    return False
+
+
+def _download_page(client, args, logger, index, executor, output_dir: Path, invoices: list, stats: dict,
+                   on_saved=None) -> bool:
+    """Pobierz faktury z jednej strony metadanych i zapisz je w indeksie.
+
+    Faktury z indeksu (z plikiem na dysku) lub z dysku sprzed indeksu są
+    pomijane; wpis indeksu bez pliku jest usuwany, a faktura pobierana ponownie.
+    Logi i liczniki w ``stats`` w kolejności metadanych. ``on_saved(numer,
+    ścieżka, sha256, treść)`` dostaje każdą nowo zapisaną fakturę (np.
+    PdfPipeline) — treść zachowaną przy zapisie, bez ponownego odczytu pliku.
+
+    Returns:
+        True jeśli wszystkie faktury strony są zapisane (bez błędów pobierania)
+    """
+    page_ok = True
+    pending = []
+    for inv in invoices:
+        ksef_nr = inv.get("ksefNumber", "")
+        if not ksef_nr:
+            continue
+
+        # Indeks: faktura już pobrana, plik na miejscu
+        if _indexed_on_disk(index, ksef_nr, logger):
+            stats["skipped"] += 1
+            client.metrics.inc("ksef_invoices_total", result="skipped")
+            continue
+
+        # Ustal podfolder ROK/MIESIAC na podstawie daty wystawienia
+        inv_subdir = _invoice_subdir(args.nip, inv, ksef_nr, logger)
+        target_dir = output_dir / inv_subdir
+
+        # Nazwa pliku: numer KSeF (bezpieczna nazwa)
+        xml_path = target_dir / f"{_safe_file_name(ksef_nr)}.xml"
+
+        # Plik sprzed indeksu (starsze archiwum) — dopisz do indeksu
+        if xml_path.exists():
+            index.adopt_file(ksef_nr, inv_subdir, xml_path, inv)
+            stats["skipped"] += 1
+            client.metrics.inc("ksef_invoices_total", result="skipped")
+            continue
+
+        target_dir.mkdir(parents=True, exist_ok=True)
+        pending.append((ksef_nr, inv_subdir, xml_path, inv))
+
+    # Pobieranie strony — równolegle, ale wyniki i logi w kolejności metadanych
+    keep_content = on_saved is not None
+    if executor is not None:
+        futures = [executor.submit(_save_invoice_xml, client, nr, path, inv, keep_content)
+                   for nr, _, path, inv in pending]
+    else:
+        futures = None
+
+    for i, (ksef_nr, inv_subdir, xml_path, inv) in enumerate(pending):
+        try:
+            if futures is not None:
+                sha256, size, content = futures[i].result()
+            else:
+                sha256, size, content = _save_invoice_xml(client, ksef_nr, xml_path, inv, keep_content)
+            index.record_download(ksef_nr, inv_subdir, xml_path.name, sha256, size, inv)
+            stats["downloaded"] += 1
+            client.metrics.inc("ksef_invoices_total", result="downloaded")
+            client.metrics.inc("ksef_downloaded_bytes_total", size)
+            logger.info("Pobrano: %s -> %s (%s)", ksef_nr, inv_subdir, xml_path)
+            if on_saved is not None:
+                on_saved(ksef_nr, xml_path, sha256, content)
+        except KSeFError as exc:
+            stats["errors"] += 1
+            client.metrics.inc("ksef_invoices_total", result="failed")
+            page_ok = False
+            logger.error("Błąd pobierania %s: %s", ksef_nr, exc)
+
+    return page_ok
+
+
+def _page_checkpoint(result: dict, invoices: list) -> Optional[datetime.datetime]:
+    """Najpóźniejsza data PermanentStorage na stronie (nie dalej niż HWM KSeF)."""
+    dates = [_parse_ksef_datetime(inv.get("permanentStorageDate")) for inv in invoices]
+    dates = [d for d in dates if d is not None]
+    if not dates:
+        return None
+    checkpoint = max(dates)
+    hwm = _parse_ksef_datetime(result.get("permanentStorageHwmDate"))
+    if hwm is not None and hwm < checkpoint:
+        checkpoint = hwm
+    return checkpoint
+
+
+def _split_truncated_window(client, args, logger, date_from, date_to, date_type: str,
+                            sort_order: str = None) -> list:
+    """Podziel okno z obciętym wynikiem (limit KSeF) na podokna mieszczące się w limicie.
+
+    Bisekcja poziomami: pierwsze strony wszystkich podokien danego poziomu
+    pobierane równolegle, podokna nadal obcięte dzielone dalej (do
+    MIN_SPLIT_WINDOW). Granice podokien się pokrywają — duplikaty usuwa
+    wywołujący po ksefNumber.
+
+    Returns:
+        lista (od, do, odpowiedź z pierwszą stroną) w kolejności chronologicznej
+    """
+    start = _KSeFClientBase._query_datetime(date_from, end=False)
+    end = _KSeFClientBase._query_datetime(date_to, end=True)
+
+    def _halves(window_from, window_to):
+        middle = window_from + (window_to - window_from) / 2
+        return [(window_from, middle), (middle, window_to)]
+
+    def _first_page(window):
+        return client.query_invoices(
             subject_type=args.subject,
-            date_from=date_from,
-            date_to=date_to,
-            page_offset=page_offset,
+            date_from=window[0],
+            date_to=window[1],
+            date_type=date_type,
+            sort_order=sort_order,
         )
 
-        invoices = result.get("invoices", [])
+    leaves = []
+    pending = _halves(start, end)
+    with ThreadPoolExecutor(max_workers=TRUNCATION_SPLIT_WORKERS, thread_name_prefix="ksef-split") as pool:
+        while pending:
+            next_level = []
+            for window, result in zip(pending, pool.map(_first_page, pending)):
+                if result.get("isTruncated") and (window[1] - window[0]) > MIN_SPLIT_WINDOW:
+                    next_level.extend(_halves(*window))
+                else:
+                    leaves.append((window[0], window[1], result))
+            pending = next_level
+
+    leaves.sort(key=lambda leaf: leaf[0])
+    logger.info("Zakres %s — %s podzielony na %d podokien",
+                start.isoformat(timespec="seconds"), end.isoformat(timespec="seconds"), len(leaves))
+    return leaves
+
+
+def _iter_invoice_pages(client, args, logger, date_from, date_to, date_type: str,
+                        sort_order: str = None, page_offset: int = 0):
+    """Kolejne niepuste strony metadanych jako (odpowiedź, nowe faktury, offset).
+
+    Gdy KSeF obetnie wynik (``isTruncated``, limit KSEF_QUERY_RESULT_LIMIT),
+    okno jest dzielone rekurencyjnie (``_split_truncated_window``), a faktury
+    już zwrócone — np. na granicach podokien — są pomijane po ksefNumber.
+    Offset to pozycja za stroną w oryginalnym oknie (do wznawiania); dla
+    stron z podokien None.
+    """
+    seen = set()
+
+    def _query(window_from, window_to, offset):
+        with client.metrics.timed("ksef_page_fetch_duration_seconds"):
+            result = client.query_invoices(
+                subject_type=args.subject,
+                date_from=window_from,
+                date_to=window_to,
+                date_type=date_type,
+                page_offset=offset,
+                sort_order=sort_order,
+            )
+        _log_page(result)
+        return result
+
+    def _log_page(result):
         logger.debug("Odpowiedź query: hasMore=%s, isTruncated=%s, invoices=%d, klucze=%s",
                       result.get("hasMore"), result.get("isTruncated"),
-                      len(invoices), list(result.keys()))
-        if not invoices:
-            if page_offset == 0:
-                logger.info("Brak faktur w podanym zakresie dat.")
-            break
+                      len(result.get("invoices", [])), list(result.keys()))
+
+    def _window(window_from, window_to, result, offset, top_level):
+        """Strony (pod)okna; po wykryciu obcięcia dzieli okno i przechodzi do podokien."""
+        span = (_KSeFClientBase._query_datetime(window_to, end=True)
+                - _KSeFClientBase._query_datetime(window_from, end=False))
+        while True:
+            invoices = result.get("invoices", [])
+            if not invoices:
+                return
+            if result.get("isTruncated"):
+                if span > MIN_SPLIT_WINDOW:
+                    break
+                logger.warning("Wynik obcięty przez KSeF w zakresie %s — %s, nie można go dalej dzielić",
+                               window_from, window_to)
+
+            fresh = [inv for inv in invoices if inv.get("ksefNumber") not in seen]
+            seen.update(inv.get("ksefNumber") for inv in fresh)
+            offset += len(invoices)
+            yield result, fresh, offset if top_level else None
+
+            # Paginacja: hasMore=true → są kolejne strony
+            if not result.get("hasMore", False):
+                return
+            result = _query(window_from, window_to, offset)
+
+        logger.warning("Wynik zapytania obcięty przez KSeF (limit %d) — dzielę zakres dat",
+                       KSEF_QUERY_RESULT_LIMIT)
+        leaves = _split_truncated_window(client, args, logger, window_from, window_to, date_type, sort_order)
+        for leaf_from, leaf_to, leaf_result in leaves:
+            _log_page(leaf_result)
+            yield from _window(leaf_from, leaf_to, leaf_result, 0, top_level=False)
+
+    yield from _window(date_from, date_to, _query(date_from, date_to, page_offset), page_offset, top_level=True)
+
+
+_PREFETCH_DONE = object()
+
+
+def _prefetch_pages(pages, depth: int, metrics=None):
+    """Pobieraj strony metadanych w wątku w tle, do ``depth`` stron naprzód.
 
-        for inv in invoices:
-            ksef_nr = inv.get("ksefNumber", "")
-            if not ksef_nr:
+    Zapytanie o kolejną stronę trwa, gdy wywołujący pobiera XML bieżącej.
+    Kolejka jest ograniczona, więc w pamięci jest najwyżej ``depth`` stron;
+    kolejność stron i wyjątki z iteratora przekazywane bez zmian. Przerwanie
+    iteracji przez wywołującego zatrzymuje wątek w tle. ``metrics`` dostaje
+    zajętość kolejki przy każdym odbiorze strony.
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    pipe = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pipe.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
+        return False
 
-            # Ustal podfolder ROK/MIESIAC na podstawie daty wystawienia
-            inv_subdir = _invoice_subdir(args.nip, inv, ksef_nr, logger)
-            target_dir = output_dir / inv_subdir
-            target_dir.mkdir(parents=True, exist_ok=True)
+    def _producer():
+        try:
+            for page in pages:
+                if not _put(page):
+                    return
+            _put(_PREFETCH_DONE)
+        except BaseException as exc:
+            _put(exc)
+        finally:
+            pages.close()
+
+    thread = threading.Thread(target=_producer, name="ksef-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            if metrics is not None:
+                metrics.observe("ksef_queue_depth", pipe.qsize(), queue="prefetch")
+            item = pipe.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class _ExportPartsReader(io.RawIOBase):
+    """Odszyfrowane części paczki eksportu jako jeden plik tylko do odczytu.
+
+    ZIP paczki jest pocięty na części w kolejności ``ordinalNumber``;
+    zipfile czyta je tak, jakby były sklejone, bez kopiowania do jednego pliku.
+    """
+
+    def __init__(self, paths: list):
+        super().__init__()
+        self._files = [open(path, "rb") for path in paths]
+        self._sizes = [os.fstat(fh.fileno()).st_size for fh in self._files]
+        self._starts = []
+        offset = 0
+        for size in self._sizes:
+            self._starts.append(offset)
+            offset += size
+        self._size = offset
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self._size:
+            return 0
+        part = bisect.bisect_right(self._starts, self._pos) - 1
+        local = self._pos - self._starts[part]
+        want = min(len(buffer), self._sizes[part] - local)
+        fh = self._files[part]
+        fh.seek(local)
+        read = fh.readinto(memoryview(buffer)[:want])
+        self._pos += read
+        return read
+
+    def close(self) -> None:
+        for fh in self._files:
+            fh.close()
+        super().close()
+
+
+def _unpack_export(client, args, logger, index, output_dir: Path, paths: list, stats: dict,
+                   on_saved=None) -> bool:
+    """Rozpakuj paczkę eksportu strumieniowo do układu _invoice_subdir i zapisz faktury w indeksie.
+
+    Metadane faktur z ``_metadata.json`` paczki (data do podfolderu,
+    invoiceHash do weryfikacji). Faktura z błędem nie trafia do indeksu —
+    dopełni ją pobieranie pojedyncze.
+
+    Returns:
+        True jeśli wszystkie faktury paczki są zapisane
+    """
+    ok = True
+    with io.BufferedReader(_ExportPartsReader(paths), DOWNLOAD_CHUNK_SIZE) as package, \
+            zipfile.ZipFile(package) as archive:
+        metadata = {}
+        if EXPORT_METADATA_FILENAME in archive.namelist():
+            with archive.open(EXPORT_METADATA_FILENAME) as fh:
+                entries = json.load(fh)
+            if isinstance(entries, dict):
+                entries = entries.get("invoices", [])
+            metadata = {inv.get("ksefNumber"): inv for inv in entries if isinstance(inv, dict)}
+
+        for member in archive.infolist():
+            name = member.filename.rsplit("/", 1)[-1]
+            if member.is_dir() or not name.lower().endswith(".xml"):
+                continue
+            ksef_nr = name[:-len(".xml")]
+            inv = metadata.get(ksef_nr, {})
 
-            # Nazwa pliku: numer KSeF (bezpieczna nazwa)
-            safe_name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', ksef_nr)
-            safe_name = safe_name.replace('..', '__')
-            if len(safe_name) > 200:
-                safe_name = safe_name[:200]
-            xml_path = target_dir / f"{safe_name}.xml"
+            if _indexed_on_disk(index, ksef_nr, logger):
+                stats["skipped"] += 1
+                client.metrics.inc("ksef_invoices_total", result="skipped")
+                continue
 
+            inv_subdir = _invoice_subdir(args.nip, inv, ksef_nr, logger)
+            target_dir = output_dir / inv_subdir
+            xml_path = target_dir / f"{_safe_file_name(ksef_nr)}.xml"
             if xml_path.exists():
-                total_skipped += 1
+                index.adopt_file(ksef_nr, inv_subdir, xml_path, inv or None)
+                stats["skipped"] += 1
+                client.metrics.inc("ksef_invoices_total", result="skipped")
                 continue
 
+            target_dir.mkdir(parents=True, exist_ok=True)
             try:
-                xml_bytes = client.download_invoice_xml(ksef_nr)
-                xml_path.write_bytes(xml_bytes)
-                total_downloaded += 1
-                logger.info("Pobrano: %s -> %s (%s)", ksef_nr, inv_subdir, xml_path)
-            except KSeFError as exc:
-                logger.error("Błąd pobierania %s: %s", ksef_nr, exc)
+                with archive.open(member) as src, AtomicFileWriter(xml_path, on_saved is not None) as out:
+                    for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        out.write(chunk)
+                    sha256, size = out.commit(_expected_sha256(inv))
+            except (KSeFError, zipfile.BadZipFile) as exc:
+                ok = False
+                logger.warning("Eksport: %s — %s (zostanie pobrana pojedynczo)", ksef_nr, exc)
+                continue
+
+            index.record_download(ksef_nr, inv_subdir, xml_path.name, sha256, size, inv or None)
+            stats["downloaded"] += 1
+            client.metrics.inc("ksef_invoices_total", result="downloaded")
+            client.metrics.inc("ksef_downloaded_bytes_total", size)
+            logger.info("Pobrano (eksport): %s -> %s (%s)", ksef_nr, inv_subdir, xml_path)
+            if on_saved is not None:
+                on_saved(ksef_nr, xml_path, sha256, out.content)
+    return ok
+
+
+def _export_range(client, args, logger, index, output_dir: Path, date_from, date_to, date_type: str,
+                  stats: dict, on_saved=None) -> bool:
+    """Pobierz zakres dat paczką eksportu KSeF zamiast pojedynczych faktur (--export).
+
+    Części paczki pobierane równolegle (--export-parts) i odszyfrowywane
+    w locie do katalogu tymczasowego w folderze docelowym, potem
+    rozpakowywane przez _unpack_export. Faktury obecne w indeksie są pomijane.
+
+    Returns:
+        True — zakres zapisany w całości; False — eksport niedostępny,
+        obcięty (isTruncated) lub z błędami: dopełnij zakres pobieraniem
+        pojedynczych faktur
+    """
+    label = f"{date_from}..{date_to}"
+    try:
+        reference_number, key, iv = client.start_invoice_export(args.subject, date_from, date_to, date_type)
+        package = client.wait_for_invoice_export(reference_number)
+    except KSeFError as exc:
+        logger.warning("Eksport %s niedostępny (%s) — pobieranie pojedynczych faktur", label, exc)
+        return False
+
+    parts = sorted(package.get("parts") or [], key=lambda part: part.get("ordinalNumber", 0))
+    complete = not package.get("isTruncated")
+    logger.info("Eksport %s gotowy: faktur %s, części %d", label, package.get("invoiceCount", "?"), len(parts))
+    if not parts:
+        return complete
+
+    work_dir = output_dir / f".export-{_safe_file_name(reference_number)}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        paths = [work_dir / f"part-{n:04d}" for n in range(len(parts))]
+        workers = max(1, min(getattr(args, "export_parts", DEFAULT_EXPORT_PARTS), len(parts)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ksef-export") as pool:
+            futures = [pool.submit(client.download_export_part, reference_number, part, path, key, iv)
+                       for part, path in zip(parts, paths)]
+            for future in futures:
+                future.result()
+        unpacked = _unpack_export(client, args, logger, index, output_dir, paths, stats, on_saved)
+    except (KSeFError, zipfile.BadZipFile) as exc:
+        logger.warning("Eksport %s: %s — pobieranie pojedynczych faktur", label, exc)
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        index.commit()
 
-        # Paginacja: hasMore=true → są kolejne strony, isTruncated=true → limit 10k
-        page_offset += len(invoices)
-        has_more = result.get("hasMore", False)
-        if not has_more:
+    if not complete:
+        logger.info("Eksport %s obcięty (isTruncated) — reszta zakresu pobierana pojedynczo", label)
+    return complete and unpacked
+
+
+def _new_stats() -> dict:
+    return {"downloaded": 0, "skipped": 0, "errors": 0}
+
+
+def _sync_days(client, args, logger, index, executor, output_dir: Path, stats: dict, on_saved=None) -> None:
+    """Okno --days wstecz od dziś (tryb domyślny)."""
+    date_to = datetime.date.today()
+    date_from = date_to - datetime.timedelta(days=args.days)
+    logger.info("Wyszukiwanie faktur od %s do %s...", date_from, date_to)
+
+    date_type = getattr(args, "date_type", "Invoicing")
+    if getattr(args, "export", False) and _export_range(client, args, logger, index, output_dir, date_from,
+                                                        date_to, date_type, stats, on_saved):
+        return
+
+    found = False
+    pages = _prefetch_pages(_iter_invoice_pages(client, args, logger, date_from, date_to, date_type),
+                            getattr(args, "prefetch", 0), client.metrics)
+    for _, invoices, _ in pages:
+        found = True
+        _download_page(client, args, logger, index, executor, output_dir, invoices, stats, on_saved)
+        index.commit()
+    if not found:
+        logger.info("Brak faktur w podanym zakresie dat.")
+
+
+def _sync_incremental(client, args, logger, index, executor, output_dir: Path, stats: dict,
+                      on_saved=None) -> None:
+    """Synchronizacja przyrostowa od punktu kontrolnego (data PermanentStorage).
+
+    Zapytanie od punktu kontrolnego z niewielką zakładką; bez punktu
+    kontrolnego — okno --days. Punkt kontrolny przesuwamy tylko po stronach
+    zapisanych w całości; po pierwszym błędzie zostaje na miejscu do
+    następnego przebiegu.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    checkpoint = index.get_checkpoint(args.nip, args.subject)
+    if checkpoint is not None:
+        overlap = datetime.timedelta(minutes=getattr(args, "overlap", DEFAULT_INCREMENTAL_OVERLAP_MIN))
+        date_from = min(checkpoint - overlap, now)
+        logger.info("Synchronizacja przyrostowa od %s (punkt kontrolny: %s)",
+                    date_from.isoformat(timespec="seconds"), checkpoint.isoformat(timespec="seconds"))
+    else:
+        date_from = now - datetime.timedelta(days=args.days)
+        logger.info("Brak punktu kontrolnego — pierwsza synchronizacja od %s",
+                    date_from.isoformat(timespec="seconds"))
+
+    # KSeF przyjmuje zakres do 90 dni — zaległy okres pobieramy kolejnymi
+    # oknami zamiast przycinać zakres
+    advance_checkpoint = True
+    window_from = date_from
+    while True:
+        window_to = min(window_from + datetime.timedelta(days=90), now)
+        pages = _prefetch_pages(_iter_invoice_pages(client, args, logger, window_from, window_to,
+                                                    "PermanentStorage", sort_order="Asc"),
+                                getattr(args, "prefetch", 0), client.metrics)
+        for result, invoices, _ in pages:
+            page_ok = _download_page(client, args, logger, index, executor, output_dir, invoices, stats,
+                                     on_saved)
+
+            if advance_checkpoint:
+                if page_ok:
+                    page_checkpoint = _page_checkpoint(result, invoices)
+                    if page_checkpoint is not None and (checkpoint is None or page_checkpoint > checkpoint):
+                        checkpoint = page_checkpoint
+                        index.set_checkpoint(args.nip, args.subject, checkpoint)
+                else:
+                    advance_checkpoint = False
+                    logger.warning("Błędy pobierania — punkt kontrolny pozostaje bez zmian")
+
+            # Zapis strony i punktu kontrolnego w jednej transakcji
+            index.commit()
+        if window_to >= now:
             break
+        window_from = window_to
 
-    logger.info("Zakończono. Pobrano: %d, pominięto: %d", total_downloaded, total_skipped)
+    if checkpoint is not None:
+        logger.info("Punkt kontrolny (%s): %s", args.subject, checkpoint.isoformat(timespec="seconds"))
 
 
-def _cli() -> None:
+def _split_date_range(date_from: datetime.date, date_to: datetime.date, max_days: int = 90) -> list:
+    """Podziel zakres dat (włącznie) na kolejne okna po najwyżej ``max_days`` dni."""
+    windows = []
+    start = date_from
+    while start <= date_to:
+        end = min(start + datetime.timedelta(days=max_days - 1), date_to)
+        windows.append((start, end))
+        start = end + datetime.timedelta(days=1)
+    return windows
+
+
+def _backfill_window(client, args, logger, index, executor, output_dir: Path,
+                     window: tuple, date_type: str, stats: dict, on_saved=None) -> None:
+    """Pobierz jedno okno backfillu, zapisując postęp (offset strony) w indeksie.
+
+    Przerwane okno wznawia się od ostatniej w pełni zapisanej strony; okno
+    z błędami pobierania przy kolejnym uruchomieniu zaczyna od początku
+    (pobrane faktury pomija indeks).
+    """
+    date_from, date_to = window
+    label = f"{date_from}..{date_to}"
+
+    state = index.get_window(args.nip, args.subject, date_type, date_from, date_to)
+    if state is not None and state["status"] == "done":
+        logger.info("Okno %s: pobrane wcześniej — pomijam", label)
+        return
+
+    if getattr(args, "export", False) and _export_range(client, args, logger, index, output_dir, date_from,
+                                                        date_to, date_type, stats, on_saved):
+        index.set_window(args.nip, args.subject, date_type, date_from, date_to, "done", 0)
+        index.commit()
+        logger.info("Okno %s zakończone (eksport): pobrano %d, pominięto %d",
+                    label, stats["downloaded"], stats["skipped"])
+        return
+
+    page_offset = state["page_offset"] if state is not None and state["status"] == "pending" else 0
+    if page_offset:
+        logger.info("Okno %s: wznowienie od pozycji %d", label, page_offset)
+    index.set_window(args.nip, args.subject, date_type, date_from, date_to, "pending", page_offset)
+    index.commit()
+
+    resume_ok = True
+    page_no = 0
+    pages = _prefetch_pages(_iter_invoice_pages(client, args, logger, date_from, date_to, date_type,
+                                                page_offset=page_offset),
+                            getattr(args, "prefetch", 0), client.metrics)
+    for _, invoices, next_offset in pages:
+        page_no += 1
+        page_ok = _download_page(client, args, logger, index, executor, output_dir, invoices, stats, on_saved)
+        # Offset wznowienia tylko dla stron niepodzielonego okna (po bisekcji
+        # przerwane okno zaczyna od początku — pobrane faktury pomija indeks)
+        if page_ok and resume_ok and next_offset is not None:
+            page_offset = next_offset
+            index.set_window(args.nip, args.subject, date_type, date_from, date_to, "pending", page_offset)
+        else:
+            resume_ok = False
+        index.commit()
+        logger.info("Okno %s: strona %d — pobrano %d, pominięto %d, błędy %d",
+                    label, page_no, stats["downloaded"], stats["skipped"], stats["errors"])
+
+    status = "done" if stats["errors"] == 0 else "error"
+    index.set_window(args.nip, args.subject, date_type, date_from, date_to, status, page_offset)
+    index.commit()
+    logger.info("Okno %s zakończone (%s): pobrano %d, pominięto %d, błędy %d",
+                label, "OK" if status == "done" else "z błędami",
+                stats["downloaded"], stats["skipped"], stats["errors"])
+
+
+def _sync_backfill(client, args, logger, index, executor, output_dir: Path, stats: dict,
+                   on_saved=None) -> None:
+    """Backfill dowolnego zakresu --date-from/--date-to oknami do 90 dni.
+
+    Okna pobierane równolegle (--parallel-windows) przez wspólnego klienta,
+    więc limiter żądań i pula połączeń obejmują wszystkie okna naraz.
+    """
+    date_from = args.date_from
+    date_to = args.date_to or datetime.date.today()
+    date_type = getattr(args, "date_type", "Invoicing")
+    windows = _split_date_range(date_from, date_to)
+    parallel = max(1, min(getattr(args, "parallel_windows", 1), len(windows)))
+    logger.info("Backfill faktur od %s do %s: %d okien (równolegle: %d)",
+                date_from, date_to, len(windows), parallel)
+
+    def _run(window):
+        window_stats = _new_stats()
+        try:
+            _backfill_window(client, args, logger, index, executor, output_dir, window, date_type, window_stats,
+                             on_saved)
+        except KSeFError as exc:
+            # Postęp okna zostaje w indeksie — kolejne uruchomienie je wznowi
+            logger.error("Okno %s..%s przerwane: %s", window[0], window[1], exc)
+            window_stats["errors"] += 1
+        return window_stats
+
+    finished = 0
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="ksef-window") as pool:
+        for future in as_completed([pool.submit(_run, window) for window in windows]):
+            window_stats = future.result()
+            finished += 1
+            for key in stats:
+                stats[key] += window_stats[key]
+            logger.info("Postęp backfillu: %d/%d okien", finished, len(windows))
+
+
+def _download_all_invoices(client, args, logger, pdf_pipeline=None) -> None:
+    """Download all invoices with pagination and file organization.
+
+    Z ``pdf_pipeline`` (ksef_pdf.PdfPipeline) każda nowo pobrana faktura
+    trafia od razu do generatora PDF; potok jest opróżniany i zamykany
+    przed zamknięciem indeksu.
+    """
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    index = InvoiceIndex(output_dir)
+
+    logger.info("Katalog docelowy: %s", output_dir.resolve())
+
+    if getattr(args, "date_from", None) is not None:
+        sync = _sync_backfill
+    elif getattr(args, "incremental", False):
+        sync = _sync_incremental
+    else:
+        sync = _sync_days
+
+    stats = _new_stats()
+
+    # Pula wątków pobierających (--concurrency > 1); przy 1 pobieramy szeregowo
+    concurrency = max(1, getattr(args, "concurrency", 1))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ksef-dl") if concurrency > 1 else None
+
+    on_saved = None
+    if pdf_pipeline is not None:
+        def on_saved(ksef_nr, xml_path, sha256, xml_bytes):
+            pdf_pipeline.submit(ksef_nr, xml_path, sha256, index=index, xml_bytes=xml_bytes)
+
+    try:
+        sync(client, args, logger, index, executor, output_dir, stats, on_saved)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if pdf_pipeline is not None:
+            pdf_pipeline.close()
+        index.close()
+
+    retry_policy = getattr(client, "retry_policy", None)
+    total_retries = retry_policy.retries if retry_policy is not None else 0
+    logger.info("Zakończono. Pobrano: %d, pominięto: %d, ponowienia: %d, błędy: %d",
+                stats["downloaded"], stats["skipped"], total_retries, stats["errors"])
+
+    limiter = getattr(client, "rate_limiter", None)
+    if limiter is not None:
+        for bucket, st in limiter.state().items():
+            if st["throttled"]:
+                logger.info("Limit KSeF (%s): HTTP 429 x%d, łączne oczekiwanie %.1f s",
+                            bucket, st["throttled"], st["waited_s"])
+        logger.debug("Stan limitera: %s", limiter.state())
+
+
+def _build_parser():
+    """Parser argumentów CLI (używany też przez ksef_sync.py dla ustawień NIP)."""
     import argparse
 
     parser = argparse.ArgumentParser(
@@ -827,11 +4024,52 @@ def _cli() -> None:
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser.add_argument("--nip", required=True, help="NIP firmy")
-    parser.add_argument("--env", choices=["test", "demo", "prod"], default="prod", help="Środowisko KSeF")
+    parser.add_argument("--env", choices=list(KSEF_URLS), default="prod",
+                        help="Środowisko KSeF (local — ksef_mock.py, adres w KSEF_LOCAL_URL)")
     parser.add_argument("--output-dir", default="faktury", help="Katalog na pliki XML")
     parser.add_argument("--subject", choices=["Subject1", "Subject2"], default="Subject2",
                         help="Subject1=wystawione, Subject2=otrzymane")
     parser.add_argument("--days", type=int, default=30, help="Ile dni wstecz")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Synchronizacja przyrostowa od zapisanego punktu kontrolnego "
+                             "(data PermanentStorage); --days tylko przy pierwszym przebiegu")
+    parser.add_argument("--overlap", type=int, default=DEFAULT_INCREMENTAL_OVERLAP_MIN, metavar="MIN",
+                        help=f"Zakładka wstecz od punktu kontrolnego w minutach "
+                             f"(domyślnie: {DEFAULT_INCREMENTAL_OVERLAP_MIN})")
+    parser.add_argument("--date-from", type=datetime.date.fromisoformat, metavar="RRRR-MM-DD",
+                        help="Backfill od daty (zakres dzielony na okna do 90 dni, wznawialny)")
+    parser.add_argument("--date-to", type=datetime.date.fromisoformat, metavar="RRRR-MM-DD",
+                        help="Backfill do daty (domyślnie: dziś)")
+    parser.add_argument("--date-type", choices=["Invoicing", "Issue", "PermanentStorage"], default="Invoicing",
+                        help="Rodzaj daty zakresu dla --days i backfillu (domyślnie: Invoicing)")
+    parser.add_argument("--parallel-windows", type=int, default=2, metavar="N",
+                        help="Liczba równolegle pobieranych okien backfillu (domyślnie: 2)")
+    parser.add_argument("--concurrency", type=int, default=1, metavar="N",
+                        help="Liczba równoległych pobrań XML (domyślnie: 1)")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH_PAGES, metavar="N",
+                        help=f"Ile stron metadanych pobierać z wyprzedzeniem w tle; 0 = wyłączone "
+                             f"(domyślnie: {DEFAULT_PREFETCH_PAGES})")
+    parser.add_argument("--export", action="store_true",
+                        help="Pobieraj zakres dat paczka eksportu KSeF (POST /invoices/exports) zamiast "
+                             "pojedynczych faktur; przy bledzie lub obcietej paczce powrot do pobierania "
+                             "pojedynczego (nie dotyczy --incremental)")
+    parser.add_argument("--export-parts", type=int, default=DEFAULT_EXPORT_PARTS, metavar="N",
+                        help=f"Liczba rownoleglych pobran czesci paczki eksportu "
+                             f"(domyslnie: {DEFAULT_EXPORT_PARTS})")
+    parser.add_argument("--pdf", action="store_true",
+                        help="Generuj PDF nowo pobranych faktur w trakcie pobierania (wymaga ksef_pdf.py)")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="Zapisz metryki Prometheus po przebiegu (textfile collector node_exportera, *.prom)")
+    parser.add_argument("--trace-file", metavar="PATH",
+                        help="Zapisz spany żądań HTTP (DNS/TCP/TLS/TTFB, bez tokenów): JSONL, "
+                             "a dla rozszerzenia .har — archiwum HAR")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="KLASA=R[/B]",
+                        help="Budżet żądań/s dla klasy endpointu (query, download, auth), "
+                             "np. download=8/16; 0 = bez limitu. Można podać wielokrotnie")
+    parser.add_argument("--retries", type=int, default=DEFAULT_MAX_RETRIES, metavar="N",
+                        help=f"Maks. ponowień żądania po błędzie przejściowym (domyślnie: {DEFAULT_MAX_RETRIES})")
+    parser.add_argument("--retry-budget", type=int, default=DEFAULT_RETRY_BUDGET, metavar="N",
+                        help=f"Maks. łączna liczba ponowień w przebiegu (domyślnie: {DEFAULT_RETRY_BUDGET})")
     parser.add_argument("-v", "--verbose", action="store_true")
 
     auth_group = parser.add_mutually_exclusive_group(required=False)
@@ -846,6 +4084,15 @@ def _cli() -> None:
     parser.add_argument("--password-enc", help="Zaszyfrowane hasło AES-256-GCM (base64)")
     parser.add_argument("--password-keyfile", help="Plik z kluczem AES-256 (dla --password-enc lub --token-enc)")
     parser.add_argument("--token-keyfile", help="Plik z kluczem AES-256 (dla --token-enc)")
+    parser.add_argument("--session-cache", action="store_true",
+                        help="Zachowaj sesję między przebiegami (zaszyfrowany cache tokenów, odnawianie "
+                             "refresh tokenem zamiast pełnego uwierzytelnienia)")
+    parser.add_argument("--session-keyfile",
+                        help="Plik z kluczem AES-256 dla cache sesji (domyślnie: --token-keyfile "
+                             "lub --password-keyfile)")
+    parser.add_argument("--state-dir",
+                        help="Katalog na stan klienta: cache sesji, czasy autoryzacji, certyfikaty KSeF "
+                             "(domyślnie: --output-dir)")
 
     # Tryb pomocniczy: szyfrowanie hasła
     parser.add_argument("--encrypt-password", metavar="PASSWORD",
@@ -854,8 +4101,11 @@ def _cli() -> None:
                         help="Jak --encrypt-password ale czyta hasło z pliku (bezpieczniejsze)")
     parser.add_argument("--generate-keyfile", metavar="PATH",
                         help="Wygeneruj klucz AES-256 do pliku (dla --encrypt-password)")
+    return parser
+
 
-    args = parser.parse_args()
+def _cli() -> None:
+    args = _build_parser().parse_args()
 
     # Tryb szyfrowania hasła (helper dla instalatora)
     password_to_encrypt = args.encrypt_password
@@ -881,31 +4131,75 @@ def _cli() -> None:
         print("BLAD: Podaj --token, --token-file, --token-enc lub --cert", file=sys.stderr)
         sys.exit(1)
 
+    if args.date_to and not args.date_from:
+        print("BLAD: --date-to wymaga --date-from", file=sys.stderr)
+        sys.exit(1)
+    if args.date_from and args.incremental:
+        print("BLAD: --date-from (backfill) i --incremental wykluczaja sie", file=sys.stderr)
+        sys.exit(1)
+    if args.date_from and args.date_from > (args.date_to or datetime.date.today()):
+        print("BLAD: --date-from jest pozniejsza niz --date-to", file=sys.stderr)
+        sys.exit(1)
+
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
         format="%(asctime)s [%(levelname)s] %(message)s",
     )
     logger = logging.getLogger("ksef_client")
 
-    client = KSeFClient(nip=args.nip, environment=args.env, logger=logger)
+    try:
+        rate_limits = parse_rate_limits(args.rate_limit)
+    except ValueError as exc:
+        print(f"BLAD: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+    metrics = Metrics()
+    client = KSeFClient(
+        nip=args.nip,
+        environment=args.env,
+        logger=logger,
+        pool_size=max(DEFAULT_POOL_SIZE, args.concurrency, args.export_parts),
+        rate_limiter=RateLimiter(rate_limits),
+        retry_policy=RetryPolicy(max_retries=args.retries, budget=args.retry_budget),
+        auth_poller=AuthPoller(state_dir=args.state_dir or args.output_dir),
+        public_key_cache=PublicKeyCache(state_dir=args.state_dir or args.output_dir),
+        metrics=metrics,
+    )
 
     # Uwierzytelnianie
-    if args.cert:
-        if not args.key:
-            print("BLAD: --key jest wymagany razem z --cert", file=sys.stderr)
-            sys.exit(1)
-        password = _resolve_password(args, logger)
-        client.authenticate_certificate(args.cert, args.key, password)
-    else:
-        token = _resolve_token(args)
-        client.authenticate_token(token)
+    if args.cert and not args.key:
+        print("BLAD: --key jest wymagany razem z --cert", file=sys.stderr)
+        sys.exit(1)
 
-    # Pobieranie faktur
-    _download_all_invoices(client, args, logger)
+    if args.session_cache and not _session_keyfile(args):
+        print("BLAD: --session-cache wymaga --session-keyfile (lub --token-keyfile/--password-keyfile)",
+              file=sys.stderr)
+        sys.exit(1)
 
-    # Zamknij sesję
-    client.terminate_session()
-    client._session.close()
+    pdf_pipeline = None
+    if args.pdf:
+        try:
+            import ksef_pdf
+        except ImportError as exc:
+            print(f"BLAD: --pdf wymaga ksef_pdf.py (reportlab): {exc}", file=sys.stderr)
+            sys.exit(1)
+        pdf_pipeline = ksef_pdf.PdfPipeline(logger=logger, metrics=client.metrics,
+                                            manifest=ksef_pdf.PdfManifest(Path(args.output_dir)))
+
+    trace_writer = _open_trace(client, args)
+    try:
+        _open_session(client, args, logger)
+
+        # Pobieranie faktur (z --pdf: PDF równolegle z pobieraniem)
+        _download_all_invoices(client, args, logger, pdf_pipeline)
+
+        _close_session(client)
+        client.close()
+    finally:
+        _close_trace(client, trace_writer)
+        # Również po błędzie — nieudany przebieg też ma być widoczny w metrykach
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
 
 
 if __name__ == "__main__":
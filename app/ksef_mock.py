@@ -0,0 +1,987 @@
+"""
+Lokalny serwer udający API KSeF 2.0 - testy obciążeniowe i regresyjne bez produkcji.
+
+Implementuje endpointy używane przez ksef_client.py:
+- POST /auth/challenge, /auth/ksef-token, /auth/xades-signature
+- GET  /auth/{referenceNumber} (status 100 → 200 po ``--auth-delay-ms``)
+- POST /auth/token/redeem, /auth/token/refresh, DELETE /auth/sessions/current
+- GET  /security/public-key-certificates (certyfikat generowany przy starcie)
+- POST /invoices/query/metadata (paginacja, hasMore, isTruncated, sortOrder)
+- GET  /invoices/ksef/{ksefNumber}
+- POST /invoices/exports, GET /invoices/exports/{referenceNumber} (paczka ZIP
+  szyfrowana AES-256-CBC kluczem klienta, pocięta na części ``--export-part-size``;
+  części pod GET /mock/exports/{referenceNumber}/parts/{n} bez tokenu — jak adres podpisany)
+
+Korpus faktur jest deterministyczny (``--invoices``, ``--days``, ``--seed``):
+te same parametry dają te same numery KSeF, treść XML i invoiceHash.
+Opóźnienia, odsetek błędów 503, losowe 429 oraz limit zapytań na sekundę
+(429 z Retry-After) są konfigurowalne; testy mogą też zaplanować konkretne
+błędy kolejnych żądań (``inject_faults``: kod HTTP lub urwana treść).
+GET /mock/stats zwraca liczniki odpowiedzi per endpoint.
+
+Użycie:
+    python ksef_mock.py --port 8089 --invoices 10000 --latency-ms 20 --throttle-rate 0.01
+    KSEF_LOCAL_URL=http://127.0.0.1:8089/v2 python ksef_client.py --env local --nip 5265877635 --token x
+
+Autor: IT TASK FORCE Piotr Mierzenski - https://ittf.pl
+"""
+
+import argparse
+import base64
+import bisect
+import datetime
+import hashlib
+import io
+import json
+import logging
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.x509.oid import NameOID
+
+# ---------------------------------------------------------------------------
+# Stałe
+# ---------------------------------------------------------------------------
+
+DEFAULT_MOCK_PORT = 8089
+API_PREFIX = "/v2"
+
+DEFAULT_CORPUS_SIZE = 1000
+DEFAULT_CORPUS_DAYS = 90
+DEFAULT_INVOICE_LINES = 3
+DEFAULT_MOCK_NIP = "5265877635"
+
+# Limity jak w KSeF: strona zapytania i liczba wyników jednego zapytania
+MAX_PAGE_SIZE = 250
+QUERY_RESULT_LIMIT = 10000
+
+# Eksport paczek: rozmiar części (przed szyfrowaniem), czas przygotowania, ważność
+DEFAULT_EXPORT_PART_SIZE = 1024 * 1024
+DEFAULT_EXPORT_DELAY_MS = 500.0
+EXPORT_PART_TTL_S = 3600
+
+ACCESS_TOKEN_TTL_S = 900
+REFRESH_TOKEN_TTL_S = 7 * 24 * 3600
+
+FA2_NS = "http://crd.gov.pl/wzor/2023/06/29/12648/"
+
+logger = logging.getLogger("ksef_mock")
+
+
+def _iso(value: datetime.datetime) -> str:
+    return value.isoformat(timespec="milliseconds")
+
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    """Data/czas ISO z zapytania jako datetime UTC (``Z`` i brak strefy = UTC)."""
+    text = value.strip()
+    if text.endswith(("Z", "z")):
+        text = text[:-1] + "+00:00"
+    parsed = datetime.datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+def _crc8(data: bytes) -> int:
+    """CRC-8 (wielomian 0x07) — suma kontrolna na końcu numeru KSeF."""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+# ---------------------------------------------------------------------------
+# Korpus faktur
+# ---------------------------------------------------------------------------
+
+class MockCorpus:
+    """Deterministyczny zbiór faktur FA(2) do udostępnienia przez serwer.
+
+    Faktury są rozłożone równomiernie w ``days`` dniach kończących się
+    o północy UTC dnia ``end_date`` (domyślnie dziś). Metadane są trzymane
+    w pamięci, XML generowany przy każdym pobraniu (invoiceHash liczony
+    leniwie i zapamiętywany).
+    """
+
+    # dateType zapytania → pole metadanych
+    DATE_FIELDS = {
+        "PermanentStorage": "permanentStorageDate",
+        "Invoicing": "invoicingDate",
+        "Issue": "issueDate",
+    }
+
+    def __init__(
+        self,
+        size: int = DEFAULT_CORPUS_SIZE,
+        nip: str = DEFAULT_MOCK_NIP,
+        days: int = DEFAULT_CORPUS_DAYS,
+        lines: int = DEFAULT_INVOICE_LINES,
+        seed: int = 0,
+        end_date: datetime.date = None,
+    ):
+        self.nip = nip
+        self.lines = max(1, lines)
+        self.seed = seed
+        end_date = end_date or datetime.datetime.now(datetime.timezone.utc).date()
+        end = datetime.datetime.combine(end_date, datetime.time(0, 0), tzinfo=datetime.timezone.utc)
+        start = end - datetime.timedelta(days=days)
+        step = (end - start) / max(size, 1)
+
+        self._meta = []
+        self._hashes = [None] * size
+        self._by_number = {}
+        for i in range(size):
+            stored = start + step * (i + 1)
+            self._meta.append(self._metadata(i, stored))
+            self._by_number[self._meta[i]["ksefNumber"]] = i
+
+        # Indeksy posortowane po polu daty — zapytanie o zakres to bisect, nie skan
+        self._sorted = {}
+        for date_type, field in self.DATE_FIELDS.items():
+            order = sorted(range(size), key=lambda i, f=field: (self._meta[i][f], i))
+            self._sorted[date_type] = ([self._meta[i][field] for i in order], order)
+
+    def __len__(self) -> int:
+        return len(self._meta)
+
+    def _seller_nip(self, i: int) -> str:
+        return f"{(self.seed * 7919 + i * 104729) % 9000000000 + 1000000000:010d}"
+
+    def _metadata(self, i: int, stored: datetime.datetime) -> dict:
+        invoicing = stored - datetime.timedelta(seconds=2)
+        issue = invoicing.date() - datetime.timedelta(days=i % 3)
+        seller = self._seller_nip(i)
+        digest = hashlib.sha256(f"{self.seed}:{i}".encode()).hexdigest().upper()
+        base = f"{seller}-{invoicing:%Y%m%d}-{digest[:12]}"
+        net, vat = self._amounts(i)
+        return {
+            "ksefNumber": f"{base}-{_crc8(base.encode()):02X}",
+            "invoiceNumber": f"FV/{i + 1}/{issue.year}",
+            "issueDate": issue.isoformat(),
+            "invoicingDate": _iso(invoicing),
+            "acquisitionDate": _iso(invoicing),
+            "permanentStorageDate": _iso(stored),
+            "seller": {"nip": seller, "name": f"Sprzedawca {i % 97} Sp. z o.o."},
+            "buyer": {"identifier": {"type": "Nip", "value": self.nip}, "name": "Nabywca Sp. z o.o."},
+            "netAmount": net,
+            "vatAmount": vat,
+            "grossAmount": round(net + vat, 2),
+            "currency": "PLN",
+            "invoicingMode": "Online",
+            "invoiceType": "Vat",
+            "formCode": {"systemCode": "FA (2)", "schemaVersion": "1-0E", "value": "FA"},
+            "isSelfInvoicing": False,
+            "hasAttachment": False,
+        }
+
+    def _amounts(self, i: int) -> tuple:
+        net = sum((n + 1) * (10 + i % 50) for n in range(self.lines))
+        return float(net), round(net * 0.23, 2)
+
+    def index_of(self, ksef_number: str):
+        return self._by_number.get(ksef_number)
+
+    def invoice_xml(self, i: int) -> bytes:
+        """Treść faktury FA(2) o numerze porządkowym ``i``."""
+        meta = self._meta[i]
+        unit = 10 + i % 50
+        rows = "".join(
+            f"<FaWiersz><NrWierszaFa>{n + 1}</NrWierszaFa><P_7>Towar {n + 1}</P_7>"
+            f"<P_8A>szt.</P_8A><P_8B>{n + 1}</P_8B><P_9A>{unit}.00</P_9A>"
+            f"<P_11>{(n + 1) * unit}.00</P_11><P_12>23</P_12></FaWiersz>"
+            for n in range(self.lines)
+        )
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<Faktura xmlns="{FA2_NS}">'
+            f'<Naglowek><KodFormularza kodSystemowy="FA (2)" wersjaSchemy="1-0E">FA</KodFormularza>'
+            f"<WariantFormularza>2</WariantFormularza>"
+            f"<DataWytworzeniaFa>{meta['invoicingDate'][:19]}Z</DataWytworzeniaFa>"
+            f"<SystemInfo>ksef_mock</SystemInfo></Naglowek>"
+            f"<Podmiot1><DaneIdentyfikacyjne><NIP>{meta['seller']['nip']}</NIP>"
+            f"<Nazwa>{meta['seller']['name']}</Nazwa></DaneIdentyfikacyjne>"
+            f"<Adres><KodKraju>PL</KodKraju><AdresL1>ul. Testowa {i % 200 + 1}</AdresL1>"
+            f"<AdresL2>00-001 Warszawa</AdresL2></Adres></Podmiot1>"
+            f"<Podmiot2><DaneIdentyfikacyjne><NIP>{self.nip}</NIP>"
+            f"<Nazwa>{meta['buyer']['name']}</Nazwa></DaneIdentyfikacyjne>"
+            f"<Adres><KodKraju>PL</KodKraju><AdresL1>ul. Odbiorcza 1</AdresL1></Adres></Podmiot2>"
+            f"<Fa><KodWaluty>PLN</KodWaluty><P_1>{meta['issueDate']}</P_1><P_1M>Warszawa</P_1M>"
+            f"<P_2>{meta['invoiceNumber']}</P_2>"
+            f"<P_13_1>{meta['netAmount']:.2f}</P_13_1><P_14_1>{meta['vatAmount']:.2f}</P_14_1>"
+            f"<P_15>{meta['grossAmount']:.2f}</P_15>"
+            f"<Adnotacje><P_16>2</P_16><P_17>2</P_17><P_18>2</P_18><P_18A>2</P_18A>"
+            f"<Zwolnienie><P_19N>1</P_19N></Zwolnienie><NoweSrodkiTransportu><P_22N>1</P_22N>"
+            f"</NoweSrodkiTransportu><P_23>2</P_23><PMarzy><P_PMarzyN>1</P_PMarzyN></PMarzy></Adnotacje>"
+            f"<RodzajFaktury>VAT</RodzajFaktury>{rows}"
+            f"<Platnosc><TerminPlatnosci><Termin>{meta['issueDate']}</Termin></TerminPlatnosci>"
+            f"<FormaPlatnosci>6</FormaPlatnosci></Platnosc></Fa></Faktura>"
+        ).encode("utf-8")
+
+    def metadata(self, i: int) -> dict:
+        """Metadane faktury z invoiceHash (SHA-256 XML, Base64) i fileSize."""
+        entry = self._meta[i]
+        if self._hashes[i] is None:
+            content = self.invoice_xml(i)
+            self._hashes[i] = (base64.b64encode(hashlib.sha256(content).digest()).decode(), len(content))
+        invoice_hash, size = self._hashes[i]
+        return dict(entry, invoiceHash=invoice_hash, fileSize=size)
+
+    def query(self, date_type: str, date_from: datetime.datetime, date_to: datetime.datetime,
+              descending: bool = False) -> list:
+        """Numery porządkowe faktur z polem daty w zakresie [from, to], posortowane."""
+        keys, order = self._sorted[date_type]
+        if date_type == "Issue":
+            low, high = date_from.date().isoformat(), date_to.date().isoformat()
+        else:
+            low, high = _iso(date_from), _iso(date_to)
+        found = order[bisect.bisect_left(keys, low):bisect.bisect_right(keys, high)]
+        return found[::-1] if descending else found
+
+    def high_water_mark(self) -> str:
+        """permanentStorageHwmDate — wszystkie faktury korpusu są już utrwalone."""
+        return self._meta[-1]["permanentStorageDate"] if self._meta else None
+
+
+# ---------------------------------------------------------------------------
+# Serwer
+# ---------------------------------------------------------------------------
+
+class MockKSeFServer(ThreadingHTTPServer):
+    """Serwer HTTP udający KSeF 2.0 dla jednego korpusu faktur.
+
+    Błędy wstrzykiwane są tylko na endpointach ``/invoices/*`` —
+    uwierzytelnianie zawsze się udaje (poza ``--auth-delay-ms``), żeby testy
+    obciążeniowe mierzyły pobieranie, a nie pecha przy logowaniu.
+
+    Parametry:
+    - ``latency_ms`` / ``jitter_ms``: opóźnienie każdej odpowiedzi (+ losowe 0..jitter)
+    - ``error_rate``: odsetek odpowiedzi 503 na ``/invoices/*``
+    - ``throttle_rate``: odsetek odpowiedzi 429 na ``/invoices/*``
+    - ``rate_limit``: maks. zapytań/s na endpoint (ponad limit — 429)
+    - ``retry_after``: wartość nagłówka Retry-After przy 429 (sekundy)
+    - ``auth_delay_ms``: jak długo GET /auth/{ref} zwraca status 100
+    - ``result_limit``: limit wyników zapytania (isTruncated)
+    - ``token``: jeśli podany — wymagany token KSeF (inaczej dowolny)
+    - ``export_delay_ms``: jak długo status eksportu pozostaje 100
+    - ``export_part_size``: rozmiar części paczki eksportu (bajty, przed szyfrowaniem)
+
+    Błędy zaplanowane przez ``inject_faults()`` mają pierwszeństwo przed
+    losowymi i dotyczą dowolnego endpointu (także części paczki eksportu).
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        address: tuple,
+        corpus: MockCorpus,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        rate_limit: float = 0.0,
+        retry_after: int = 1,
+        auth_delay_ms: float = 0.0,
+        result_limit: int = QUERY_RESULT_LIMIT,
+        access_ttl: int = ACCESS_TOKEN_TTL_S,
+        token: str = None,
+        seed: int = None,
+        export_delay_ms: float = DEFAULT_EXPORT_DELAY_MS,
+        export_part_size: int = DEFAULT_EXPORT_PART_SIZE,
+    ):
+        super().__init__(address, _MockHandler)
+        self.corpus = corpus
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.auth_delay_ms = auth_delay_ms
+        self.result_limit = result_limit
+        self.access_ttl = access_ttl
+        self.token = token
+        self.export_delay_ms = export_delay_ms
+        self.export_part_size = max(1, export_part_size)
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._challenges = {}
+        self._auth = {}       # referenceNumber → {"token", "started", "redeemed"}
+        self._access = {}     # accessToken → ważny do (time.monotonic)
+        self._refresh = {}    # refreshToken → ważny do (time.monotonic)
+        self._windows = {}    # endpoint → [sekunda, liczba zapytań]
+        self._exports = {}    # referenceNumber → zlecenie eksportu (i gotowa paczka)
+        self._scripted = []   # (prefiks szablonu endpointu, błąd) — inject_faults()
+        self._stats = {}
+        self._thread = None
+
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.certificate_b64, self.certificate_valid = self._token_certificate()
+
+    # ------------------------------------------------------------------
+    # Uruchamianie
+    # ------------------------------------------------------------------
+
+    @property
+    def base_url(self) -> str:
+        """Adres do użycia jako KSEF_LOCAL_URL (z prefiksem /v2)."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    def start(self) -> "MockKSeFServer":
+        """Uruchom serwer w wątku w tle (testy, benchmarki)."""
+        self._thread = threading.Thread(target=self.serve_forever, name="ksef-mock", daemon=True)
+        self._thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # Klient zamknął połączenie keep-alive (np. po 503) — to nie błąd serwera
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logger.debug("Połączenie %s zamknięte przez klienta", client_address)
+            return
+        logger.exception("Błąd obsługi zapytania od %s", client_address)
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    # ------------------------------------------------------------------
+    # Stan
+    # ------------------------------------------------------------------
+
+    def _token_certificate(self) -> tuple:
+        """Samopodpisany certyfikat KsefTokenEncryption (Base64 DER, daty ważności)."""
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "ksef-mock")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        valid_from, valid_to = now - datetime.timedelta(days=1), now + datetime.timedelta(days=365)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(self.private_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(valid_from)
+            .not_valid_after(valid_to)
+            .sign(self.private_key, hashes.SHA256())
+        )
+        der = cert.public_bytes(serialization.Encoding.DER)
+        return base64.b64encode(der).decode(), (valid_from, valid_to)
+
+    def record(self, endpoint: str, status: int) -> None:
+        with self._lock:
+            codes = self._stats.setdefault(endpoint, {})
+            codes[str(status)] = codes.get(str(status), 0) + 1
+
+    def stats(self) -> dict:
+        """Liczniki odpowiedzi {endpoint: {kod HTTP: liczba}}."""
+        with self._lock:
+            return {endpoint: dict(codes) for endpoint, codes in self._stats.items()}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def delay(self) -> None:
+        if self.latency_ms or self.jitter_ms:
+            with self._lock:
+                jitter = self._random.uniform(0, self.jitter_ms)
+            time.sleep((self.latency_ms + jitter) / 1000)
+
+    def inject_faults(self, *faults, endpoint: str = "/invoices/") -> None:
+        """Zaplanuj błędy kolejnych żądań, których szablon endpointu lub ścieżka zaczyna się od ``endpoint``.
+
+        Ścieżka pozwala wskazać konkretny zasób, np.
+        ``/invoices/ksef/{numer}`` — błąd tylko dla tej faktury. Każdy błąd to kod HTTP (np. 429 z Retry-After, 503) albo
+        ``"truncate"`` — odpowiedź z pełnym Content-Length, urwana w połowie
+        treści (zerwane połączenie). Każde pasujące żądanie zużywa jeden błąd.
+        """
+        with self._lock:
+            self._scripted.extend((endpoint, fault) for fault in faults)
+
+    def clear_faults(self) -> None:
+        """Usuń niewykorzystane błędy z ``inject_faults()``."""
+        with self._lock:
+            self._scripted.clear()
+
+    def pending_faults(self) -> int:
+        with self._lock:
+            return len(self._scripted)
+
+    def scripted_fault(self, endpoint: str, path: str = ""):
+        """Pierwszy zaplanowany błąd pasujący do endpointu lub ścieżki (zużywany) albo None."""
+        with self._lock:
+            for n, (prefix, fault) in enumerate(self._scripted):
+                if endpoint.startswith(prefix) or path.startswith(prefix):
+                    del self._scripted[n]
+                    return fault
+        return None
+
+    def fault(self, endpoint: str):
+        """Wstrzyknięty błąd dla zapytania: None, 429 lub 503."""
+        with self._lock:
+            if self.rate_limit:
+                second = int(time.monotonic())
+                window = self._windows.setdefault(endpoint, [second, 0])
+                if window[0] != second:
+                    window[0], window[1] = second, 0
+                window[1] += 1
+                if window[1] > self.rate_limit:
+                    return 429
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def new_challenge(self) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        challenge = f"{now:%Y%m%d}-CR-{uuid.uuid4().hex[:20].upper()}"
+        timestamp_ms = int(now.timestamp() * 1000)
+        with self._lock:
+            self._challenges[challenge] = timestamp_ms
+        return {"challenge": challenge, "timestamp": _iso(now), "timestampMs": timestamp_ms}
+
+    def take_challenge(self, challenge: str):
+        with self._lock:
+            return self._challenges.pop(challenge, None)
+
+    def start_auth(self, method: str) -> dict:
+        reference = f"{datetime.date.today():%Y%m%d}-AU-{uuid.uuid4().hex[:20].upper()}"
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._auth[reference] = {"token": token, "started": time.monotonic(), "method": method,
+                                     "redeemed": False}
+        valid_until = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=15)
+        return {
+            "referenceNumber": reference,
+            "authenticationToken": {"token": token, "validUntil": _iso(valid_until)},
+        }
+
+    def auth_entry(self, bearer: str, reference: str = None):
+        """Operacja uwierzytelniania dla authenticationToken (i numeru referencyjnego)."""
+        with self._lock:
+            for ref, entry in self._auth.items():
+                if entry["token"] == bearer and reference in (None, ref):
+                    return ref, entry
+        return None, None
+
+    def auth_done(self, entry: dict) -> bool:
+        return (time.monotonic() - entry["started"]) * 1000 >= self.auth_delay_ms
+
+    def issue_tokens(self, refresh: bool = True) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        access = uuid.uuid4().hex
+        result = {"accessToken": {"token": access,
+                                  "validUntil": _iso(now + datetime.timedelta(seconds=self.access_ttl))}}
+        with self._lock:
+            self._access[access] = time.monotonic() + self.access_ttl
+            if refresh:
+                refresh_token = uuid.uuid4().hex
+                self._refresh[refresh_token] = time.monotonic() + REFRESH_TOKEN_TTL_S
+                result["refreshToken"] = {
+                    "token": refresh_token,
+                    "validUntil": _iso(now + datetime.timedelta(seconds=REFRESH_TOKEN_TTL_S)),
+                }
+        return result
+
+    def access_valid(self, token: str) -> bool:
+        with self._lock:
+            expires = self._access.get(token)
+        return expires is not None and expires > time.monotonic()
+
+    def refresh_valid(self, token: str) -> bool:
+        with self._lock:
+            expires = self._refresh.get(token)
+        return expires is not None and expires > time.monotonic()
+
+    def redeem(self, entry: dict) -> bool:
+        """Oznacz authenticationToken jako wymieniony; False, jeśli już był."""
+        with self._lock:
+            if entry["redeemed"]:
+                return False
+            entry["redeemed"] = True
+            return True
+
+    def revoke(self, access_token: str) -> None:
+        with self._lock:
+            self._access.pop(access_token, None)
+
+    # ------------------------------------------------------------------
+    # Eksport paczek
+    # ------------------------------------------------------------------
+
+    def start_export(self, invoices: list, truncated: bool, key: bytes, iv: bytes) -> str:
+        reference = f"{datetime.date.today():%Y%m%d}-EX-{uuid.uuid4().hex[:20].upper()}"
+        with self._lock:
+            self._exports[reference] = {"invoices": invoices, "truncated": truncated, "key": key, "iv": iv,
+                                        "started": time.monotonic(), "parts": None}
+        return reference
+
+    def export_entry(self, reference: str):
+        with self._lock:
+            return self._exports.get(reference)
+
+    def export_done(self, entry: dict) -> bool:
+        return (time.monotonic() - entry["started"]) * 1000 >= self.export_delay_ms
+
+    def export_parts(self, entry: dict) -> list:
+        """Zaszyfrowane części paczki (budowane przy pierwszym odczycie): [(część, opis)]."""
+        with self._lock:
+            if entry["parts"] is not None:
+                return entry["parts"]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for i in entry["invoices"]:
+                archive.writestr(f"{self.corpus.metadata(i)['ksefNumber']}.xml", self.corpus.invoice_xml(i))
+            archive.writestr("_metadata.json",
+                             json.dumps({"invoices": [self.corpus.metadata(i) for i in entry["invoices"]]}))
+        package = buffer.getvalue()
+
+        parts = []
+        for offset in range(0, len(package), self.export_part_size):
+            plain = package[offset:offset + self.export_part_size]
+            padder = sym_padding.PKCS7(128).padder()
+            encryptor = Cipher(algorithms.AES(entry["key"]), modes.CBC(entry["iv"])).encryptor()
+            encrypted = encryptor.update(padder.update(plain) + padder.finalize()) + encryptor.finalize()
+            parts.append((encrypted, {
+                "partSize": len(plain),
+                "partHash": base64.b64encode(hashlib.sha256(plain).digest()).decode(),
+                "encryptedPartSize": len(encrypted),
+                "encryptedPartHash": base64.b64encode(hashlib.sha256(encrypted).digest()).decode(),
+            }))
+        with self._lock:
+            entry["parts"] = parts
+            entry["size"] = len(package)
+        return parts
+
+
+# ---------------------------------------------------------------------------
+# Obsługa zapytań
+# ---------------------------------------------------------------------------
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """Routing endpointów KSeF; ścieżki podane bez prefiksu /v2."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "ksef-mock/1.0"
+    # Nagłówki i treść idą osobnymi zapisami — bez TCP_NODELAY keep-alive
+    # czekałby ~40 ms na opóźnione ACK klienta przy każdej odpowiedzi
+    disable_nagle_algorithm = True
+    # Ustawiane w _dispatch dla błędu "truncate" z inject_faults()
+    truncate = False
+
+    # (metoda, ścieżka) → nazwa metody; ścieżki z parametrem w _route()
+    ROUTES = {
+        ("POST", "/auth/challenge"): "_challenge",
+        ("POST", "/auth/ksef-token"): "_ksef_token",
+        ("POST", "/auth/xades-signature"): "_xades_signature",
+        ("POST", "/auth/token/redeem"): "_redeem",
+        ("POST", "/auth/token/refresh"): "_refresh",
+        ("DELETE", "/auth/sessions/current"): "_close_session",
+        ("GET", "/security/public-key-certificates"): "_certificates",
+        ("POST", "/invoices/query/metadata"): "_query_metadata",
+        ("POST", "/invoices/exports"): "_start_export",
+        ("GET", "/mock/stats"): "_mock_stats",
+    }
+    # (metoda, wzorzec ścieżki, szablon endpointu, nazwa metody) — grupy wzorca to argumenty
+    PATTERN_ROUTES = (
+        ("GET", re.compile(r"/invoices/ksef/([^/]+)"), "/invoices/ksef/{ksefNumber}", "_download"),
+        ("GET", re.compile(r"/invoices/exports/([^/]+)"), "/invoices/exports/{referenceNumber}", "_export_status"),
+        ("GET", re.compile(r"/mock/exports/([^/]+)/parts/(\d+)"), "/mock/exports/{referenceNumber}/parts/{n}",
+         "_export_part"),
+        ("GET", re.compile(r"/auth/([^/]+)"), "/auth/{referenceNumber}", "_auth_status"),
+    )
+
+    def log_message(self, fmt, *args):
+        logger.debug("%s %s", self.address_string(), fmt % args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    # ------------------------------------------------------------------
+    # Routing i odpowiedzi
+    # ------------------------------------------------------------------
+
+    def _route(self, method: str, path: str) -> tuple:
+        """(szablon endpointu, nazwa metody, parametry ścieżki) lub (ścieżka, None, ())."""
+        name = self.ROUTES.get((method, path))
+        if name:
+            return path, name, ()
+        for route_method, pattern, template, route_name in self.PATTERN_ROUTES:
+            match = pattern.fullmatch(path)
+            if method == route_method and match:
+                return template, route_name, match.groups()
+        return path, None, ()
+
+    def _dispatch(self, method: str) -> None:
+        parts = urlsplit(self.path)
+        path = parts.path
+        if path.startswith(API_PREFIX + "/"):
+            path = path[len(API_PREFIX):]
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        endpoint, name, params = self._route(method, path)
+        self.endpoint = f"{method} {endpoint}"
+        if name is None:
+            return self._error(404, 21000, f"Nieznany endpoint: {method} {path}")
+
+        self.server.delay()
+        status = self.server.scripted_fault(endpoint, path)
+        if status is None and endpoint.startswith("/invoices/"):
+            status = self.server.fault(endpoint)
+        if status == "truncate":
+            self.truncate = True
+        elif status is not None:
+            if status == 429:
+                return self._error(429, 21999, "Przekroczono limit zapytań",
+                                   headers={"Retry-After": str(self.server.retry_after)})
+            return self._error(status, 21998, "Usługa chwilowo niedostępna")
+
+        getattr(self, name)(*params)
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None) -> None:
+        self.server.record(self.endpoint, status)
+        self.send_response(status)
+        if body or status != 204:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body and self.truncate:
+            # Zerwane połączenie: połowa treści mimo pełnego Content-Length
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        elif body:
+            self.wfile.write(body)
+
+    def _json(self, status: int, data, headers: dict = None) -> None:
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json", headers)
+
+    def _error(self, status: int, code: int, description: str, headers: dict = None) -> None:
+        """Błąd w formacie KSeF (exception.exceptionDetailList)."""
+        self._json(status, {
+            "exception": {
+                "exceptionDetailList": [{"exceptionCode": code, "exceptionDescription": description}],
+                "serviceCode": uuid.uuid4().hex,
+                "timestamp": _iso(datetime.datetime.now(datetime.timezone.utc)),
+            }
+        }, headers)
+
+    def _json_body(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            return None
+
+    def _bearer(self) -> str:
+        value = self.headers.get("Authorization", "")
+        return value[7:] if value.startswith("Bearer ") else ""
+
+    def _require_access(self) -> bool:
+        if self.server.access_valid(self._bearer()):
+            return True
+        self._error(401, 21301, "Brak ważnego accessToken")
+        return False
+
+    # ------------------------------------------------------------------
+    # Uwierzytelnianie
+    # ------------------------------------------------------------------
+
+    def _challenge(self) -> None:
+        self._json(200, self.server.new_challenge())
+
+    def _ksef_token(self) -> None:
+        data = self._json_body() or {}
+        timestamp_ms = self.server.take_challenge(data.get("challenge", ""))
+        if timestamp_ms is None:
+            return self._error(400, 21401, "Nieznany lub wykorzystany challenge")
+        try:
+            plaintext = self.server.private_key.decrypt(
+                base64.b64decode(data.get("encryptedToken", "")),
+                padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
+            ).decode("utf-8")
+        except ValueError:
+            return self._error(400, 21402, "Nie można odszyfrować tokenu")
+        token, _, stamp = plaintext.rpartition("|")
+        if stamp != str(timestamp_ms) or (self.server.token and token != self.server.token):
+            return self._error(400, 21403, "Nieprawidłowy token KSeF")
+        self._json(202, self.server.start_auth("Token"))
+
+    def _xades_signature(self) -> None:
+        # Podpis nie jest weryfikowany — wystarczy znany challenge w dokumencie
+        text = self.body.decode("utf-8", "replace")
+        start, end = text.find("<Challenge>"), text.find("</Challenge>")
+        challenge = text[start + len("<Challenge>"):end] if 0 <= start < end else ""
+        if self.server.take_challenge(challenge) is None:
+            return self._error(400, 21401, "Nieznany lub wykorzystany challenge")
+        self._json(202, self.server.start_auth("QualifiedSignature"))
+
+    def _auth_status(self, reference: str) -> None:
+        ref, entry = self.server.auth_entry(self._bearer(), reference)
+        if entry is None:
+            return self._error(401, 21301, "Nieprawidłowy authenticationToken")
+        started = datetime.datetime.now(datetime.timezone.utc)
+        if self.server.auth_done(entry):
+            status = {"code": 200, "description": "Uwierzytelnianie zakończone sukcesem"}
+        else:
+            status = {"code": 100, "description": "Uwierzytelnianie w toku"}
+        self._json(200, {"startDate": _iso(started), "authenticationMethod": entry["method"], "status": status})
+
+    def _redeem(self) -> None:
+        ref, entry = self.server.auth_entry(self._bearer())
+        if entry is None:
+            return self._error(401, 21301, "Nieprawidłowy authenticationToken")
+        if not self.server.auth_done(entry):
+            return self._error(400, 21304, "Uwierzytelnianie w toku")
+        if not self.server.redeem(entry):
+            return self._error(401, 21301, "authenticationToken został już wykorzystany")
+        self._json(200, self.server.issue_tokens())
+
+    def _refresh(self) -> None:
+        if not self.server.refresh_valid(self._bearer()):
+            return self._error(401, 21301, "Nieprawidłowy refreshToken")
+        self._json(200, self.server.issue_tokens(refresh=False))
+
+    def _close_session(self) -> None:
+        if not self._require_access():
+            return
+        self.server.revoke(self._bearer())
+        self._send(204, b"", "")
+
+    def _certificates(self) -> None:
+        valid_from, valid_to = self.server.certificate_valid
+        self._json(200, [{
+            "certificate": self.server.certificate_b64,
+            "validFrom": _iso(valid_from),
+            "validTo": _iso(valid_to),
+            "usage": ["KsefTokenEncryption", "SymmetricKeyEncryption"],
+        }])
+
+    # ------------------------------------------------------------------
+    # Faktury
+    # ------------------------------------------------------------------
+
+    def _query_metadata(self) -> None:
+        if not self._require_access():
+            return
+        data = self._json_body()
+        date_range = (data or {}).get("dateRange") or {}
+        date_type = date_range.get("dateType")
+        if date_type not in MockCorpus.DATE_FIELDS:
+            return self._error(400, 21405, f"Nieprawidłowy dateType: {date_type}")
+        try:
+            date_from = _parse_datetime(date_range["from"])
+            date_to = _parse_datetime(date_range.get("to") or _iso(datetime.datetime.now(datetime.timezone.utc)))
+            page_size = int(self.query.get("pageSize", 10))
+            page_offset = int(self.query.get("pageOffset", 0))
+        except (KeyError, ValueError) as exc:
+            return self._error(400, 21405, f"Nieprawidłowe zapytanie: {exc}")
+        if not 10 <= page_size <= MAX_PAGE_SIZE or page_offset < 0:
+            return self._error(400, 21405, f"pageSize poza zakresem 10-{MAX_PAGE_SIZE} lub pageOffset < 0")
+
+        corpus = self.server.corpus
+        descending = self.query.get("sortOrder", "Asc").lower() == "desc"
+        found = corpus.query(date_type, date_from, date_to, descending)
+        truncated = len(found) > self.server.result_limit
+        found = found[:self.server.result_limit]
+        page = found[page_offset:page_offset + page_size]
+        self._json(200, {
+            "hasMore": page_offset + page_size < len(found),
+            "isTruncated": truncated,
+            "permanentStorageHwmDate": corpus.high_water_mark(),
+            "invoices": [corpus.metadata(i) for i in page],
+        })
+
+    def _download(self, ksef_number: str) -> None:
+        if not self._require_access():
+            return
+        i = self.server.corpus.index_of(ksef_number)
+        if i is None:
+            return self._error(404, 21164, f"Faktura {ksef_number} nie istnieje")
+        self._send(200, self.server.corpus.invoice_xml(i), "application/octet-stream")
+
+    # ------------------------------------------------------------------
+    # Eksport paczek
+    # ------------------------------------------------------------------
+
+    def _start_export(self) -> None:
+        if not self._require_access():
+            return
+        data = self._json_body() or {}
+        encryption = data.get("encryption") or {}
+        date_range = (data.get("filters") or {}).get("dateRange") or {}
+        date_type = date_range.get("dateType")
+        if date_type not in MockCorpus.DATE_FIELDS:
+            return self._error(400, 21405, f"Nieprawidłowy dateType: {date_type}")
+        try:
+            key = self.server.private_key.decrypt(
+                base64.b64decode(encryption.get("encryptedSymmetricKey", "")),
+                padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
+            )
+            iv = base64.b64decode(encryption.get("initializationVector", ""))
+        except ValueError:
+            return self._error(400, 21402, "Nie można odszyfrować klucza symetrycznego")
+        if len(key) != 32 or len(iv) != 16:
+            return self._error(400, 21402, "Klucz AES-256 (32 B) i IV (16 B) wymagane")
+        try:
+            date_from = _parse_datetime(date_range["from"])
+            date_to = _parse_datetime(date_range.get("to") or _iso(datetime.datetime.now(datetime.timezone.utc)))
+        except (KeyError, ValueError) as exc:
+            return self._error(400, 21405, f"Nieprawidłowe zapytanie: {exc}")
+
+        found = self.server.corpus.query(date_type, date_from, date_to, False)
+        truncated = len(found) > self.server.result_limit
+        reference = self.server.start_export(found[:self.server.result_limit], truncated, key, iv)
+        self._json(201, {"referenceNumber": reference})
+
+    def _export_status(self, reference: str) -> None:
+        if not self._require_access():
+            return
+        entry = self.server.export_entry(reference)
+        if entry is None:
+            return self._error(404, 21175, f"Eksport {reference} nie istnieje")
+        if not self.server.export_done(entry):
+            return self._json(200, {"status": {"code": 100, "description": "Eksport w toku"}},
+                              headers={"Retry-After": str(max(1, round(self.server.export_delay_ms / 1000)))})
+
+        parts = self.server.export_parts(entry)
+        host = self.headers.get("Host") or "{}:{}".format(*self.server.server_address[:2])
+        expires = _iso(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=EXPORT_PART_TTL_S))
+        self._json(200, {
+            "status": {"code": 200, "description": "Eksport zakończony sukcesem"},
+            "completedDate": _iso(datetime.datetime.now(datetime.timezone.utc)),
+            "package": {
+                "invoiceCount": len(entry["invoices"]),
+                "size": entry["size"],
+                "isTruncated": entry["truncated"],
+                "lastPermanentStorageDate": (self.server.corpus.metadata(entry["invoices"][-1])["permanentStorageDate"]
+                                             if entry["invoices"] else None),
+                "parts": [dict(info, ordinalNumber=n, partName=f"{reference}-{n:03d}.zip.aes", method="GET",
+                               url=f"http://{host}/mock/exports/{reference}/parts/{n}", expirationDate=expires)
+                          for n, (_, info) in enumerate(parts, start=1)],
+            },
+        })
+
+    def _export_part(self, reference: str, n: str) -> None:
+        entry = self.server.export_entry(reference)
+        # Części istnieją dopiero po zakończeniu eksportu (status 200)
+        parts = (entry or {}).get("parts") or []
+        if not 1 <= int(n) <= len(parts):
+            return self._error(404, 21175, f"Część {n} eksportu {reference} nie istnieje")
+        self._send(200, parts[int(n) - 1][0], "application/octet-stream")
+
+    def _mock_stats(self) -> None:
+        self._json(200, {"invoices": len(self.server.corpus), "responses": self.server.stats()})
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, corpus: MockCorpus = None, **options) -> MockKSeFServer:
+    """Uruchom MockKSeFServer w wątku w tle; ``port=0`` — wolny port (``server.base_url``)."""
+    return MockKSeFServer((host, port), corpus or MockCorpus(), **options).start()
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _cli() -> None:
+    parser = argparse.ArgumentParser(description="Lokalny serwer udajacy API KSeF 2.0 (testy obciazeniowe)")
+    parser.add_argument("--host", default="127.0.0.1", help="Adres nasluchu (domyslnie: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_MOCK_PORT,
+                        help=f"Port (domyslnie: {DEFAULT_MOCK_PORT})")
+    parser.add_argument("--invoices", type=int, default=DEFAULT_CORPUS_SIZE, metavar="N",
+                        help=f"Liczba faktur w korpusie (domyslnie: {DEFAULT_CORPUS_SIZE})")
+    parser.add_argument("--days", type=int, default=DEFAULT_CORPUS_DAYS,
+                        help=f"Faktury rozlozone w ostatnich N dniach (domyslnie: {DEFAULT_CORPUS_DAYS})")
+    parser.add_argument("--lines", type=int, default=DEFAULT_INVOICE_LINES,
+                        help=f"Pozycji na fakturze — rozmiar XML (domyslnie: {DEFAULT_INVOICE_LINES})")
+    parser.add_argument("--nip", default=DEFAULT_MOCK_NIP, help="NIP nabywcy w korpusie")
+    parser.add_argument("--seed", type=int, default=0, help="Ziarno korpusu i losowania bledow")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Opoznienie kazdej odpowiedzi")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Dodatkowe losowe opoznienie 0..N ms")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Odsetek odpowiedzi 503 na /invoices/* (0-1)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Odsetek odpowiedzi 429 na /invoices/* (0-1)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, metavar="RPS",
+                        help="Limit zapytan/s na endpoint /invoices/* — ponad limit 429 (0 = bez limitu)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After przy 429 w sekundach")
+    parser.add_argument("--auth-delay-ms", type=float, default=0.0,
+                        help="Jak dlugo status uwierzytelniania pozostaje 100")
+    parser.add_argument("--result-limit", type=int, default=QUERY_RESULT_LIMIT,
+                        help=f"Limit wynikow zapytania — isTruncated (domyslnie: {QUERY_RESULT_LIMIT})")
+    parser.add_argument("--access-ttl", type=int, default=ACCESS_TOKEN_TTL_S,
+                        help=f"Waznosc accessToken w sekundach (domyslnie: {ACCESS_TOKEN_TTL_S})")
+    parser.add_argument("--token", help="Wymagany token KSeF (domyslnie dowolny)")
+    parser.add_argument("--export-delay-ms", type=float, default=DEFAULT_EXPORT_DELAY_MS,
+                        help=f"Jak dlugo status eksportu pozostaje 100 (domyslnie: {DEFAULT_EXPORT_DELAY_MS:.0f})")
+    parser.add_argument("--export-part-size", type=int, default=DEFAULT_EXPORT_PART_SIZE, metavar="BAJTY",
+                        help=f"Rozmiar czesci paczki eksportu (domyslnie: {DEFAULT_EXPORT_PART_SIZE})")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    started = time.monotonic()
+    corpus = MockCorpus(args.invoices, args.nip, args.days, args.lines, args.seed)
+    logger.info("Korpus: %d faktur z %d dni (%.1f s)", len(corpus), args.days, time.monotonic() - started)
+
+    try:
+        server = MockKSeFServer(
+            (args.host, args.port), corpus,
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+            rate_limit=args.rate_limit, retry_after=args.retry_after,
+            auth_delay_ms=args.auth_delay_ms, result_limit=args.result_limit,
+            access_ttl=args.access_ttl, token=args.token, seed=args.seed,
+            export_delay_ms=args.export_delay_ms, export_part_size=args.export_part_size,
+        )
+    except OSError as exc:
+        print(f"BLAD: nie mozna uruchomic serwera na {args.host}:{args.port}: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+    # SIGTERM (docker stop) — zamknięcie jak Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info("Mock KSeF: %s (KSEF_LOCAL_URL)", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Mock KSeF zatrzymany")
+
+
+if __name__ == "__main__":
+    _cli()
@@ -11,9 +11,18 @@ Source: https://github.com/call2pedro/KSeF-xml-download
 
 import argparse
 import base64
+import contextlib
 import hashlib
 import io
+import json
+import logging
+import os
+import queue
 import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from decimal import Decimal, InvalidOperation
 from pathlib import Path
 
@@ -43,6 +52,11 @@ try:
 except ImportError:
     HAS_QRCODE = False
 
+try:
+    from ksef_client import InvoiceIndex
+except ImportError:
+    InvoiceIndex = None  # Optional - index written by ksef_client.py
+
 
 # ---------------------------------------------------------------------------
 # Constants
@@ -119,6 +133,11 @@ GENERATOR_LINE_1 = (
 )
 GENERATOR_LINE_2 = "Autor: IT TASK FORCE Piotr Mierzenski - https://ittf.pl"
 
+# Renderer version stamp stored in the PDF manifest. Bump it whenever the
+# layout or parsing changes so that --rebuild-stale re-renders old PDFs.
+RENDERER_VERSION = "1"
+PDF_MANIFEST_FILENAME = ".ksef_pdf_manifest.json"
+
 # Szerokości kolumn tabeli pozycji (mm, None = elastyczna)
 ITEM_COL_WIDTHS = [10, None, 18, 22, 35, 22, 38]
 ITEM_COL_WIDTHS_WALUTA = [10, None, 18, 18, 30, 18, 32, 32]
@@ -566,13 +585,15 @@ def _parse_additional_info(fa, root, ns: dict) -> dict:
     return data
 
 
-def parse_ksef_xml(xml_path: Path) -> dict:
-    """Parse a KSeF XML invoice and return a normalized dict.
+def _parse_ksef_xml_tree(xml_path: "Path | bytes") -> dict:
+    """Parse a KSeF XML invoice with ElementTree ``find()`` lookups.
 
-    Handles FA(1), FA(2), FA(3) schemas - different namespaces, similar structure.
+    Reference implementation for the streaming parse_ksef_xml() - same
+    result, but builds the whole tree first. Kept for the differential
+    check (``ksef_pdf.py compare-parsers``).
 
     Args:
-        xml_path: Path to the KSeF XML invoice file.
+        xml_path: Path to the KSeF XML invoice file, or the raw XML bytes.
 
     Returns:
         Normalized dictionary with invoice data.
@@ -580,8 +601,10 @@ def parse_ksef_xml(xml_path: Path) -> dict:
     Raises:
         ValueError: If the XML namespace is not a known KSeF namespace.
     """
-    tree = SafeET.parse(str(xml_path))
-    root = tree.getroot()
+    if isinstance(xml_path, (bytes, bytearray)):
+        root = SafeET.fromstring(bytes(xml_path), forbid_dtd=True)
+    else:
+        root = SafeET.parse(str(xml_path), forbid_dtd=True).getroot()
 
     # Detect namespace
     root_tag = root.tag
@@ -628,17 +651,354 @@ def parse_ksef_xml(xml_path: Path) -> dict:
     return data
 
 
+# ---------------------------------------------------------------------------
+# XML Parsing — invoice, single-pass streaming engine
+# ---------------------------------------------------------------------------
+
+def _child_index(element, prefix: str) -> dict:
+    """Map local name -> direct children in the ``prefix`` namespace, in one pass."""
+    index: dict = {}
+    for child in element:
+        tag = child.tag
+        if isinstance(tag, str) and tag.startswith(prefix):
+            index.setdefault(tag[len(prefix):], []).append(child)
+    return index
+
+
+def _first(index: dict, name: str):
+    children = index.get(name)
+    return children[0] if children else None
+
+
+def _ctext(index: dict, name: str, default=None):
+    """Text of the first child ``name`` (as _text(), but from a child index)."""
+    el = _first(index, name)
+    if el is not None and el.text:
+        return el.text.strip()
+    return default
+
+
+def _stream_podmiot(idx: dict, prefix: str) -> dict:
+    data = {}
+    dane = _first(idx, "DaneIdentyfikacyjne")
+    if dane is not None:
+        dane_idx = _child_index(dane, prefix)
+        data["nip"] = _ctext(dane_idx, "NIP")
+        data["nazwa"] = _ctext(dane_idx, "Nazwa")
+    adres = _first(idx, "Adres")
+    if adres is not None:
+        adres_idx = _child_index(adres, prefix)
+        data["kod_kraju"] = _ctext(adres_idx, "KodKraju")
+        data["adres_l1"] = _ctext(adres_idx, "AdresL1")
+        data["adres_l2"] = _ctext(adres_idx, "AdresL2")
+    kontakt = _first(idx, "DaneKontaktowe")
+    if kontakt is not None:
+        kontakt_idx = _child_index(kontakt, prefix)
+        data["email"] = _ctext(kontakt_idx, "Email")
+        data["telefon"] = _ctext(kontakt_idx, "Telefon")
+    data["nr_klienta"] = _ctext(idx, "NrKlienta")
+    return data
+
+
+def _stream_podmiot3(idx: dict, prefix: str) -> dict:
+    data = _stream_podmiot(idx, prefix)
+    rola_kod = _ctext(idx, "Rola")
+    if rola_kod:
+        data["rola_kod"] = rola_kod
+        data["rola"] = ROLA_PODMIOT3.get(rola_kod, f"Rola {rola_kod}")
+    else:
+        opis = _ctext(idx, "OpisRoli")
+        if opis:
+            data["rola"] = opis
+            data["rola_kod"] = "inna"
+    data["id_nabywcy"] = _ctext(idx, "IDNabywcy")
+    data["nr_eori"] = _ctext(idx, "NrEORI")
+    data["udzial"] = _ctext(idx, "Udzial")
+    return data
+
+
+def _stream_podmiot_upowazniony(idx: dict, prefix: str) -> dict:
+    data = _stream_podmiot(idx, prefix)
+    rola_kod = _ctext(idx, "RolaPU")
+    if rola_kod:
+        data["rola_kod"] = rola_kod
+        data["rola"] = ROLA_PODMIOTU_UPOWAZNIONEGO.get(rola_kod, f"Rola {rola_kod}")
+    data["nr_eori"] = _ctext(idx, "NrEORI")
+    return data
+
+
+def _stream_header(idx: dict) -> dict:
+    kod_form = _first(idx, "KodFormularza")
+    return {
+        "kod_formularza": kod_form.text if kod_form is not None else None,
+        "kod_systemowy": kod_form.get("kodSystemowy") if kod_form is not None else None,
+        "wersja_schemy": kod_form.get("wersjaSchemy") if kod_form is not None else None,
+        "wariant": _ctext(idx, "WariantFormularza"),
+        "data_wytworzenia": _ctext(idx, "DataWytworzeniaFa"),
+        "system_info": _ctext(idx, "SystemInfo"),
+    }
+
+
+def _stream_wiersz(idx: dict) -> dict:
+    return {
+        "nr": _ctext(idx, "NrWierszaFa"),
+        "nazwa": _ctext(idx, "P_7", ""),
+        "jednostka": _ctext(idx, "P_8A"),
+        "ilosc": _ctext(idx, "P_8B"),
+        "cena_jedn": _ctext(idx, "P_9A"),
+        "cena_jedn_brutto": _ctext(idx, "P_9B"),
+        "wartosc_netto": _ctext(idx, "P_11"),
+        "wartosc_netto_waluta": _ctext(idx, "P_11A"),
+        "stawka_vat": _ctext(idx, "P_12"),
+    }
+
+
+def _stream_fa(idx: dict, prefix: str, wiersze: list) -> dict:
+    """Fa fields from its child index; FaWiersz rows were parsed while streaming."""
+    data: dict = {
+        "waluta": _ctext(idx, "KodWaluty", "PLN"),
+        "data_wystawienia": _ctext(idx, "P_1"),
+        "miejsce_wystawienia": _ctext(idx, "P_1M"),
+        "numer_faktury": _ctext(idx, "P_2"),
+        "data_dostawy": _ctext(idx, "P_6"),
+        "brutto_total": _ctext(idx, "P_15"),
+        "rodzaj_faktury": _ctext(idx, "RodzajFaktury"),
+        "fp": _ctext(idx, "FP"),
+        "tp": _ctext(idx, "TP"),
+        "kurs_waluty": _ctext(idx, "KursWalutyZ"),
+        "korekta_nr": _ctext(idx, "P_3A"),
+        "korekta_data": _ctext(idx, "P_3B"),
+        "korekta_przyczyna": _ctext(idx, "P_3C"),
+        "korekta_nr_ksef": _ctext(idx, "P_3L"),
+        "wiersze": wiersze,
+    }
+    okres = _first(idx, "OkresFa")
+    if okres is not None:
+        okres_idx = _child_index(okres, prefix)
+        data["okres_od"] = _ctext(okres_idx, "P_4A")
+        data["okres_do"] = _ctext(okres_idx, "P_4B")
+
+    vat_summary = []
+    for net_suffix, vat_suffix, rate_label in VAT_RATE_FIELDS:
+        netto = _ctext(idx, f"P_13_{net_suffix}")
+        if netto is not None:
+            vat = _ctext(idx, f"P_14_{vat_suffix}")
+            vat_summary.append({"stawka": rate_label, "netto": netto, "vat": vat or "0.00"})
+    data["vat_summary"] = vat_summary
+
+    adnotacje: dict = {}
+    adnotacje_el = _first(idx, "Adnotacje")
+    if adnotacje_el is not None:
+        adn_idx = _child_index(adnotacje_el, prefix)
+        for field in ["P_16", "P_17", "P_18", "P_18A", "P_23"]:
+            val = _ctext(adn_idx, field)
+            if val:
+                adnotacje[field] = val
+        zwolnienie = _first(adn_idx, "Zwolnienie")
+        if zwolnienie is not None:
+            zw_idx = _child_index(zwolnienie, prefix)
+            p19 = _ctext(zw_idx, "P_19")
+            if p19:
+                adnotacje["P_19"] = p19
+            adnotacje["P_19A"] = _ctext(zw_idx, "P_19A")
+            adnotacje["P_19B"] = _ctext(zw_idx, "P_19B")
+            adnotacje["P_19C"] = _ctext(zw_idx, "P_19C")
+    data["adnotacje"] = adnotacje
+
+    platnosc: dict = {}
+    platnosc_el = _first(idx, "Platnosc")
+    if platnosc_el is not None:
+        pl_idx = _child_index(platnosc_el, prefix)
+        platnosc = {
+            "zaplacono": _ctext(pl_idx, "Zaplacono"),
+            "data_zaplaty": _ctext(pl_idx, "DataZaplaty"),
+            "forma": _ctext(pl_idx, "FormaPlatnosci"),
+            "termin": _ctext(pl_idx, "TerminPlatnosci"),
+        }
+        rachunek = _first(pl_idx, "RachunekBankowy")
+        if rachunek is not None:
+            rb_idx = _child_index(rachunek, prefix)
+            platnosc["nr_rachunku"] = _ctext(rb_idx, "NrRB")
+            platnosc["nazwa_banku"] = _ctext(rb_idx, "NazwaBanku")
+    data["platnosc"] = platnosc
+
+    dodatkowe_opisy = []
+    for do_el in idx.get("DodatkowyOpis", ()):
+        do_idx = _child_index(do_el, prefix)
+        klucz = _ctext(do_idx, "Klucz")
+        wartosc = _ctext(do_idx, "Wartosc")
+        if klucz and wartosc:
+            dodatkowe_opisy.append({"klucz": klucz, "wartosc": wartosc})
+    data["dodatkowy_opis"] = dodatkowe_opisy
+
+    warunki = _first(idx, "WarunkiTransakcji")
+    zamowienia = []
+    if warunki is not None:
+        for zam in _child_index(warunki, prefix).get("Zamowienia", ()):
+            zam_idx = _child_index(zam, prefix)
+            zamowienia.append({"data": _ctext(zam_idx, "DataZamowienia"), "numer": _ctext(zam_idx, "NrZamowienia")})
+    data["zamowienia"] = zamowienia
+    return data
+
+
+def _stream_stopka(idx: dict, prefix: str) -> dict:
+    stopka_data: dict = {}
+    info = _first(idx, "Informacje")
+    if info is not None:
+        stopka_data["tekst"] = _ctext(_child_index(info, prefix), "StopkaFaktury")
+    rejestry = _first(idx, "Rejestry")
+    if rejestry is not None:
+        rej_idx = _child_index(rejestry, prefix)
+        stopka_data["krs"] = _ctext(rej_idx, "KRS")
+        stopka_data["regon"] = _ctext(rej_idx, "REGON")
+        stopka_data["bdo"] = _ctext(rej_idx, "BDO")
+    return stopka_data
+
+
+def parse_ksef_xml(xml_path: "Path | bytes | io.BufferedIOBase") -> dict:
+    """Parse a KSeF XML invoice and return a normalized dict.
+
+    Handles FA(1), FA(2), FA(3) schemas - different namespaces, similar structure.
+
+    Single pass over iterparse events (defusedxml - a KSeF invoice has no
+    DTD, so any DOCTYPE is rejected, and with it entities and external
+    references): every top-level section is converted when it
+    ends and then dropped from the tree, FaWiersz rows one by one, so
+    memory stays flat regardless of the number of lines. Each element's
+    children are indexed once instead of one ``find()`` per field. The
+    namespace is checked on the root tag, so non-invoice XML (e.g. UPO)
+    is rejected before the rest of the file is read. Produces the same
+    dict as the ElementTree-based _parse_ksef_xml_tree().
+
+    Args:
+        xml_path: Path to the KSeF XML invoice file, the raw XML bytes or
+            a binary file object.
+
+    Returns:
+        Normalized dictionary with invoice data.
+
+    Raises:
+        ValueError: If the XML namespace is not a known KSeF namespace.
+    """
+    if isinstance(xml_path, (bytes, bytearray, memoryview)):
+        source = contextlib.nullcontext(io.BytesIO(bytes(xml_path)))
+    elif hasattr(xml_path, "read"):
+        source = contextlib.nullcontext(xml_path)
+    else:
+        source = open(xml_path, "rb")
+
+    data: dict = {}
+    prefix = ""
+    stack: list = []
+    sections: dict = {}  # first top-level section per local name -> parsed dict
+    podmioty3: list = []
+    wiersze: list = []
+    first_fa = None
+
+    with source as fh:
+        for event, elem in SafeET.iterparse(fh, events=("start", "end"), forbid_dtd=True):
+            if event == "start":
+                if not stack:
+                    root_tag = elem.tag
+                    ns_uri = root_tag.split("}")[0].lstrip("{") if "}" in root_tag else ""
+                    if ns_uri not in KSEF_NAMESPACES:
+                        raise ValueError(f"Nieznany namespace KSeF: {ns_uri}")
+                    prefix = "{" + ns_uri + "}"
+                    data["namespace"] = ns_uri
+                elif len(stack) == 1 and first_fa is None and elem.tag == prefix + "Fa":
+                    first_fa = elem
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            depth = len(stack)
+            if depth == 2 and stack[1] is first_fa and elem.tag == prefix + "FaWiersz":
+                wiersze.append(_stream_wiersz(_child_index(elem, prefix)))
+                first_fa.remove(elem)
+            elif depth == 1:
+                name = elem.tag[len(prefix):] if elem.tag.startswith(prefix) else None
+                if name == "Podmiot3":
+                    podmioty3.append(_stream_podmiot3(_child_index(elem, prefix), prefix))
+                elif name is not None and name not in sections:
+                    idx = _child_index(elem, prefix)
+                    if name == "Naglowek":
+                        sections[name] = _stream_header(idx)
+                    elif name in ("Podmiot1", "Podmiot2"):
+                        sections[name] = _stream_podmiot(idx, prefix)
+                    elif name == "PodmiotUpowazniony":
+                        sections[name] = _stream_podmiot_upowazniony(idx, prefix)
+                    elif name == "Fa":
+                        sections[name] = _stream_fa(idx, prefix, wiersze)
+                    elif name == "Stopka":
+                        sections[name] = _stream_stopka(idx, prefix)
+                stack[0].remove(elem)
+
+    data.update(sections.get("Naglowek", {}))
+    data["sprzedawca"] = sections.get("Podmiot1", {})
+    data["nabywca"] = sections.get("Podmiot2", {})
+    if podmioty3:
+        data["podmioty3"] = podmioty3
+    if "PodmiotUpowazniony" in sections:
+        data["podmiot_upowazniony"] = sections["PodmiotUpowazniony"]
+    if "Fa" in sections:
+        data.update(sections["Fa"])
+        data["stopka"] = sections.get("Stopka", {})
+    else:
+        # Ensure keys expected by the renderer are always present
+        data.setdefault("stopka", {})
+    return data
+
+
+def _compare_parsers(paths) -> int:
+    """Differential check: streaming parse_ksef_xml() vs _parse_ksef_xml_tree().
+
+    Both parsers run on every ``*.xml`` file (directories are searched
+    recursively); results, or the exception types for files neither can
+    parse, must be identical.
+
+    Returns:
+        Number of files on which the parsers disagree.
+    """
+    compared = differ = skipped = 0
+    for path in paths:
+        path = Path(path)
+        files = sorted(path.rglob("*.xml")) if path.is_dir() else [path]
+        for xml_path in files:
+            results = []
+            for parser in (_parse_ksef_xml_tree, parse_ksef_xml):
+                try:
+                    results.append(("ok", parser(xml_path)))
+                except Exception as exc:
+                    results.append(("error", type(exc).__name__))
+            tree, stream = results
+            if tree[0] == "error" and tree == stream:
+                skipped += 1
+            elif tree == stream:
+                compared += 1
+            else:
+                differ += 1
+                if tree[0] == stream[0] == "ok":
+                    keys = sorted(k for k in set(tree[1]) | set(stream[1]) if tree[1].get(k) != stream[1].get(k))
+                    print(f"ROZNICA: {xml_path}: {', '.join(keys)}")
+                else:
+                    print(f"ROZNICA: {xml_path}: drzewo={tree[1] if tree[0] == 'error' else 'ok'}, "
+                          f"strumien={stream[1] if stream[0] == 'error' else 'ok'}")
+    print(f"Zgodne: {compared}, rozne: {differ}, pominieto (nie faktura KSeF): {skipped}")
+    return differ
+
+
 # ---------------------------------------------------------------------------
 # XML Parsing — UPO
 # ---------------------------------------------------------------------------
 
-def parse_upo_xml(xml_path: Path) -> dict:
+def parse_upo_xml(xml_path: "Path | bytes | io.BufferedIOBase") -> dict:
     """Parse a KSeF UPO XML and return a normalized dict.
 
     Auto-detects UPO v4.2 and v4.3 namespaces.
 
     Args:
-        xml_path: Path to the UPO XML file.
+        xml_path: Path to the UPO XML file, the raw XML bytes or a binary
+            file object.
 
     Returns:
         Normalized dictionary with UPO data.
@@ -646,8 +1006,12 @@ def parse_upo_xml(xml_path: Path) -> dict:
     Raises:
         ValueError: If the XML namespace is not a known UPO namespace.
     """
-    tree = SafeET.parse(str(xml_path))
-    root = tree.getroot()
+    if isinstance(xml_path, (bytes, bytearray, memoryview)):
+        root = SafeET.fromstring(bytes(xml_path))
+    elif hasattr(xml_path, "read"):
+        root = SafeET.parse(xml_path).getroot()
+    else:
+        root = SafeET.parse(str(xml_path)).getroot()
 
     # Detect namespace
     root_tag = root.tag
@@ -742,19 +1106,34 @@ def _fmt(value, decimals: int = 2) -> str:
 # QR Code generation
 # ---------------------------------------------------------------------------
 
-def _compute_qr_url(xml_path: Path, nip: str, date_str: str) -> str:
+def _compute_qr_url(
+    xml_path: "Path | None",
+    nip: str,
+    date_str: str,
+    sha256: "str | None" = None,
+    xml_bytes: "bytes | None" = None,
+) -> str:
     """Compute verification QR URL from XML file (QR Code I).
 
+    The hash comes from ``sha256`` if given, else from ``xml_bytes``, and
+    only as a last resort from reading ``xml_path``.
+
     Args:
-        xml_path: Path to the XML invoice file.
+        xml_path: Path to the XML invoice file (may be None with sha256 or xml_bytes).
         nip: NIP of the seller.
         date_str: Invoice issue date in YYYY-MM-DD format.
+        sha256: Known SHA-256 of the XML file (hex); skips reading the file.
+        xml_bytes: Raw XML content, hashed instead of reading xml_path.
 
     Returns:
         URL in format https://qr.ksef.mf.gov.pl/invoice/{NIP}/{DD-MM-RRRR}/{hash}
     """
-    raw_bytes = xml_path.read_bytes()
-    sha256_hash = hashlib.sha256(raw_bytes).digest()
+    if sha256:
+        sha256_hash = bytes.fromhex(sha256)
+    elif xml_bytes is not None:
+        sha256_hash = hashlib.sha256(xml_bytes).digest()
+    else:
+        sha256_hash = hashlib.sha256(xml_path.read_bytes()).digest()
     hash_b64url = base64.urlsafe_b64encode(sha256_hash).rstrip(b"=").decode("ascii")
 
     # Convert date YYYY-MM-DD to DD-MM-RRRR
@@ -801,6 +1180,11 @@ def _generate_qr_image(url: str, size: int = 120) -> "Image | None":
 # InvoicePDF — reportlab-based PDF generator for KSeF invoices
 # ---------------------------------------------------------------------------
 
+def _pdf_target(output):
+    """reportlab output: file objects are passed through, paths as str."""
+    return output if hasattr(output, "write") else str(output)
+
+
 class InvoicePDF:
     """Generator PDF faktury KSeF oparty na reportlab."""
 
@@ -809,24 +1193,31 @@ class InvoicePDF:
         data: dict,
         xml_path: "Path | None" = None,
         ksef_nr: "str | None" = None,
+        xml_sha256: "str | None" = None,
+        xml_bytes: "bytes | None" = None,
     ):
         _register_fonts()
         self.data = data
         self.xml_path = xml_path
         self.ksef_nr = ksef_nr
+        # Only the hash of the source XML is needed (QR code) - not the content
+        if xml_sha256 is None and xml_bytes is not None:
+            xml_sha256 = hashlib.sha256(xml_bytes).hexdigest()
+        self.xml_sha256 = xml_sha256
         self.styles = _get_styles()
         self.page_width, self.page_height = A4
         self.margin = 15 * mm
         self.content_width = self.page_width - 2 * self.margin
 
-    def build(self, output_path: Path) -> None:
+    def build(self, output_path: "Path | io.BufferedIOBase") -> None:
         """Build and save the complete PDF invoice.
 
         Args:
-            output_path: Destination path for the PDF file.
+            output_path: Destination path for the PDF file, or a writable
+                binary file object (e.g. ``io.BytesIO``).
         """
         doc = SimpleDocTemplate(
-            str(output_path),
+            _pdf_target(output_path),
             pagesize=A4,
             leftMargin=self.margin,
             rightMargin=self.margin,
@@ -1489,7 +1880,7 @@ class InvoicePDF:
 
     def _render_qr_code(self) -> list:
         """Render QR code with verification URL and clickable link."""
-        if not self.xml_path:
+        if not self.xml_path and not self.xml_sha256:
             return []
 
         d = self.data
@@ -1498,7 +1889,7 @@ class InvoicePDF:
         if not nip or not date_str:
             return []
 
-        qr_url = _compute_qr_url(self.xml_path, nip, date_str)
+        qr_url = _compute_qr_url(self.xml_path, nip, date_str, sha256=self.xml_sha256)
         qr_img = _generate_qr_image(qr_url, size=120)
         if not qr_img:
             return []
@@ -1582,14 +1973,15 @@ class UpoPDF:
         self.margin = 15 * mm
         self.content_width = self.page_width - 2 * self.margin
 
-    def build(self, output_path: Path) -> None:
+    def build(self, output_path: "Path | io.BufferedIOBase") -> None:
         """Build and save the UPO PDF in landscape A4.
 
         Args:
-            output_path: Destination path for the PDF file.
+            output_path: Destination path for the PDF file, or a writable
+                binary file object (e.g. ``io.BytesIO``).
         """
         doc = SimpleDocTemplate(
-            str(output_path),
+            _pdf_target(output_path),
             pagesize=landscape(A4),
             leftMargin=self.margin,
             rightMargin=self.margin,
@@ -1807,33 +2199,112 @@ class UpoPDF:
 
 def generate_invoice_pdf(
     data: dict,
-    output_path: Path,
+    output_path: "Path | io.BufferedIOBase",
     xml_path: "Path | None" = None,
     ksef_nr: "str | None" = None,
+    xml_sha256: "str | None" = None,
+    xml_bytes: "bytes | None" = None,
 ) -> None:
     """Generate a PDF invoice from parsed KSeF data.
 
     Args:
         data: Parsed invoice data dict from parse_ksef_xml().
-        output_path: Destination path for the PDF file.
+        output_path: Destination path for the PDF file, or a writable
+            binary file object.
         xml_path: Optional path to original XML (enables QR code generation).
         ksef_nr: Optional KSeF reference number to display.
+        xml_sha256: Optional known SHA-256 of the XML (hex) used for the QR
+            code instead of hashing xml_path again.
+        xml_bytes: Optional original XML content; enables the QR code
+            without a file on disk.
     """
-    pdf = InvoicePDF(data, xml_path=xml_path, ksef_nr=ksef_nr)
+    pdf = InvoicePDF(
+        data, xml_path=xml_path, ksef_nr=ksef_nr, xml_sha256=xml_sha256, xml_bytes=xml_bytes
+    )
     pdf.build(output_path)
 
 
-def generate_upo_pdf(data: dict, output_path: Path) -> None:
+def generate_upo_pdf(data: dict, output_path: "Path | io.BufferedIOBase") -> None:
     """Generate a UPO PDF from parsed UPO data.
 
     Args:
         data: Parsed UPO data dict from parse_upo_xml().
-        output_path: Destination path for the PDF file.
+        output_path: Destination path for the PDF file, or a writable
+            binary file object.
     """
     pdf = UpoPDF(data)
     pdf.build(output_path)
 
 
+def _build_pdf(
+    xml_bytes: bytes,
+    output,
+    ksef_nr: "str | None" = None,
+    xml_sha256: "str | None" = None,
+    metrics=None,
+) -> None:
+    """Parse XML content and build its PDF into ``output``, auto-detecting invoice vs UPO."""
+    if xml_sha256 is None:
+        xml_sha256 = hashlib.sha256(xml_bytes).hexdigest()
+
+    # Try as invoice first, fall back to UPO
+    try:
+        started = time.monotonic()
+        data = parse_ksef_xml(xml_bytes)
+        parsed = time.monotonic()
+        generate_invoice_pdf(data, output, ksef_nr=ksef_nr, xml_sha256=xml_sha256)
+        if metrics is not None:
+            metrics.observe("ksef_pdf_parse_duration_seconds", parsed - started)
+            metrics.observe("ksef_pdf_render_duration_seconds", time.monotonic() - parsed)
+    except ValueError as e:
+        if "Nieznany" in str(e):
+            # Nie rozpoznano jako faktura KSeF — proba jako UPO
+            generate_upo_pdf(parse_upo_xml(xml_bytes), output)
+        else:
+            raise
+
+
+def render_pdf(
+    xml_bytes: bytes,
+    ksef_nr: "str | None" = None,
+    xml_sha256: "str | None" = None,
+) -> bytes:
+    """Render KSeF invoice or UPO XML content to PDF bytes, without touching disk.
+
+    For callers that already hold the XML in memory (the download
+    pipeline, a web service): the content is parsed once and hashed once
+    for the QR code - or not at all when ``xml_sha256`` is known.
+
+    Args:
+        xml_bytes: Raw XML content (invoice FA(1)/FA(2)/FA(3) or UPO).
+        ksef_nr: Optional KSeF reference number to display on invoices.
+        xml_sha256: Optional known SHA-256 of xml_bytes (hex).
+
+    Returns:
+        The PDF document.
+    """
+    buffer = io.BytesIO()
+    _build_pdf(bytes(xml_bytes), buffer, ksef_nr, xml_sha256)
+    return buffer.getvalue()
+
+
+def render_invoice_pdf(
+    xml_bytes: bytes,
+    ksef_nr: "str | None" = None,
+    xml_sha256: "str | None" = None,
+) -> bytes:
+    """Render KSeF invoice XML content to PDF bytes (QR code from the content hash).
+
+    Raises:
+        ValueError: If the XML is not a KSeF invoice.
+    """
+    xml_bytes = bytes(xml_bytes)
+    buffer = io.BytesIO()
+    generate_invoice_pdf(parse_ksef_xml(xml_bytes), buffer, ksef_nr=ksef_nr,
+                         xml_sha256=xml_sha256, xml_bytes=xml_bytes)
+    return buffer.getvalue()
+
+
 def generate_pdf(xml_path: Path, pdf_path: Path) -> None:
     """Drop-in replacement for backward compatibility.
 
@@ -1843,65 +2314,434 @@ def generate_pdf(xml_path: Path, pdf_path: Path) -> None:
         xml_path: Path to the KSeF XML invoice file.
         pdf_path: Destination path for the PDF file.
     """
-    xml_path = Path(xml_path)
-    pdf_path = Path(pdf_path)
-    data = parse_ksef_xml(xml_path)
-    generate_invoice_pdf(data, pdf_path, xml_path=xml_path)
+    xml_bytes = Path(xml_path).read_bytes()
+    data = parse_ksef_xml(xml_bytes)
+    generate_invoice_pdf(data, Path(pdf_path), xml_bytes=xml_bytes)
+
+
+# ---------------------------------------------------------------------------
+# Download pipeline
+# ---------------------------------------------------------------------------
+
+# reportlab is not documented as thread-safe and rendering holds the GIL
+# anyway - every file render in this process (pipelines, directory runs)
+# takes this lock in _render_xml_file, one document at a time
+_RENDER_LOCK = threading.Lock()
+
+
+class PdfPipeline:
+    """Render PDFs for freshly downloaded invoices while the download runs.
+
+    ksef_client hands every saved XML to ``submit()`` together with the
+    content and SHA-256 captured while writing it; a background worker takes
+    it from a bounded queue, parses it and builds the PDF without reading
+    the file back (only callers that pass no content make it read the file
+    once). PDF cost therefore follows the number of new invoices, not the
+    size of the archive. A full queue blocks ``submit()``, so a slow
+    renderer throttles the downloader instead of buffering without limit.
+
+    Args:
+        ksef_nr: Optional KSeF reference number to display (as --ksef-nr).
+        queue_size: Maximum number of invoices waiting for rendering.
+        logger: Logger for per-invoice results (default: module logger).
+        metrics: Optional ksef_client metrics view (e.g. ``client.metrics``)
+            for parse/render times and queue depth.
+        manifest: Optional PdfManifest of the output directory; updated
+            with every render and saved by ``close()``.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        ksef_nr: "str | None" = None,
+        queue_size: int = 64,
+        logger: "logging.Logger | None" = None,
+        metrics=None,
+        manifest: "PdfManifest | None" = None,
+    ):
+        self.ksef_nr = ksef_nr
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics
+        self.manifest = manifest
+        self.processed = 0
+        self.errors = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        # Started by the first submit(): a pipeline that never receives work
+        # (e.g. authentication failed) leaves no thread behind
+        self._worker: "threading.Thread | None" = None
+        self._worker_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def submit(
+        self,
+        ksef_number: str,
+        xml_path: Path,
+        sha256: "str | None" = None,
+        index=None,
+        xml_bytes: "bytes | None" = None,
+    ) -> None:
+        """Queue one downloaded invoice; ``index`` receives the PDF status.
+
+        ``xml_bytes`` is the content already written to ``xml_path`` - the
+        queue then holds at most ``queue_size`` invoices in memory.
+        """
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="ksef-pdf", daemon=True
+                )
+                self._worker.start()
+        if self.metrics is not None:
+            self.metrics.observe("ksef_queue_depth", self._queue.qsize(), queue="pdf")
+        self._queue.put((ksef_number, Path(xml_path), sha256, index, xml_bytes))
+
+    def close(self) -> None:
+        """Wait until every queued invoice is rendered and stop the worker."""
+        with self._worker_lock:
+            worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(self._STOP)
+            worker.join()
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            ksef_number, xml_path, sha256, index, xml_bytes = item
+            pdf_path = xml_path.with_suffix(".pdf")
+            try:
+                if xml_bytes is None:
+                    xml_bytes = xml_path.read_bytes()
+                if sha256 is None:
+                    sha256 = hashlib.sha256(xml_bytes).hexdigest()
+                pdf_size = _render_xml_file(
+                    xml_path, pdf_path, self.ksef_nr,
+                    xml_bytes=xml_bytes, xml_sha256=sha256,
+                    metrics=self.metrics,
+                )
+            except Exception as exc:
+                self.errors += 1
+                self.logger.error("Blad PDF: %s: %s", xml_path.name, exc)
+                status = "error"
+                if self.manifest is not None:
+                    self.manifest.discard(xml_path)
+            else:
+                if self.manifest is not None:
+                    self.manifest.record(xml_path, sha256, pdf_size)
+                self.processed += 1
+                self.logger.info("PDF: %s -> %s", xml_path.name, pdf_path.name)
+                status = "ok"
+            if index is not None:
+                try:
+                    index.set_pdf_status(ksef_number, status)
+                except Exception as exc:
+                    # The worker must keep draining the queue - submit() blocks on a full one
+                    self.logger.error("Indeks PDF: %s: %s", ksef_number, exc)
+
+
+# ---------------------------------------------------------------------------
+# PDF manifest
+# ---------------------------------------------------------------------------
+
+class PdfManifest:
+    """Record of rendered PDFs in a directory tree (``.ksef_pdf_manifest.json``).
+
+    Each entry, keyed by the XML path relative to the root, holds the
+    SHA-256 of the source XML, the RENDERER_VERSION that produced the PDF
+    and the PDF size. A PDF is stale when any of them no longer matches -
+    the XML changed, the renderer was upgraded, or the file on disk is
+    missing or truncated. ``save()`` replaces the manifest atomically.
+
+    Thread-safe; entries are recorded by the parent process only.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.path = self.root / PDF_MANIFEST_FILENAME
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self._entries = data.get("files", {}) if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _key(self, xml_path: Path) -> str:
+        try:
+            return Path(xml_path).resolve().relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return Path(xml_path).resolve().as_posix()
+
+    def get(self, xml_path: Path) -> "dict | None":
+        with self._lock:
+            return self._entries.get(self._key(xml_path))
+
+    def record(self, xml_path: Path, xml_sha256: str, pdf_size: int) -> None:
+        entry = {"xml_sha256": xml_sha256, "renderer": RENDERER_VERSION, "pdf_size": pdf_size}
+        with self._lock:
+            self._entries[self._key(xml_path)] = entry
+            self._dirty = True
+
+    def discard(self, xml_path: Path) -> None:
+        with self._lock:
+            if self._entries.pop(self._key(xml_path), None) is not None:
+                self._dirty = True
+
+    def is_stale(self, xml_path: Path, xml_sha256: "str | None" = None) -> bool:
+        """True if the PDF next to ``xml_path`` must be rendered again.
+
+        ``xml_sha256`` (hex) skips hashing the XML, e.g. when the invoice
+        index already knows it.
+        """
+        entry = self.get(xml_path)
+        if entry is None or entry.get("renderer") != RENDERER_VERSION:
+            return True
+        try:
+            if Path(xml_path).with_suffix(".pdf").stat().st_size != entry.get("pdf_size"):
+                return True
+            if xml_sha256 is None:
+                xml_sha256 = hashlib.sha256(Path(xml_path).read_bytes()).hexdigest()
+        except OSError:
+            return True
+        return xml_sha256 != entry.get("xml_sha256")
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"renderer": RENDERER_VERSION, "files": self._entries}, indent=1, sort_keys=True)
+            self._dirty = False
+        tmp_path = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex[:12]}.part")
+        try:
+            tmp_path.write_text(data, encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+
+# ---------------------------------------------------------------------------
+# Batch rendering
+# ---------------------------------------------------------------------------
+
+def _init_render_worker() -> None:
+    """Process pool initializer: register fonts and build styles once per worker."""
+    _register_fonts()
+    _get_styles()
+
+
+def _render_job(xml_path: Path, pdf_path: Path, ksef_nr: "str | None") -> tuple:
+    """Render one file in a worker; returns the error message instead of raising.
+
+    Exceptions from reportlab or the parser are not guaranteed to pickle,
+    so only their text crosses the process boundary.
+
+    Returns:
+        ``(error, xml_sha256, pdf_size)``; ``error`` is None on success.
+    """
+    try:
+        xml_bytes = xml_path.read_bytes()
+        xml_sha256 = hashlib.sha256(xml_bytes).hexdigest()
+        pdf_size = _render_xml_file(xml_path, pdf_path, ksef_nr, xml_bytes=xml_bytes, xml_sha256=xml_sha256)
+    except Exception as exc:
+        return str(exc) or type(exc).__name__, None, None
+    return None, xml_sha256, pdf_size
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def generate_pdfs(
+    xml_paths,
+    jobs: int = 0,
+    ksef_nr: "str | None" = None,
+    manifest: "PdfManifest | None" = None,
+):
+    """Render many XML files (invoices or UPO) next to their sources.
+
+    With ``jobs`` > 1 the files are rendered by a process pool, largest
+    first so that one big invoice does not finish alone at the end; each
+    worker registers fonts and builds styles once. ``jobs=0`` uses every
+    CPU, ``jobs=1`` renders in this process in the given order.
+
+    Args:
+        xml_paths: Iterable of XML file paths; each PDF is written to
+            ``xml_path.with_suffix(".pdf")``.
+        jobs: Number of worker processes (0 = ``os.cpu_count()``).
+        ksef_nr: Optional KSeF reference number to display on invoices.
+        manifest: Optional PdfManifest updated with every result (not
+            saved here - call ``manifest.save()`` when done).
+
+    Yields:
+        ``(xml_path, pdf_path, error)`` in completion order; ``error`` is
+        None on success, otherwise the error message.
+    """
+    def result(xml_path: Path, job: tuple) -> tuple:
+        error, xml_sha256, pdf_size = job
+        if manifest is not None:
+            if error is None:
+                manifest.record(xml_path, xml_sha256, pdf_size)
+            else:
+                manifest.discard(xml_path)
+        return xml_path, xml_path.with_suffix(".pdf"), error
+
+    xml_paths = [Path(p) for p in xml_paths]
+    jobs = min(jobs or os.cpu_count() or 1, len(xml_paths))
+    if jobs <= 1:
+        for xml_path in xml_paths:
+            yield result(xml_path, _render_job(xml_path, xml_path.with_suffix(".pdf"), ksef_nr))
+        return
+
+    xml_paths.sort(key=_file_size, reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_render_worker) as pool:
+        futures = {
+            pool.submit(_render_job, xml_path, xml_path.with_suffix(".pdf"), ksef_nr): xml_path
+            for xml_path in xml_paths
+        }
+        for future in as_completed(futures):
+            xml_path = futures[future]
+            yield result(xml_path, future.result())
 
 
 # ---------------------------------------------------------------------------
 # CLI
 # ---------------------------------------------------------------------------
 
+def _render_xml_file(
+    xml_path: Path,
+    pdf_path: Path,
+    ksef_nr: "str | None",
+    xml_bytes: "bytes | None" = None,
+    xml_sha256: "str | None" = None,
+    metrics=None,
+) -> int:
+    """Render one XML file to PDF, auto-detecting invoice vs UPO.
+
+    The file is read once (not at all with ``xml_bytes``) and hashed once
+    for the QR code (not at all with ``xml_sha256``). ``metrics`` (a
+    ksef_client metrics view) receives invoice parse and render times.
+
+    The PDF is built in a temporary file next to ``pdf_path`` and renamed
+    into place, so a crash never leaves a truncated PDF under the final
+    name. The build holds ``_RENDER_LOCK`` for this one document only.
+
+    Returns:
+        Size of the written PDF in bytes.
+    """
+    if xml_bytes is None:
+        xml_bytes = xml_path.read_bytes()
+
+    tmp_path = pdf_path.with_name(f".{pdf_path.name}.{uuid.uuid4().hex[:12]}.part")
+    try:
+        with _RENDER_LOCK, open(tmp_path, "wb") as out:
+            _build_pdf(xml_bytes, out, ksef_nr, xml_sha256, metrics)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, pdf_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return size
+
+
 def _process_directory(
     dir_path: Path,
     skip_existing: bool,
     ksef_nr: "str | None",
+    full_scan: bool = False,
+    jobs: int = 1,
+    rebuild_stale: bool = False,
 ) -> None:
     """Process all XML files in a directory.
 
     Auto-detects invoice vs UPO XML and generates corresponding PDFs.
 
+    When the directory holds an invoice index written by ksef_client.py,
+    the file list and PDF status come from the index instead of a
+    recursive scan, so only invoices without a PDF are visited. The first
+    indexed run scans the tree once and adopts XML files the index does not
+    know (an older archive, files copied in by hand), so they are rendered
+    too.
+
+    Every render is recorded in the directory's PdfManifest. With
+    ``rebuild_stale`` only PDFs the manifest reports as stale (XML
+    changed, older RENDERER_VERSION, PDF missing or of the wrong size)
+    are rendered again.
+
     Args:
         dir_path: Directory containing XML files.
         skip_existing: If True, skip files that already have a PDF.
         ksef_nr: Optional KSeF reference number for invoices.
+        full_scan: If True, ignore the index and scan the directory tree.
+        jobs: Number of worker processes (see generate_pdfs()).
+        rebuild_stale: If True, skip files whose PDF is up to date.
     """
-    xml_files = sorted(dir_path.rglob("*.xml"))
-    if not xml_files:
-        print(f"Brak plikow XML w {dir_path}")
-        return
+    index = None
+    if not full_scan and InvoiceIndex is not None:
+        index = InvoiceIndex.open_existing(dir_path)
 
-    processed = 0
     skipped = 0
-    errors = 0
-
-    for xml_path in xml_files:
-        pdf_path = xml_path.with_suffix(".pdf")
+    if index is not None:
+        adopted = index.adopt_untracked()
+        if adopted:
+            print(f"Dopisano do indeksu {adopted} plikow XML spoza indeksu")
+        entries = index.entries(pdf_pending_only=skip_existing and not rebuild_stale)
+        if skip_existing and not rebuild_stale:
+            skipped = index.count() - len(entries)
+        # XML SHA-256 from the index - the stale check does not hash the files again
+        xml_files = [(index.xml_path(e), e["ksef_number"], e["sha256"]) for e in entries]
+        if not xml_files and not skipped:
+            print(f"Brak plikow XML w {dir_path}")
+    else:
+        xml_files = [(p, None, None) for p in sorted(dir_path.rglob("*.xml"))]
+        if not xml_files:
+            print(f"Brak plikow XML w {dir_path}")
+            return
 
-        if skip_existing and pdf_path.exists():
-            skipped += 1
-            continue
+    processed = 0
+    errors = 0
+    manifest = PdfManifest(dir_path)
 
-        try:
-            # Try as invoice first, fall back to UPO
-            try:
-                data = parse_ksef_xml(xml_path)
-                generate_invoice_pdf(
-                    data, pdf_path, xml_path=xml_path, ksef_nr=ksef_nr
-                )
-            except ValueError as e:
-                if "Nieznany" in str(e):
-                    # Nie rozpoznano jako faktura KSeF — proba jako UPO
-                    data = parse_upo_xml(xml_path)
-                    generate_upo_pdf(data, pdf_path)
-                else:
-                    raise
-            processed += 1
-            print(f"OK: {xml_path.name} -> {pdf_path.name}")
-        except Exception as exc:
-            print(f"Blad: {xml_path.name}: {exc}")
-            errors += 1
+    try:
+        pending = {}
+        for xml_path, indexed_nr, xml_sha256 in xml_files:
+            if rebuild_stale:
+                if not manifest.is_stale(xml_path, xml_sha256):
+                    skipped += 1
+                    continue
+            elif skip_existing and xml_path.with_suffix(".pdf").exists():
+                skipped += 1
+                if indexed_nr is not None:
+                    index.set_pdf_status(indexed_nr, "ok")
+                continue
+            pending[xml_path] = indexed_nr
+
+        # Workers only render; the index and manifest are updated here, in the parent process
+        for xml_path, pdf_path, error in generate_pdfs(pending, jobs, ksef_nr, manifest):
+            indexed_nr = pending[xml_path]
+            if error is None:
+                processed += 1
+                print(f"OK: {xml_path.name} -> {pdf_path.name}")
+            else:
+                print(f"Blad: {xml_path.name}: {error}")
+                errors += 1
+            if indexed_nr is not None:
+                index.set_pdf_status(indexed_nr, "ok" if error is None else "error")
+    finally:
+        manifest.save()
+        if index is not None:
+            index.close()
 
     print(f"Przetworzono: {processed}, pominięto: {skipped}, błędy: {errors}")
 
@@ -1912,7 +2752,7 @@ def _cli() -> None:
     if (
         len(sys.argv) == 3
         and not sys.argv[1].startswith("-")
-        and sys.argv[1] not in ("invoice", "upo")
+        and sys.argv[1] not in ("invoice", "upo", "compare-parsers")
     ):
         xml_path = Path(sys.argv[1])
         pdf_path = Path(sys.argv[2])
@@ -1936,26 +2776,55 @@ def _cli() -> None:
         action="store_true",
         help="Pominij pliki z istniejacym PDF",
     )
+    inv.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="Ignoruj indeks ksef_client i skanuj caly folder",
+    )
+    inv.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Liczba procesow renderujacych dla --dir; 0 = wszystkie rdzenie (domyslnie: 1)",
+    )
+    inv.add_argument(
+        "--rebuild-stale",
+        action="store_true",
+        help="Renderuj ponownie tylko PDF nieaktualne wg manifestu "
+        "(zmieniony XML, nowsza wersja renderera, brakujacy lub uciety PDF)",
+    )
 
     # upo subcommand
     upo_p = subparsers.add_parser("upo", help="Generuj PDF UPO")
     upo_p.add_argument("xml", help="Plik XML UPO")
     upo_p.add_argument("pdf", help="Plik wyjsciowy PDF")
 
+    # compare-parsers subcommand
+    cmp_p = subparsers.add_parser(
+        "compare-parsers",
+        help="Test roznicowy: parser strumieniowy vs ElementTree na korpusie XML",
+    )
+    cmp_p.add_argument("paths", nargs="+", help="Pliki XML lub foldery (przeszukiwane rekurencyjnie)")
+
     args = parser.parse_args()
 
+    if args.command == "compare-parsers":
+        sys.exit(1 if _compare_parsers(args.paths) else 0)
+
     if args.command == "invoice":
         if args.dir:
             _process_directory(
-                Path(args.dir), args.skip_existing, args.ksef_nr
+                Path(args.dir), args.skip_existing, args.ksef_nr, args.full_scan,
+                args.jobs, args.rebuild_stale,
             )
         elif args.xml and args.pdf:
-            data = parse_ksef_xml(Path(args.xml))
+            xml_bytes = Path(args.xml).read_bytes()
             generate_invoice_pdf(
-                data,
+                parse_ksef_xml(xml_bytes),
                 Path(args.pdf),
-                xml_path=Path(args.xml),
                 ksef_nr=args.ksef_nr,
+                xml_bytes=xml_bytes,
             )
         else:
             inv.print_help()
@@ -0,0 +1,606 @@
+"""
+Orkiestrator KSeF - pobieranie faktur i generowanie PDF dla wielu NIP w jednym procesie.
+
+Zastępuje pętlę ``run_download`` z ``linux/entrypoint.sh``: czyta pliki
+``.env`` podatników z katalogu danych (te same reguły co ``parse_env``)
+i przetwarza NIP-y równolegle (``--tenants``). Biblioteki, fonty, pula
+połączeń HTTP, cache certyfikatów KSeF i harmonogram odpytywania
+autoryzacji są ładowane raz i współdzielone przez wszystkich podatników.
+
+Tryb ciągły (``--serve``) zastępuje cron: proces działa stale, sesje KSeF
+pozostają otwarte między przebiegami, a każdy NIP ma własny termin
+synchronizacji przesunięty o losowy odstęp (``--jitter``).
+
+Autor: IT TASK FORCE Piotr Mierzenski - https://ittf.pl
+"""
+
+import argparse
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ksef_client import (
+    DEFAULT_POOL_SIZE,
+    AuthPoller,
+    KSeFClient,
+    KSeFError,
+    Metrics,
+    PublicKeyCache,
+    RateLimiter,
+    RetryPolicy,
+    _build_parser,
+    _close_session,
+    _close_trace,
+    _download_all_invoices,
+    _open_session,
+    _open_trace,
+    new_http_session,
+    parse_rate_limits,
+)
+
+try:
+    import ksef_pdf
+except ImportError:
+    ksef_pdf = None  # Opcjonalne — bez reportlab pobieramy tylko XML
+
+# ---------------------------------------------------------------------------
+# Stałe
+# ---------------------------------------------------------------------------
+
+DEFAULT_DATA_DIR = "/data"
+DEFAULT_TENANT_WORKERS = 4
+# Tryb ciągły: odstęp synchronizacji NIP (min), rozrzut terminów (s),
+# co ile sekund sprawdzać katalog danych (nowe/usunięte NIP-y)
+DEFAULT_SERVE_INTERVAL_MIN = 60
+DEFAULT_SERVE_JITTER_S = 300
+SERVE_RESCAN_S = 60
+ENV_FILENAME = ".env"
+LOGGER_NAME = "ksef_sync"
+
+_ENV_KEY_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_TRUE_VALUES = ("1", "true", "TRUE", "yes", "tak")
+
+
+# ---------------------------------------------------------------------------
+# Logowanie (format jak log()/log_warn()/log_err() w entrypoint.sh)
+# ---------------------------------------------------------------------------
+
+class _LogFormatter(logging.Formatter):
+    """``[RRRR-MM-DD GG:MM:SS] [NIP] UWAGA: ...`` — prefiks NIP dla logów podatnika."""
+
+    LEVEL_PREFIX = {logging.WARNING: "UWAGA: ", logging.ERROR: "BLAD: ", logging.CRITICAL: "BLAD: "}
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = self.LEVEL_PREFIX.get(record.levelno, "") + record.getMessage()
+        if record.name.startswith(LOGGER_NAME + "."):
+            line = f"[{record.name[len(LOGGER_NAME) + 1:]}] {line}"
+        text = f"[{self.formatTime(record, '%Y-%m-%d %H:%M:%S')}] {line}"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+def _setup_logging(verbose: bool, log_file: str = None) -> logging.Logger:
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        try:
+            handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+        except OSError as exc:
+            print(f"UWAGA: Nie mozna otworzyc pliku logu {log_file}: {exc}", file=sys.stderr)
+    for handler in handlers:
+        handler.setFormatter(_LogFormatter())
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, handlers=handlers, force=True)
+    return logging.getLogger(LOGGER_NAME)
+
+
+# ---------------------------------------------------------------------------
+# Konfiguracja podatnika (.env)
+# ---------------------------------------------------------------------------
+
+def _strip_quotes(value: str) -> str:
+    """Usuń otaczające cudzysłowy (podwójne lub pojedyncze)."""
+    for quote in ('"', "'"):
+        if len(value) >= 2 and value[0] == quote and value[-1] == quote:
+            return value[1:-1]
+    return value
+
+
+def parse_env(env_file) -> dict:
+    """Wczytaj pary KLUCZ=WARTOŚĆ z pliku .env (reguły jak ``parse_env`` w entrypoint.sh).
+
+    - linie zaczynające się od # i puste są pomijane,
+    - linia musi zawierać '=', klucz tylko z liter, cyfr i podkreśleń,
+    - wartość może być w cudzysłowach (pojedynczych lub podwójnych),
+    - wartości są literałami — bez rozwijania zmiennych i poleceń.
+    """
+    values = {}
+    with open(env_file, encoding="utf-8") as fh:
+        for raw_line in fh:
+            line = raw_line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, _, val = line.partition("=")
+            if not _ENV_KEY_RE.fullmatch(key):
+                continue
+            values[key] = _strip_quotes(val)
+    return values
+
+
+def _env_flag(value: str) -> bool:
+    return value in _TRUE_VALUES
+
+
+def tenant_client_args(nip_dir: Path, env: dict, logger: logging.Logger) -> tuple:
+    """Zbuduj argumenty ksef_client.py dla katalogu NIP (jak process_nip w entrypoint.sh).
+
+    Returns:
+        (NIP, katalog XML, lista argumentów CLI ksef_client.py)
+
+    Raises:
+        ValueError: niekompletna konfiguracja — komunikat jak w entrypoint.sh
+    """
+    env_file = nip_dir / ENV_FILENAME
+    nip = env.get("CONTEXT_NIP", "")
+    auth_method = env.get("AUTH_METHOD", "")
+
+    if not nip:
+        raise ValueError(f"Brak CONTEXT_NIP w pliku {env_file} - pomijanie katalogu")
+    if not auth_method:
+        raise ValueError(f"Brak AUTH_METHOD w pliku {env_file} (NIP: {nip}) - pomijanie")
+
+    logger.info("Przetwarzanie NIP: %s (metoda: %s)", nip, auth_method)
+
+    xml_dir = Path(env.get("FAKTURY_DIR") or nip_dir / "faktury")
+    default_keyfile = str(nip_dir / "certs" / ".aes_key")
+
+    client_args = [
+        "--nip", nip,
+        "--output-dir", str(xml_dir),
+        "--days", env.get("KSEF_DAYS") or "7",
+        "--env", env.get("KSEF_ENV") or "prod",
+        "--state-dir", str(nip_dir),
+    ]
+
+    # Synchronizacja przyrostowa od zapisanego punktu kontrolnego (opt-in)
+    if _env_flag(env.get("KSEF_INCREMENTAL", "")):
+        client_args.append("--incremental")
+
+    # Zakres dat paczką eksportu KSeF zamiast pojedynczych faktur (opt-in)
+    if _env_flag(env.get("KSEF_EXPORT", "")):
+        client_args.append("--export")
+
+    if auth_method == "token":
+        if env.get("KSEF_TOKEN_ENC"):
+            # Zaszyfrowany token — wymaga pliku klucza
+            keyfile = env.get("TOKEN_KEYFILE") or default_keyfile
+            if not Path(keyfile).is_file():
+                raise ValueError(f"Brak pliku klucza AES: {keyfile} (NIP: {nip})")
+            client_args += ["--token-enc", env["KSEF_TOKEN_ENC"], "--token-keyfile", keyfile]
+        elif env.get("KSEF_TOKEN"):
+            client_args += ["--token", env["KSEF_TOKEN"]]
+        else:
+            raise ValueError(f"AUTH_METHOD=token ale brak KSEF_TOKEN ani KSEF_TOKEN_ENC (NIP: {nip})")
+    elif auth_method == "cert":
+        cert_file = nip_dir / "certs" / "auth_cert.crt"
+        key_file = nip_dir / "certs" / "auth_key.key"
+        if not cert_file.is_file():
+            raise ValueError(f"Brak pliku certyfikatu: {cert_file} (NIP: {nip})")
+        if not key_file.is_file():
+            raise ValueError(f"Brak pliku klucza: {key_file} (NIP: {nip})")
+        client_args += ["--cert", str(cert_file), "--key", str(key_file)]
+        if env.get("KEY_PASSWORD_ENC"):
+            pw_keyfile = env.get("PASSWORD_KEYFILE") or default_keyfile
+            if not Path(pw_keyfile).is_file():
+                raise ValueError(f"Brak pliku klucza AES: {pw_keyfile} (NIP: {nip})")
+            client_args += ["--password-enc", env["KEY_PASSWORD_ENC"], "--password-keyfile", pw_keyfile]
+    else:
+        raise ValueError(f"Nieznana AUTH_METHOD='{auth_method}' (NIP: {nip})")
+
+    # Ślad żądań HTTP do diagnozy wolnych przebiegów (ścieżka względna — w katalogu NIP)
+    if env.get("KSEF_TRACE_FILE"):
+        client_args += ["--trace-file", str(nip_dir / env["KSEF_TRACE_FILE"])]
+
+    # Sesja KSeF między przebiegami (szyfrowana kluczem AES danego NIP)
+    if _env_flag(env.get("KSEF_SESSION_CACHE", "")):
+        session_keyfile = env.get("TOKEN_KEYFILE") or env.get("PASSWORD_KEYFILE") or default_keyfile
+        if Path(session_keyfile).is_file():
+            client_args += ["--session-cache", "--session-keyfile", session_keyfile]
+        else:
+            logger.warning("KSEF_SESSION_CACHE bez pliku klucza AES %s - cache sesji wylaczony",
+                           session_keyfile)
+
+    return nip, xml_dir, client_args
+
+
+# ---------------------------------------------------------------------------
+# Przetwarzanie podatnika
+# ---------------------------------------------------------------------------
+
+def _download_xml(args, logger: logging.Logger, session, auth_poller, public_key_cache, warm: dict = None,
+                  pdf_pipeline=None, metrics: Metrics = None) -> None:
+    """Odpowiednik uruchomienia ksef_client.py, ale na współdzielonych zasobach procesu.
+
+    ``warm`` (tryb --serve): katalog NIP -> (argumenty, klient). Klient z
+    poprzedniego przebiegu jest używany ponownie, dopóki konfiguracja NIP się
+    nie zmieni, a sesja KSeF zostaje otwarta na kolejny przebieg.
+    """
+    client = None
+    if warm is not None:
+        cached = warm.pop(args.state_dir, None)
+        if cached is not None and cached[0] == vars(args):
+            client = cached[1]
+        elif cached is not None:
+            _release_client(cached[1], logger)
+
+    if client is None:
+        client = KSeFClient(
+            nip=args.nip,
+            environment=args.env,
+            logger=logger,
+            rate_limiter=RateLimiter(parse_rate_limits(args.rate_limit)),
+            auth_poller=auth_poller,
+            public_key_cache=public_key_cache,
+            session=session,
+            metrics=metrics,
+        )
+    # Budżet ponowień liczony na przebieg
+    client.retry_policy = RetryPolicy(max_retries=args.retries, budget=args.retry_budget)
+
+    trace_writer = _open_trace(client, args)
+    try:
+        _open_session(client, args, logger)
+        _download_all_invoices(client, args, logger, pdf_pipeline)
+    except BaseException:
+        if warm is not None:
+            _release_client(client, logger)
+        raise
+    finally:
+        _close_trace(client, trace_writer)
+    if warm is None:
+        _close_session(client)
+    else:
+        client._save_session()
+        warm[args.state_dir] = (vars(args), client)
+
+
+def _release_client(client: KSeFClient, logger: logging.Logger) -> None:
+    """Zamknij sesję klienta trybu --serve (zmiana konfiguracji lub zatrzymanie)."""
+    try:
+        _close_session(client)
+    except (KSeFError, OSError) as exc:
+        logger.debug("Zamykanie sesji: %s", exc)
+
+
+def _release_warm_client(warm: dict, state_dir: str, logger: logging.Logger) -> None:
+    """Zwolnij klienta NIP-u usuniętego z harmonogramu (tryb --serve)."""
+    cached = warm.pop(state_dir, None)
+    if cached is not None:
+        _release_client(cached[1], logger)
+
+
+def _generate_pdfs(xml_dir: Path) -> None:
+    # reportlab nie gwarantuje bezpieczeństwa wątkowego — każdy plik jest
+    # renderowany pod ksef_pdf._RENDER_LOCK (wspólną z wątkami PdfPipeline
+    # wszystkich NIP-ów), blokada nie obejmuje całego katalogu
+    ksef_pdf._process_directory(xml_dir, skip_existing=True, ksef_nr=None)
+
+
+def process_tenant(nip_dir: Path, session, auth_poller: AuthPoller, public_key_cache: PublicKeyCache,
+                   warm: dict = None, metrics: Metrics = None) -> bool:
+    """Pobierz XML i wygeneruj PDF dla jednego katalogu NIP.
+
+    Args:
+        warm: klienci z otwartą sesją między przebiegami (tryb --serve)
+        metrics: wspólny rejestr metryk procesu (serie z etykietami NIP)
+
+    Returns:
+        True gdy XML pobrano (błąd PDF nie jest błędem podatnika — jak w entrypoint.sh)
+    """
+    logger = logging.getLogger(f"{LOGGER_NAME}.{nip_dir.name}")
+
+    try:
+        env = parse_env(nip_dir / ENV_FILENAME)
+        nip, xml_dir, client_args = tenant_client_args(nip_dir, env, logger)
+    except (OSError, ValueError) as exc:
+        logger.error("%s", exc)
+        return False
+
+    if not xml_dir.is_dir():
+        logger.info("Tworzenie katalogu faktur: %s", xml_dir)
+        try:
+            xml_dir.mkdir(parents=True, mode=0o755)
+        except OSError:
+            logger.error("Nie mozna utworzyc katalogu %s", xml_dir)
+            return False
+
+    logger.info("Pobieranie XML: %s -> %s", nip, xml_dir)
+    pipeline = None
+    try:
+        args = _build_parser().parse_args(client_args)
+        # PDF nowych faktur powstają w trakcie pobierania; krok "Generowanie PDF"
+        # dopełnia już tylko zaległe pozycje indeksu. Potok opróżnia i zamyka
+        # _download_all_invoices (przed zamknięciem indeksu); wątek PDF startuje
+        # dopiero z pierwszą fakturą, więc błąd przed pobieraniem niczego nie zostawia
+        if ksef_pdf is not None:
+            pdf_metrics = metrics.bind(nip=args.nip, env=args.env) if metrics is not None else None
+            pipeline = ksef_pdf.PdfPipeline(logger=logger, metrics=pdf_metrics,
+                                            manifest=ksef_pdf.PdfManifest(Path(args.output_dir)))
+        _download_xml(args, logger, session, auth_poller, public_key_cache, warm, pipeline, metrics)
+    except SystemExit:
+        # argparse / walidacja ksef_client — komunikat jest już na stderr
+        logger.error("Blad pobierania XML (NIP: %s) - pomijanie generacji PDF", nip)
+        return False
+    except Exception as exc:
+        logger.debug("Szczegoly bledu", exc_info=True)
+        logger.error("Blad pobierania XML (NIP: %s): %s - pomijanie generacji PDF", nip, exc)
+        return False
+    logger.info("Pobieranie XML zakonczone pomyslnie (NIP: %s)", nip)
+
+    if ksef_pdf is None:
+        logger.warning("Brak modulu ksef_pdf (reportlab) - pomijanie generacji PDF (NIP: %s)", nip)
+        return True
+
+    logger.info("Generowanie PDF: %s", xml_dir)
+    try:
+        _generate_pdfs(xml_dir)
+    except Exception as exc:
+        # Błąd PDF nie przerywa — XML zostały pobrane
+        logger.error("Blad generowania PDF (NIP: %s): %s", nip, exc)
+        return True
+    logger.info("Generowanie PDF zakonczone pomyslnie (NIP: %s)", nip)
+    return True
+
+
+def _prepare_pdf() -> None:
+    """Fonty i style PDF rejestrowane raz, przed startem wątków."""
+    if ksef_pdf is not None:
+        ksef_pdf._register_fonts()
+        ksef_pdf._get_styles()
+
+
+def find_tenants(data_dir: Path, logger: logging.Logger = None) -> list:
+    """Katalogi NIP (bezpośrednie podkatalogi ``data_dir``) z plikiem .env.
+
+    Katalogi bez .env są pomijane (z ostrzeżeniem, gdy podano ``logger``).
+    """
+    tenants = []
+    for nip_dir in sorted(p for p in data_dir.iterdir() if p.is_dir()):
+        if not (nip_dir / ENV_FILENAME).is_file():
+            if logger is not None:
+                logger.warning("Brak pliku .env w katalogu %s/ - pomijanie", nip_dir)
+            continue
+        tenants.append(nip_dir)
+    return tenants
+
+
+def run_download(data_dir: Path, tenants: int = DEFAULT_TENANT_WORKERS, logger: logging.Logger = None,
+                 metrics: Metrics = None) -> tuple:
+    """Przetwórz wszystkie katalogi NIP, najwyżej ``tenants`` jednocześnie.
+
+    Returns:
+        (liczba NIP-ów, OK, błędy)
+    """
+    logger = logger or logging.getLogger(LOGGER_NAME)
+    logger.info("Skanowanie katalogu danych: %s", data_dir)
+
+    try:
+        nip_dirs = find_tenants(data_dir, logger)
+    except OSError as exc:
+        logger.error("Nie mozna odczytac katalogu %s: %s", data_dir, exc)
+        nip_dirs = []
+
+    if not nip_dirs:
+        logger.warning("Nie znaleziono zadnych katalogow NIP w %s", data_dir)
+        logger.warning("Utworz podkatalog z plikiem .env, np. %s/1234567890/.env", data_dir)
+        logger.info("Zakonczone przetwarzanie 0 NIP-ow (OK: 0, bledy: 0)")
+        return 0, 0, 0
+
+    _prepare_pdf()
+
+    workers = max(1, min(tenants, len(nip_dirs)))
+    # Wspólne dla wszystkich NIP-ów: pula połączeń, cache certyfikatów KSeF
+    # i czasy autoryzacji (per środowisko); tokeny i limity żądań — per NIP
+    session = new_http_session(DEFAULT_POOL_SIZE * workers)
+    auth_poller = AuthPoller(state_dir=data_dir)
+    public_key_cache = PublicKeyCache(state_dir=data_dir)
+
+    ok_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ksef-nip") as pool:
+            results = pool.map(
+                lambda nip_dir: process_tenant(nip_dir, session, auth_poller, public_key_cache,
+                                               metrics=metrics),
+                nip_dirs,
+            )
+            ok_count = sum(1 for ok in results if ok)
+    finally:
+        session.close()
+
+    fail_count = len(nip_dirs) - ok_count
+    logger.info("Zakonczone przetwarzanie %d NIP-ow (OK: %d, bledy: %d)", len(nip_dirs), ok_count, fail_count)
+    return len(nip_dirs), ok_count, fail_count
+
+
+def _write_metrics(metrics: Metrics, path: str, logger: logging.Logger) -> None:
+    try:
+        metrics.write_textfile(path)
+    except OSError as exc:
+        logger.error("Nie mozna zapisac metryk %s: %s", path, exc)
+
+
+# ---------------------------------------------------------------------------
+# Tryb ciągły (--serve)
+# ---------------------------------------------------------------------------
+
+def serve(
+    data_dir: Path,
+    stop: threading.Event,
+    interval_s: float = DEFAULT_SERVE_INTERVAL_MIN * 60,
+    jitter_s: float = DEFAULT_SERVE_JITTER_S,
+    tenants: int = DEFAULT_TENANT_WORKERS,
+    logger: logging.Logger = None,
+    metrics: Metrics = None,
+    metrics_file: str = None,
+) -> None:
+    """Synchronizuj NIP-y cyklicznie co ``interval_s`` aż do ustawienia ``stop``.
+
+    Każdy NIP dostaje stałe przesunięcie z zakresu [0, ``jitter_s``), więc
+    podatnicy nie odpytują KSeF w tej samej chwili. Termin, w którym
+    poprzedni przebieg danego NIP jeszcze trwa, jest pomijany. Po ``stop``
+    nowe przebiegi nie startują, trwające są dokańczane, a sesje KSeF
+    zamykane (lub zapisywane w cache sesji). ``metrics_file`` jest
+    odświeżany przy każdym wybudzeniu harmonogramu (co najwyżej co minutę).
+    """
+    logger = logger or logging.getLogger(LOGGER_NAME)
+    workers = max(1, tenants)
+    logger.info("Tryb ciagly: synchronizacja co %d min, rozrzut do %d s, NIP-ow jednoczesnie: %d",
+                interval_s // 60, jitter_s, workers)
+
+    _prepare_pdf()
+    session = new_http_session(DEFAULT_POOL_SIZE * workers)
+    auth_poller = AuthPoller(state_dir=data_dir)
+    public_key_cache = PublicKeyCache(state_dir=data_dir)
+    warm = {}
+    # katalog NIP -> {"due": termin (monotonic), "future": trwający przebieg}
+    schedule = {}
+    next_scan = 0.0
+    first_scan = True
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ksef-nip")
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            if now >= next_scan:
+                try:
+                    found = set(find_tenants(data_dir, logger if first_scan else None))
+                except OSError as exc:
+                    logger.error("Nie mozna odczytac katalogu %s: %s", data_dir, exc)
+                    found = set(schedule)
+                if first_scan and not found:
+                    logger.warning("Nie znaleziono zadnych katalogow NIP w %s", data_dir)
+                first_scan = False
+                for nip_dir in sorted(found - set(schedule)):
+                    schedule[nip_dir] = {"due": now + random.uniform(0, jitter_s), "future": None}
+                    logger.info("Harmonogram: %s (pierwszy przebieg za %.0f s)",
+                                nip_dir.name, schedule[nip_dir]["due"] - now)
+                for nip_dir in set(schedule) - found:
+                    logger.info("Harmonogram: usunieto %s (brak katalogu lub .env)", nip_dir.name)
+                    running = schedule.pop(nip_dir)["future"]
+                    if running is None:
+                        _release_warm_client(warm, str(nip_dir), logger)
+                    else:
+                        # Trwający przebieg odkłada klienta do warm dopiero na końcu —
+                        # zwolnienie po jego zakończeniu (od razu, jeśli już się skończył)
+                        running.add_done_callback(
+                            lambda _fut, state_dir=str(nip_dir): _release_warm_client(warm, state_dir, logger))
+                next_scan = now + SERVE_RESCAN_S
+
+            for nip_dir, entry in schedule.items():
+                if now < entry["due"]:
+                    continue
+                # Kolejny termin w tej samej fazie; zaległe terminy przepadają
+                missed = int((now - entry["due"]) // interval_s)
+                entry["due"] += (missed + 1) * interval_s
+                running = entry["future"]
+                if running is not None and not running.done():
+                    logging.getLogger(f"{LOGGER_NAME}.{nip_dir.name}").warning(
+                        "Poprzedni przebieg nadal trwa - pomijanie terminu")
+                    continue
+                entry["future"] = pool.submit(process_tenant, nip_dir, session, auth_poller,
+                                              public_key_cache, warm, metrics)
+
+            if metrics is not None and metrics_file:
+                _write_metrics(metrics, metrics_file, logger)
+
+            wake = min([entry["due"] for entry in schedule.values()] + [next_scan])
+            stop.wait(max(0.0, wake - time.monotonic()))
+    finally:
+        logger.info("Zatrzymywanie trybu ciaglego - oczekiwanie na trwajace przebiegi...")
+        pool.shutdown(wait=True, cancel_futures=True)
+        for state_dir in list(warm):
+            _release_warm_client(warm, state_dir, logging.getLogger(f"{LOGGER_NAME}.{Path(state_dir).name}"))
+        session.close()
+        logger.info("Tryb ciagly zakonczony")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _cli() -> None:
+    parser = argparse.ArgumentParser(
+        description="Orkiestrator KSeF — pobieranie XML i PDF dla wszystkich NIP-ow z katalogu danych",
+    )
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR,
+                        help=f"Katalog z podkatalogami NIP (domyslnie: {DEFAULT_DATA_DIR})")
+    parser.add_argument("--tenants", type=int, metavar="N",
+                        default=int(os.environ.get("KSEF_TENANTS") or DEFAULT_TENANT_WORKERS),
+                        help=f"Ile NIP-ow przetwarzac jednoczesnie (zmienna KSEF_TENANTS, "
+                             f"domyslnie: {DEFAULT_TENANT_WORKERS})")
+    parser.add_argument("--log-file", help="Dopisuj log rowniez do pliku")
+    parser.add_argument("--serve", action="store_true",
+                        help="Tryb ciagly zamiast cron: synchronizacja co --interval minut az do SIGTERM")
+    parser.add_argument("--interval", type=int, metavar="MIN",
+                        default=int(os.environ.get("KSEF_INTERVAL") or DEFAULT_SERVE_INTERVAL_MIN),
+                        help=f"Odstep synchronizacji NIP w trybie --serve (zmienna KSEF_INTERVAL, "
+                             f"domyslnie: {DEFAULT_SERVE_INTERVAL_MIN})")
+    parser.add_argument("--jitter", type=int, metavar="S",
+                        default=int(os.environ.get("KSEF_JITTER") or DEFAULT_SERVE_JITTER_S),
+                        help=f"Maks. losowe przesuniecie terminu NIP w sekundach (zmienna KSEF_JITTER, "
+                             f"domyslnie: {DEFAULT_SERVE_JITTER_S})")
+    parser.add_argument("--metrics-file", metavar="PATH", default=os.environ.get("KSEF_METRICS_FILE") or None,
+                        help="Zapisz metryki Prometheus po przebiegu — textfile collector node_exportera, "
+                             "plik *.prom (zmienna KSEF_METRICS_FILE)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        default=int(os.environ.get("KSEF_METRICS_PORT") or 0) or None,
+                        help="Tryb --serve: metryki Prometheus pod http://:PORT/metrics (zmienna KSEF_METRICS_PORT)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.interval < 1 or args.jitter < 0:
+        print("BLAD: --interval musi byc >= 1, --jitter >= 0", file=sys.stderr)
+        sys.exit(1)
+
+    logger = _setup_logging(args.verbose, args.log_file)
+    metrics = Metrics()
+
+    if not args.serve:
+        try:
+            run_download(Path(args.data_dir), args.tenants, logger, metrics)
+        finally:
+            if args.metrics_file:
+                _write_metrics(metrics, args.metrics_file, logger)
+        return
+
+    stop = threading.Event()
+
+    # SIGTERM od tini (docker stop) i Ctrl+C — tylko flaga, bez logowania w handlerze
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    server = None
+    if args.metrics_port:
+        try:
+            server = metrics.serve(args.metrics_port)
+        except OSError as exc:
+            logger.error("Nie mozna uruchomic serwera metryk na porcie %d: %s", args.metrics_port, exc)
+        else:
+            logger.info("Metryki Prometheus: http://0.0.0.0:%d/metrics", args.metrics_port)
+    try:
+        serve(Path(args.data_dir), stop, args.interval * 60, args.jitter, args.tenants, logger, metrics,
+              args.metrics_file)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if args.metrics_file:
+            _write_metrics(metrics, args.metrics_file, logger)
+
+
+if __name__ == "__main__":
+    _cli()
@@ -0,0 +1,424 @@
+"""
+Benchmark synchronizacji KSeF - ``_download_all_invoices`` na lokalnym serwerze ksef_mock.py.
+
+Każdy scenariusz (wielkość korpusu x profil opóźnień) uruchamia osobny
+proces serwera (ksef_mock.py) i osobny proces klienta, żeby serwer nie
+dzielił GIL z mierzonym kodem, a szczytowe RSS dotyczyło jednego przebiegu.
+
+Mierzone:
+- invoices_per_s — pobrane faktury / czas ``_download_all_invoices``
+- p50_ms, p99_ms — czas pobrania jednej faktury (span ``download`` z trace_hooks,
+  z ponowieniami i oczekiwaniem na limiter)
+- peak_rss_mb — szczytowe RSS procesu klienta
+- io_syscalls_per_invoice — wywołania read/write na fakturę (syscr + syscw
+  z /proc/self/io; bez recv/send gniazd — zapis plików, SQLite)
+- syscalls_per_invoice — wszystkie wywołania systemowe na fakturę, tylko z
+  ``--strace``: dodatkowy przebieg pod ``strace -f -c`` (czasy z niego
+  nie są używane)
+
+Wyniki trafiają do JSON (``--output``), porównanie z ``baselines.json``
+kończy się kodem 1, gdy którykolwiek wskaźnik jest gorszy niż baza
+o więcej niż ``--tolerance`` (p99 — podwójna tolerancja). Bazy zależą od maszyny — po zmianie sprzętu
+odśwież je przez ``--update-baselines``.
+
+Użycie:
+    python bench/bench_sync.py                              # 1k i 10k, profile lan/wan/flaky
+    python bench/bench_sync.py --sizes 100000 --profiles lan
+    python bench/bench_sync.py --update-baselines
+
+Autor: IT TASK FORCE Piotr Mierzenski - https://ittf.pl
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / "app"
+BASELINES_FILE = BENCH_DIR / "baselines.json"
+RESULTS_DIR = BENCH_DIR / "results"
+
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TOLERANCE = 0.25
+MOCK_NIP = "5265877635"
+MOCK_TOKEN = "bench-token"
+MOCK_START_TIMEOUT_S = 300
+
+# Profile opóźnień serwera — opcje ksef_mock.py
+LATENCY_PROFILES = {
+    "lan": {},
+    "wan": {"latency_ms": 20, "jitter_ms": 10},
+    "flaky": {"latency_ms": 20, "jitter_ms": 10, "error_rate": 0.01, "throttle_rate": 0.001, "retry_after": 1},
+}
+
+# Wskaźnik → (kierunek: +1 większy = lepszy, -1 mniejszy = lepszy; mnożnik tolerancji).
+# p99 przy błędach i ponowieniach zależy od losowego jittera backoffu — podwójna tolerancja
+METRICS = {
+    "invoices_per_s": (+1, 1.0),
+    "p50_ms": (-1, 1.0),
+    "p99_ms": (-1, 2.0),
+    "peak_rss_mb": (-1, 1.0),
+    "io_syscalls_per_invoice": (-1, 1.0),
+    "syscalls_per_invoice": (-1, 1.0),
+}
+
+
+def scenario_name(size: int, profile: str) -> str:
+    label = f"{size // 1000}k" if size % 1000 == 0 else str(size)
+    return f"{label}-{profile}"
+
+
+def _percentile(values: list, fraction: float) -> float:
+    """Percentyl metodą najbliższej rangi (wartości posortowane rosnąco)."""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+    return values[rank]
+
+
+def _io_syscalls() -> int:
+    """syscr + syscw bieżącego procesu (0, gdy /proc/self/io niedostępne)."""
+    try:
+        with open("/proc/self/io", encoding="ascii") as fh:
+            counters = dict(line.split(": ") for line in fh.read().splitlines())
+    except (OSError, ValueError):
+        return 0
+    return int(counters.get("syscr", 0)) + int(counters.get("syscw", 0))
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KiB, macOS: bajty
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# ---------------------------------------------------------------------------
+# Proces klienta
+# ---------------------------------------------------------------------------
+
+def run_worker(scenario: dict) -> dict:
+    """Jeden przebieg ``_download_all_invoices`` (w osobnym procesie); zwraca wyniki."""
+    sys.path.insert(0, str(APP_DIR))
+    import ksef_client
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+    logger = logging.getLogger("ksef_client")
+
+    with tempfile.TemporaryDirectory(prefix="ksef-bench-") as output_dir:
+        args = ksef_client._build_parser().parse_args([
+            "--nip", MOCK_NIP,
+            "--token", MOCK_TOKEN,
+            "--env", "local",
+            "--days", str(scenario["days"]),
+            "--output-dir", output_dir,
+            "--concurrency", str(scenario["concurrency"]),
+        ])
+        # Bez budżetów żądań i limitu ponowień — mierzymy kod klienta, nie limiter
+        rate_limits = ksef_client.parse_rate_limits([] if scenario["client_limits"] else
+                                                    ["query=0", "download=0", "auth=0"])
+        client = ksef_client.KSeFClient(
+            nip=args.nip,
+            environment=args.env,
+            logger=logger,
+            pool_size=max(ksef_client.DEFAULT_POOL_SIZE, args.concurrency),
+            rate_limiter=ksef_client.RateLimiter(rate_limits),
+            retry_policy=ksef_client.RetryPolicy(max_retries=args.retries, budget=None),
+            auth_poller=ksef_client.AuthPoller(),
+            public_key_cache=ksef_client.PublicKeyCache(),
+        )
+
+        latencies = []
+        errors = []
+
+        def on_span(span):
+            if span["kind"] != "download":
+                return
+            if span["error"]:
+                errors.append(span["error"])
+            else:
+                latencies.append(span["timings"]["total"])
+
+        client.trace_hooks.append(on_span)
+        ksef_client._open_session(client, args, logger)
+
+        syscalls_before = _io_syscalls()
+        cpu_before = time.process_time()
+        started = time.perf_counter()
+        ksef_client._download_all_invoices(client, args, logger)
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_before
+        syscalls = _io_syscalls() - syscalls_before
+
+        ksef_client._close_session(client)
+        client.close()
+
+    downloaded = len(latencies)
+    latencies.sort()
+    return {
+        "downloaded": downloaded,
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "cpu_s": round(cpu, 3),
+        "invoices_per_s": round(downloaded / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50), 2),
+        "p99_ms": round(_percentile(latencies, 0.99), 2),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "io_syscalls_per_invoice": round(syscalls / downloaded, 1) if downloaded else 0.0,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Scenariusze
+# ---------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _mock_command(port: int, size: int, days: int, profile: dict) -> list:
+    cmd = [sys.executable, str(APP_DIR / "ksef_mock.py"), "--port", str(port),
+           "--invoices", str(size), "--days", str(days), "--token", MOCK_TOKEN]
+    for option, value in profile.items():
+        cmd += [f"--{option.replace('_', '-')}", str(value)]
+    return cmd
+
+
+def _mock_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/mock/stats", timeout=5) as resp:
+        return json.load(resp)
+
+
+def _start_mock(cmd: list, base_url: str) -> subprocess.Popen:
+    """Uruchom ksef_mock.py i poczekaj, aż odpowie (generowanie korpusu trwa)."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + MOCK_START_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"ksef_mock.py zakonczyl sie: {proc.stderr.read().decode(errors='replace')}")
+        try:
+            _mock_stats(base_url)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("ksef_mock.py nie odpowiada")
+
+
+def _strace_total(path: Path) -> int:
+    """Łączna liczba wywołań z podsumowania ``strace -c`` (wiersz ``total``)."""
+    for line in path.read_text(encoding="utf-8", errors="replace").splitlines():
+        fields = line.split()
+        if fields and fields[-1] == "total" and len(fields) >= 4 and re.fullmatch(r"\d+", fields[3]):
+            return int(fields[3])
+    raise RuntimeError(f"Brak podsumowania strace w {path}")
+
+
+def _run_worker_process(scenario: dict, base_url: str, strace_file: Path = None) -> dict:
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--worker", json.dumps(scenario)]
+    if strace_file is not None:
+        cmd = ["strace", "-f", "-c", "-o", str(strace_file)] + cmd
+    proc = subprocess.run(cmd, env=dict(os.environ, KSEF_LOCAL_URL=base_url), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Przebieg {scenario_name(scenario['size'], scenario['profile'])} nieudany:\n"
+                           f"{proc.stderr[-4000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run_scenario(size: int, profile: str, concurrency: int, client_limits: bool, strace: bool,
+                 logger: logging.Logger) -> dict:
+    """Serwer + proces klienta dla jednego scenariusza; wynik z licznikami serwera."""
+    # Zakres --days obejmuje cały korpus (faktury kończą się o północy dziś)
+    days = 60
+    scenario = {"size": size, "profile": profile, "days": days, "concurrency": concurrency,
+                "client_limits": client_limits}
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}/v2"
+    mock = _start_mock(_mock_command(port, size, days, LATENCY_PROFILES[profile]), base_url)
+    try:
+        result = _run_worker_process(scenario, base_url)
+        server = _mock_stats(base_url)["responses"]
+        if strace:
+            # Osobny przebieg — strace spowalnia klienta, więc liczymy tylko wywołania
+            with tempfile.TemporaryDirectory(prefix="ksef-bench-") as tmp:
+                strace_file = Path(tmp) / "strace.txt"
+                traced = _run_worker_process(scenario, base_url, strace_file)
+                if traced["downloaded"]:
+                    result["syscalls_per_invoice"] = round(_strace_total(strace_file) / traced["downloaded"], 1)
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+    downloads = server.get("GET /invoices/ksef/{ksefNumber}", {})
+    result["server"] = {
+        "requests": sum(sum(codes.values()) for codes in server.values()),
+        "http_429": sum(codes.get("429", 0) for codes in server.values()),
+        "http_503": sum(codes.get("503", 0) for codes in server.values()),
+    }
+    if result["downloaded"] != size or downloads.get("200", 0) < size:
+        logger.warning("%s: pobrano %d z %d faktur (bledy: %d)",
+                       scenario_name(size, profile), result["downloaded"], size, result["errors"])
+    return dict(scenario, **result)
+
+
+# ---------------------------------------------------------------------------
+# Bazy odniesienia
+# ---------------------------------------------------------------------------
+
+def compare(results: dict, baselines: dict, tolerance: float) -> list:
+    """Lista regresji: (scenariusz, wskaźnik, wynik, baza, tolerancja)."""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if not baseline:
+            continue
+        for metric, (direction, factor) in METRICS.items():
+            value, base = result.get(metric), baseline.get(metric)
+            if value is None or not base:
+                continue
+            limit = tolerance * factor
+            worse = value < base * (1 - limit) if direction > 0 else value > base * (1 + limit)
+            if worse:
+                regressions.append((name, metric, value, base, limit))
+    return regressions
+
+
+def _load_baselines(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8")).get("scenarios", {})
+
+
+def _save_baselines(path: Path, results: dict) -> None:
+    scenarios = _load_baselines(path)
+    for name, result in results.items():
+        scenarios[name] = {metric: result[metric] for metric in METRICS if metric in result}
+    payload = {
+        "updated": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "machine": f"{platform.machine()} {os.cpu_count()} CPU, Python {platform.python_version()}",
+        "scenarios": dict(sorted(scenarios.items())),
+    }
+    path.write_text(json.dumps(payload, indent=2) + "\n", encoding="utf-8")
+
+
+def _print_table(results: dict, baselines: dict) -> None:
+    print(f"{'scenariusz':<14} {'faktur/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>7} {'io sys/f':>8}"
+          f" {'sys/f':>7} {'429':>5} {'503':>5}  baza faktur/s")
+    for name, r in results.items():
+        base = baselines.get(name, {}).get("invoices_per_s")
+        print(f"{name:<14} {r['invoices_per_s']:>9.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+              f" {r['peak_rss_mb']:>7.1f} {r['io_syscalls_per_invoice']:>8.1f}"
+              f" {r.get('syscalls_per_invoice', '-'):>7}"
+              f" {r['server']['http_429']:>5} {r['server']['http_503']:>5}  {base if base else '-'}")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _cli() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark synchronizacji KSeF na lokalnym ksef_mock.py")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="Wielkosci korpusu po przecinku (domyslnie: 1000,10000; pelny zestaw: 1000,10000,100000)")
+    parser.add_argument("--profiles", default=",".join(LATENCY_PROFILES),
+                        help=f"Profile opoznien po przecinku: {', '.join(LATENCY_PROFILES)}")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"--concurrency klienta (domyslnie: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--client-limits", action="store_true",
+                        help="Zostaw domyslne budzety zadan klienta (RateLimiter) zamiast je wylaczac")
+    parser.add_argument("--strace", action="store_true",
+                        help="Dodatkowy przebieg pod strace -f -c: wszystkie wywolania systemowe na fakture")
+    parser.add_argument("--output", help="Plik JSON z wynikami (domyslnie: bench/results/bench-DATA.json)")
+    parser.add_argument("--baselines", default=str(BASELINES_FILE),
+                        help="Plik baz odniesienia (domyslnie: bench/baselines.json)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Dopuszczalne pogorszenie wzgledem bazy (domyslnie: {DEFAULT_TOLERANCE})")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Zapisz wyniki jako nowe bazy zamiast porownywac")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker))))
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    logger = logging.getLogger("bench_sync")
+
+    try:
+        sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    except ValueError:
+        print(f"BLAD: nieprawidlowe --sizes: {args.sizes}", file=sys.stderr)
+        sys.exit(2)
+    profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+    unknown = [p for p in profiles if p not in LATENCY_PROFILES]
+    if unknown:
+        print(f"BLAD: nieznane profile: {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(2)
+    if args.strace and not shutil.which("strace"):
+        print("BLAD: --strace wymaga programu strace", file=sys.stderr)
+        sys.exit(2)
+
+    results = {}
+    for size in sizes:
+        for profile in profiles:
+            name = scenario_name(size, profile)
+            logger.info("Scenariusz %s...", name)
+            try:
+                results[name] = run_scenario(size, profile, args.concurrency, args.client_limits, args.strace,
+                                             logger)
+            except RuntimeError as exc:
+                logger.error("%s", exc)
+                sys.exit(2)
+            logger.info("%s: %.1f faktur/s, p99 %.1f ms", name, results[name]["invoices_per_s"],
+                        results[name]["p99_ms"])
+
+    baselines_path = Path(args.baselines)
+    baselines = _load_baselines(baselines_path)
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"bench-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "machine": f"{platform.machine()} {os.cpu_count()} CPU, Python {platform.python_version()}",
+        "tolerance": args.tolerance,
+        "scenarios": results,
+    }, indent=2) + "\n", encoding="utf-8")
+
+    print()
+    _print_table(results, baselines)
+    print(f"\nWyniki: {output}")
+
+    if args.update_baselines:
+        _save_baselines(baselines_path, results)
+        print(f"Bazy zapisane: {baselines_path}")
+        return
+
+    incomplete = [name for name, r in results.items() if r["downloaded"] != r["size"]]
+    regressions = compare(results, baselines, args.tolerance)
+    for name, metric, value, base, limit in regressions:
+        print(f"REGRESJA {name}: {metric} = {value} (baza {base}, tolerancja {limit:.0%})")
+    for name in incomplete:
+        print(f"NIEKOMPLETNE {name}: pobrano {results[name]['downloaded']} z {results[name]['size']}")
+    if regressions or incomplete:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    _cli()
@@ -4,6 +4,7 @@
 #
 # Modes:
 #   (no args)  - configure crontab, run initial download, then exec cron -f
+#                (KSEF_MODE=daemon: exec ksef_sync.py --serve instead of cron)
 #   --once     - run download once and exit
 
 set -euo pipefail
@@ -28,6 +29,12 @@ APP_DIR="/app"
 DATA_DIR="/data"
 LOG_FILE="${DATA_DIR}/ksef-download.log"
 KSEF_CRON="${KSEF_CRON:-0 * * * *}"
+# KSEF_TENANTS - how many NIPs ksef_sync.py processes at once (default: 4)
+# KSEF_MODE    - cron (default) or daemon (in-process scheduler, KSEF_INTERVAL
+#                minutes between syncs of a NIP, start spread by KSEF_JITTER seconds)
+# KSEF_METRICS_FILE - Prometheus textfile written after each run (e.g. /data/metrics/ksef.prom)
+# KSEF_METRICS_PORT - daemon mode: serve Prometheus metrics on http://:PORT/metrics
+KSEF_MODE="${KSEF_MODE:-cron}"
 
 # Virtualenv installed in /venv (see Dockerfile)
 export PATH="/venv/bin:${PATH}"
@@ -138,7 +145,8 @@ process_nip() {
     # Read .env into local variables using the safe parser
     local CONTEXT_NIP="" AUTH_METHOD="" KSEF_TOKEN="" KSEF_TOKEN_ENC=""
     local FAKTURY_DIR="" KEY_PASSWORD_ENC="" KSEF_DAYS="" KSEF_ENV=""
-    local TOKEN_KEYFILE="" PASSWORD_KEYFILE=""
+    local TOKEN_KEYFILE="" PASSWORD_KEYFILE="" KSEF_INCREMENTAL="" KSEF_SESSION_CACHE=""
+    local KSEF_EXPORT=""
 
     eval "$(parse_env "${env_file}")"
 
@@ -182,8 +190,19 @@ process_nip() {
     client_args+=(--output-dir "${xml_dir}")
     client_args+=(--days "${KSEF_DAYS:-7}")
     client_args+=(--env "${KSEF_ENV:-prod}")
+    client_args+=(--state-dir "${nip_dir}")
     client_args+=(-v)
 
+    # Incremental sync from the stored PermanentStorage checkpoint (opt-in)
+    case "${KSEF_INCREMENTAL:-}" in
+        1|true|TRUE|yes|tak) client_args+=(--incremental) ;;
+    esac
+
+    # Date range as a KSeF export package instead of per-invoice downloads (opt-in)
+    case "${KSEF_EXPORT:-}" in
+        1|true|TRUE|yes|tak) client_args+=(--export) ;;
+    esac
+
     case "${AUTH_METHOD}" in
         token)
             if [ -n "${KSEF_TOKEN_ENC:-}" ]; then
@@ -231,6 +250,18 @@ process_nip() {
             ;;
     esac
 
+    # Reuse the KSeF session between runs (encrypted with the NIP's AES key)
+    case "${KSEF_SESSION_CACHE:-}" in
+        1|true|TRUE|yes|tak)
+            local session_keyfile="${TOKEN_KEYFILE:-${PASSWORD_KEYFILE:-${nip_dir}/certs/.aes_key}}"
+            if [ -f "${session_keyfile}" ]; then
+                client_args+=(--session-cache --session-keyfile "${session_keyfile}")
+            else
+                log_warn "KSEF_SESSION_CACHE bez pliku klucza AES ${session_keyfile} - cache sesji wylaczony"
+            fi
+            ;;
+    esac
+
     # ------------------------------------------------------------------
     # Run ksef_client.py (as ksef user)
     # ------------------------------------------------------------------
@@ -258,11 +289,46 @@ process_nip() {
 }
 
 # ---------------------------------------------------------------------------
-# run_download() - iterate over all NIP directories in /data and process each.
+# ksef_sync.py arguments shared by run_download() and run_daemon()
+# ---------------------------------------------------------------------------
+SYNC_ARGS=(--data-dir "${DATA_DIR}" --log-file "${LOG_FILE}" -v)
+[ -n "${KSEF_TENANTS:-}" ] && SYNC_ARGS+=(--tenants "${KSEF_TENANTS}")
+[ -n "${KSEF_INTERVAL:-}" ] && SYNC_ARGS+=(--interval "${KSEF_INTERVAL}")
+[ -n "${KSEF_JITTER:-}" ] && SYNC_ARGS+=(--jitter "${KSEF_JITTER}")
+[ -n "${KSEF_METRICS_FILE:-}" ] && SYNC_ARGS+=(--metrics-file "${KSEF_METRICS_FILE}")
+[ -n "${KSEF_METRICS_PORT:-}" ] && SYNC_ARGS+=(--metrics-port "${KSEF_METRICS_PORT}")
+
+# ---------------------------------------------------------------------------
+# run_download() - process all NIP directories in /data.
+# ksef_sync.py reads every <NIP>/.env with the same rules as parse_env() and
+# handles the NIPs in one Python process (KSEF_TENANTS at a time); it logs the
+# same per-NIP lines and the final OK/error summary as process_nip() did.
 # ---------------------------------------------------------------------------
 run_download() {
     fix_ownership
 
+    runuser -u ksef -- python "${APP_DIR}/ksef_sync.py" "${SYNC_ARGS[@]}" \
+        || log_err "Orkiestrator ksef_sync.py zakonczyl sie bledem"
+}
+
+# ---------------------------------------------------------------------------
+# run_daemon() - replace this shell with ksef_sync.py --serve (as ksef user).
+# tini delivers SIGTERM to runuser, which forwards it to Python; in-progress
+# NIP syncs are finished and KSeF sessions closed before the container stops.
+# ---------------------------------------------------------------------------
+run_daemon() {
+    fix_ownership
+
+    exec runuser -u ksef -- python "${APP_DIR}/ksef_sync.py" --serve "${SYNC_ARGS[@]}"
+}
+
+# ---------------------------------------------------------------------------
+# run_download_legacy() - previous per-NIP loop (one interpreter per step).
+# Kept for KSEF_LEGACY_LOOP=1 until the orchestrator has been in use for a while.
+# ---------------------------------------------------------------------------
+run_download_legacy() {
+    fix_ownership
+
     local nip_count=0
     local ok_count=0
     local fail_count=0
@@ -298,6 +364,16 @@ run_download() {
     log "Zakonczone przetwarzanie ${nip_count} NIP-ow (OK: ${ok_count}, bledy: ${fail_count})"
 }
 
+# ---------------------------------------------------------------------------
+# download() - orchestrator by default, legacy loop with KSEF_LEGACY_LOOP=1
+# ---------------------------------------------------------------------------
+download() {
+    case "${KSEF_LEGACY_LOOP:-}" in
+        1|true|TRUE|yes|tak) run_download_legacy ;;
+        *) run_download ;;
+    esac
+}
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
@@ -305,17 +381,26 @@ main() {
     if [ "${1:-}" = "--once" ]; then
         # Single-run mode - execute download and exit
         log "Tryb jednorazowy (--once)"
-        run_download
+        download
+    elif [ "${KSEF_MODE}" = "daemon" ]; then
+        # In-process scheduler - no cron, warm sessions between syncs
+        log "Tryb ciagly (KSEF_MODE=daemon): co ${KSEF_INTERVAL:-60} min"
+        run_daemon
     else
         # Cron daemon mode
         log "Konfiguracja harmonogramu: ${KSEF_CRON}"
 
         # Register cron job as root - the script itself handles privilege separation
         # via runuser, so running as root here is intentional
-        echo "${KSEF_CRON} /entrypoint.sh --once >> ${LOG_FILE} 2>&1" | crontab -
+        # cron starts jobs with an empty environment - pass the orchestrator settings along
+        local cron_env=""
+        [ -n "${KSEF_TENANTS:-}" ] && cron_env+="KSEF_TENANTS=${KSEF_TENANTS} "
+        [ -n "${KSEF_LEGACY_LOOP:-}" ] && cron_env+="KSEF_LEGACY_LOOP=${KSEF_LEGACY_LOOP} "
+        [ -n "${KSEF_METRICS_FILE:-}" ] && cron_env+="KSEF_METRICS_FILE=${KSEF_METRICS_FILE} "
+        echo "${KSEF_CRON} ${cron_env}/entrypoint.sh --once >> ${LOG_FILE} 2>&1" | crontab -
 
         log "Pierwsze uruchomienie..."
-        run_download || true
+        download || true
 
         log "Cron aktywny - oczekiwanie na harmonogram (${KSEF_CRON})"
         exec cron -f
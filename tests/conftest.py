@@ -0,0 +1,93 @@
+"""Wspólna konfiguracja testów: moduły aplikacji z katalogu app/ (jak w Dockerze).
+
+Fixture'y do testów z serwerem ksef_mock: ``start_mock`` (serwer na wolnym
+porcie, zatrzymywany po teście), ``make_client`` (klient uwierzytelniony
+w mocku, bez limitów i z szybkim ponawianiem) oraz ``make_args`` (argumenty
+CLI ksef_client z katalogiem wyjściowym w ``tmp_path``).
+"""
+
+import datetime
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+
+if str(APP_DIR) not in sys.path:
+    sys.path.insert(0, str(APP_DIR))
+
+import ksef_client  # noqa: E402
+import ksef_mock  # noqa: E402
+
+# Ponowienia w testach bez realnego czekania (jitter do 1 ms)
+FAST_RETRY = {"max_retries": 3, "base_delay": 0.001, "max_delay": 0.001, "budget": 100}
+
+
+@pytest.fixture
+def start_mock():
+    """Fabryka serwerów ksef_mock: ``start_mock(size=..., days=..., **opcje serwera)``.
+
+    Korpus kończy się o północy UTC dzisiejszego dnia; ``days`` i ``size``
+    trafiają do MockCorpus, pozostałe argumenty do MockKSeFServer.
+    """
+    servers = []
+
+    def _start(size: int = 20, days: int = 5, lines: int = 2, end_date: datetime.date = None, **options):
+        corpus = ksef_mock.MockCorpus(size=size, days=days, lines=lines, end_date=end_date)
+        options.setdefault("seed", 0)
+        server = ksef_mock.start_mock_server(corpus=corpus, **options)
+        servers.append(server)
+        return server
+
+    yield _start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def make_client():
+    """Fabryka klientów KSeFClient uwierzytelnionych tokenem w podanym mocku."""
+    clients = []
+
+    def _make(server, authenticate: bool = True, rate_limiter: ksef_client.RateLimiter = None, **retry):
+        client = ksef_client.KSeFClient(
+            ksef_mock.DEFAULT_MOCK_NIP,
+            environment="local",
+            rate_limiter=rate_limiter or ksef_client.RateLimiter({}),
+            retry_policy=ksef_client.RetryPolicy(**dict(FAST_RETRY, **retry)),
+            # Każdy mock ma własny certyfikat — bez współdzielonego cache kluczy
+            public_key_cache=ksef_client.PublicKeyCache(),
+        )
+        client.base_url = server.base_url
+        clients.append(client)
+        if authenticate:
+            client.authenticate_token("token-testowy")
+        return client
+
+    yield _make
+    for client in clients:
+        client.close()
+
+
+@pytest.fixture
+def make_args(tmp_path):
+    """Argumenty CLI ksef_client (``--nip`` mocka, ``--output-dir`` w tmp_path) plus ``argv``.
+
+    Pozostałe opcje z wartościami domyślnymi CLI — w tym ``--prefetch``
+    (strony metadanych pobierane w wątku w tle).
+    """
+
+    def _make(*argv):
+        base = ["--nip", ksef_mock.DEFAULT_MOCK_NIP, "--env", "local", "--token", "token-testowy",
+                "--output-dir", str(tmp_path / "faktury")]
+        return ksef_client._build_parser().parse_args(base + list(argv))
+
+    return _make
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("ksef_test")
@@ -0,0 +1,214 @@
+"""AsyncKSeFClient (asyncio + httpx) z serwerem mock."""
+
+import asyncio
+import datetime
+import threading
+
+import pytest
+
+import ksef_client
+import ksef_mock
+from conftest import FAST_RETRY
+
+
+def _run(server, scenario, authenticate: bool = True, retry: dict = None, **options):
+    """Uruchom ``scenario(client)`` z klientem asynchronicznym uwierzytelnionym w mocku."""
+    options.setdefault("public_key_cache", ksef_client.PublicKeyCache())
+
+    async def _main():
+        async with ksef_client.AsyncKSeFClient(
+            ksef_mock.DEFAULT_MOCK_NIP,
+            environment="local",
+            rate_limiter=ksef_client.RateLimiter({}),
+            retry_policy=ksef_client.RetryPolicy(**dict(FAST_RETRY, **(retry or {}))),
+            **options,
+        ) as client:
+            client.base_url = server.base_url
+            if authenticate:
+                await client.authenticate_token("token-testowy")
+            return await scenario(client)
+
+    return asyncio.run(_main())
+
+
+def test_token_authentication(start_mock):
+    server = start_mock()
+
+    async def scenario(client):
+        assert client.access_token is None
+        await client.authenticate_token("token-testowy")
+        return client.access_token, client.refresh_token
+
+    access_token, refresh_token = _run(server, scenario, authenticate=False)
+
+    assert access_token and refresh_token
+    stats = server.stats()
+    assert stats["POST /auth/ksef-token"] == {"202": 1}
+    assert stats["POST /auth/token/redeem"] == {"200": 1}
+
+
+def test_rejected_token(start_mock):
+    server = start_mock(token="token-testowy")
+
+    async def scenario(client):
+        await client.authenticate_token("zly-token")
+
+    with pytest.raises(ksef_client.KSeFError):
+        _run(server, scenario, authenticate=False)
+
+
+def test_auth_state_is_saved_off_the_event_loop(start_mock, tmp_path, monkeypatch):
+    server = start_mock()
+    threads = []
+    for cls in (ksef_client.AuthPoller, ksef_client.PublicKeyCache):
+        original = cls._save
+
+        def _save(self, original=original):
+            threads.append(threading.current_thread())
+            original(self)
+
+        monkeypatch.setattr(cls, "_save", _save)
+
+    async def scenario(client):
+        return client.access_token
+
+    assert _run(server, scenario, auth_poller=ksef_client.AuthPoller(tmp_path, initial_s=0.01),
+                public_key_cache=ksef_client.PublicKeyCache(tmp_path))
+
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    assert (tmp_path / ksef_client.AuthPoller.STATE_FILENAME).is_file()
+    assert (tmp_path / ksef_client.PublicKeyCache.STATE_FILENAME).is_file()
+
+
+def test_query_invoices(start_mock):
+    server = start_mock(size=30)
+    today = datetime.date.today()
+
+    async def scenario(client):
+        return await client.query_invoices(date_from=today - datetime.timedelta(days=10), date_to=today,
+                                           page_size=10, page_offset=1)
+
+    result = _run(server, scenario)
+
+    assert len(result["invoices"]) == 10
+    assert result["hasMore"]
+    all_numbers = {server.corpus.metadata(i)["ksefNumber"] for i in range(30)}
+    assert {inv["ksefNumber"] for inv in result["invoices"]} <= all_numbers
+
+
+def test_concurrent_downloads(start_mock):
+    server = start_mock(size=10, latency_ms=20)
+    numbers = [server.corpus.metadata(i)["ksefNumber"] for i in range(10)]
+
+    async def scenario(client):
+        return await asyncio.gather(*(client.download_invoice_xml(nr) for nr in numbers))
+
+    results = _run(server, scenario)
+
+    assert results == [server.corpus.invoice_xml(i) for i in range(10)]
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 10}
+
+
+def test_throttling_and_transient_errors_are_retried(start_mock):
+    server = start_mock(retry_after=0)
+    meta = server.corpus.metadata(0)
+
+    async def scenario(client):
+        server.inject_faults(429, 503, 429, endpoint="/invoices/ksef/")
+        xml = await client.download_invoice_xml(meta["ksefNumber"])
+        return xml, client.rate_limiter.state()
+
+    xml, limiter = _run(server, scenario)
+
+    assert xml == server.corpus.invoice_xml(0)
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"429": 2, "503": 1, "200": 1}
+    assert limiter["download"]["throttled"] == 2
+
+
+def test_transient_error_without_retries_fails(start_mock):
+    server = start_mock()
+    meta = server.corpus.metadata(0)
+
+    async def scenario(client):
+        server.inject_faults(503, endpoint="/invoices/ksef/")
+        await client.download_invoice_xml(meta["ksefNumber"])
+
+    with pytest.raises(ksef_client.KSeFError) as excinfo:
+        _run(server, scenario, retry={"max_retries": 0})
+    assert excinfo.value.status_code == 503
+
+
+def test_terminate_session(start_mock):
+    server = start_mock()
+
+    async def scenario(client):
+        token = client.access_token
+        await client.terminate_session()
+        assert client.access_token is None and client.refresh_token is None
+
+        # Token zamkniętej sesji odrzucany przez KSeF
+        client.access_token = token
+        with pytest.raises(ksef_client.KSeFError) as excinfo:
+            await client.query_invoices()
+        return excinfo.value.status_code
+
+    assert _run(server, scenario) == 401
+    assert server.stats()["DELETE /auth/sessions/current"] == {"204": 1}
+
+
+# ---------------------------------------------------------------------------
+# Odnawianie sesji po HTTP 401
+# ---------------------------------------------------------------------------
+
+def test_expired_token_is_refreshed(start_mock):
+    server = start_mock()
+    meta = server.corpus.metadata(0)
+
+    async def scenario(client):
+        token = client.access_token
+        server.inject_faults(401, endpoint="/invoices/ksef/")
+        xml = await client.download_invoice_xml(meta["ksefNumber"])
+        return token, client.access_token, xml
+
+    old_token, new_token, xml = _run(server, scenario)
+
+    assert xml == server.corpus.invoice_xml(0)
+    assert new_token != old_token
+    stats = server.stats()
+    assert stats["GET /invoices/ksef/{ksefNumber}"] == {"401": 1, "200": 1}
+    assert stats["POST /auth/token/refresh"] == {"200": 1}
+
+
+def test_concurrent_401_renew_once(start_mock):
+    server = start_mock(size=8)
+    numbers = [server.corpus.metadata(i)["ksefNumber"] for i in range(8)]
+
+    async def scenario(client):
+        server.inject_faults(*[401] * 8, endpoint="/invoices/ksef/")
+        return await client.download_invoices_xml(numbers, concurrency=8)
+
+    results = _run(server, scenario)
+
+    assert [xml for _, xml in results] == [server.corpus.invoice_xml(i) for i in range(8)]
+    stats = server.stats()
+    assert stats["GET /invoices/ksef/{ksefNumber}"] == {"401": 8, "200": 8}
+    assert stats["POST /auth/token/refresh"] == {"200": 1}
+
+
+def test_failed_refresh_reauthenticates(start_mock):
+    server = start_mock()
+    meta = server.corpus.metadata(0)
+
+    async def scenario(client):
+        client.reauthenticate = lambda: client.authenticate_token("token-testowy")
+        server.reset_stats()
+        server.inject_faults(401, endpoint="/invoices/ksef/")
+        server.inject_faults(401, endpoint="/auth/token/refresh")
+        return await client.download_invoice_xml(meta["ksefNumber"])
+
+    assert _run(server, scenario) == server.corpus.invoice_xml(0)
+    stats = server.stats()
+    assert stats["POST /auth/token/refresh"] == {"401": 1}
+    assert stats["POST /auth/ksef-token"] == {"202": 1}
+    assert stats["GET /invoices/ksef/{ksefNumber}"] == {"401": 1, "200": 1}
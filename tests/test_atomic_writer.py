@@ -0,0 +1,136 @@
+"""AtomicFileWriter i strumieniowe pobieranie XML: bez niepełnych plików pod docelową nazwą."""
+
+import base64
+import hashlib
+from pathlib import Path
+
+import pytest
+
+import ksef_client
+
+
+def _leftovers(directory) -> list:
+    return sorted(p.name for p in directory.iterdir() if p.name.endswith(".part"))
+
+
+def test_commit_renames_temp_file(tmp_path):
+    target = tmp_path / "a.xml"
+    with ksef_client.AtomicFileWriter(target, keep_content=True) as out:
+        out.write(b"<Faktura>")
+        out.write(b"</Faktura>")
+        assert not target.exists()
+        assert out.tmp_path.parent == tmp_path
+        sha256, size = out.commit(hashlib.sha256(b"<Faktura></Faktura>").hexdigest().upper())
+
+    assert target.read_bytes() == b"<Faktura></Faktura>"
+    assert (sha256, size) == (hashlib.sha256(b"<Faktura></Faktura>").hexdigest(), 19)
+    assert out.content == b"<Faktura></Faktura>"
+    assert _leftovers(tmp_path) == []
+
+
+def test_exception_removes_temp_file(tmp_path):
+    target = tmp_path / "a.xml"
+    with pytest.raises(RuntimeError):
+        with ksef_client.AtomicFileWriter(target) as out:
+            out.write(b"<Faktura>")
+            raise RuntimeError("przerwane")
+
+    assert not target.exists()
+    assert _leftovers(tmp_path) == []
+
+
+def test_hash_mismatch_keeps_previous_file(tmp_path):
+    target = tmp_path / "a.xml"
+    target.write_bytes(b"stara wersja")
+
+    with pytest.raises(ksef_client.KSeFError, match="Niezgodny SHA-256"):
+        with ksef_client.AtomicFileWriter(target) as out:
+            out.write(b"nowa wersja")
+            out.commit("00" * 32)
+
+    assert target.read_bytes() == b"stara wersja"
+    assert _leftovers(tmp_path) == []
+
+
+def test_parallel_writers_use_distinct_temp_files(tmp_path):
+    target = tmp_path / "a.xml"
+    with ksef_client.AtomicFileWriter(target) as first, ksef_client.AtomicFileWriter(target) as second:
+        assert first.tmp_path != second.tmp_path
+        first.write(b"1")
+        second.write(b"2")
+        first.commit()
+        second.commit()
+
+    assert target.read_bytes() == b"2"
+    assert _leftovers(tmp_path) == []
+
+
+def test_expected_sha256_from_invoice_hash():
+    digest = hashlib.sha256(b"x").digest()
+    assert ksef_client._expected_sha256({"invoiceHash": base64.b64encode(digest).decode()}) == digest.hex()
+    assert ksef_client._expected_sha256({"invoiceHash": "nie-base64!"}) is None
+    assert ksef_client._expected_sha256({"invoiceHash": base64.b64encode(b"krotki").decode()}) is None
+    assert ksef_client._expected_sha256(None) is None
+
+
+# ---------------------------------------------------------------------------
+# Pobieranie z serwera mock
+# ---------------------------------------------------------------------------
+
+def test_truncated_download_is_retried(start_mock, make_client, tmp_path):
+    server = start_mock()
+    client = make_client(server)
+    meta = server.corpus.metadata(0)
+    target = tmp_path / "a.xml"
+
+    server.inject_faults("truncate", "truncate", endpoint="/invoices/ksef/")
+    sha256, size, content = ksef_client._save_invoice_xml(client, meta["ksefNumber"], target, meta,
+                                                          keep_content=True)
+
+    assert target.read_bytes() == content == server.corpus.invoice_xml(0)
+    assert size == meta["fileSize"]
+    assert sha256 == ksef_client._expected_sha256(meta)
+    assert client.retry_policy.retries == 2
+    assert _leftovers(tmp_path) == []
+
+
+def test_truncated_download_gives_up_cleanly(start_mock, make_client, tmp_path):
+    server = start_mock()
+    client = make_client(server, max_retries=1)
+    meta = server.corpus.metadata(0)
+    target = tmp_path / "a.xml"
+
+    server.inject_faults("truncate", "truncate", endpoint="/invoices/ksef/")
+    with pytest.raises(ksef_client.KSeFError, match="Przerwane pobieranie"):
+        client.download_invoice_xml_to(meta["ksefNumber"], target)
+
+    assert not target.exists()
+    assert _leftovers(tmp_path) == []
+
+
+def test_hash_mismatch_from_metadata_is_not_saved(start_mock, make_client, tmp_path):
+    server = start_mock()
+    client = make_client(server)
+    meta = dict(server.corpus.metadata(0), invoiceHash=base64.b64encode(b"\0" * 32).decode())
+    target = tmp_path / "a.xml"
+
+    with pytest.raises(ksef_client.KSeFError, match="Niezgodny SHA-256"):
+        ksef_client._save_invoice_xml(client, meta["ksefNumber"], target, meta)
+
+    assert not target.exists()
+    assert _leftovers(tmp_path) == []
+
+
+def test_download_errors_leave_no_partial_files(start_mock, make_client, make_args, logger):
+    server = start_mock(size=10)
+    client = make_client(server, max_retries=0)
+    args = make_args("--days", "10", "--concurrency", "4")
+
+    server.inject_faults("truncate", 503, "truncate", endpoint="/invoices/ksef/")
+    ksef_client._download_all_invoices(client, args, logger)
+
+    output_dir = Path(args.output_dir)
+    assert [p.name for p in output_dir.rglob("*.part")] == []
+    assert len(list(output_dir.rglob("*.xml"))) == 7
+    with ksef_client.InvoiceIndex(output_dir) as index:
+        assert index.count() == 7
@@ -0,0 +1,148 @@
+"""Backfill zakresu --date-from/--date-to: okna do 90 dni, wznawianie i pomijanie okien."""
+
+import datetime
+import logging
+
+import pytest
+
+import ksef_client
+
+
+def _downloads(server) -> int:
+    return sum(server.stats().get("GET /invoices/ksef/{ksefNumber}", {}).values())
+
+
+def _spy_queries(client, server, fail_offset: int = None) -> list:
+    """Zapisuj pageOffset zapytań klienta; zapytanie o ``fail_offset`` kończy się HTTP 503 z mocka."""
+    offsets = []
+    query_invoices = client.query_invoices
+
+    def _query(**kwargs):
+        offsets.append(kwargs.get("page_offset", 0))
+        if kwargs.get("page_offset") == fail_offset:
+            server.inject_faults(503, endpoint="/invoices/query/")
+        return query_invoices(**kwargs)
+
+    client.query_invoices = _query
+    return offsets
+
+
+def _windows(index, args) -> list:
+    date_to = args.date_to or datetime.date.today()
+    return [index.get_window(args.nip, args.subject, args.date_type, *window)
+            for window in ksef_client._split_date_range(args.date_from, date_to)]
+
+
+def test_split_date_range():
+    start = datetime.date(2025, 1, 1)
+    windows = ksef_client._split_date_range(start, datetime.date(2025, 7, 19))
+
+    assert [(b - a).days + 1 for a, b in windows] == [90, 90, 20]
+    assert windows[0][0] == start and windows[-1][1] == datetime.date(2025, 7, 19)
+    for (_, prev_to), (next_from, _) in zip(windows, windows[1:]):
+        assert next_from == prev_to + datetime.timedelta(days=1)
+
+    assert ksef_client._split_date_range(start, start) == [(start, start)]
+    assert ksef_client._split_date_range(start, start + datetime.timedelta(days=89)) == [
+        (start, start + datetime.timedelta(days=89))]
+    assert ksef_client._split_date_range(start, start - datetime.timedelta(days=1)) == []
+
+
+# ---------------------------------------------------------------------------
+# Backfill z serwerem mock
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("parallel", ["1", "3"])
+def test_range_is_split_into_90_day_windows(start_mock, make_client, make_args, logger, parallel):
+    server = start_mock(size=200, days=200)
+    client = make_client(server)
+    date_from = datetime.date.today() - datetime.timedelta(days=209)
+    args = make_args("--date-from", date_from.isoformat(), "--parallel-windows", parallel)
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    # 210 dni: okna 90 + 90 + 30, każde do 100 faktur — jedna strona na okno
+    assert server.stats()["POST /invoices/query/metadata"] == {"200": 3}
+    assert _downloads(server) == 200
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 200
+        windows = _windows(index, args)
+    assert [w["status"] for w in windows] == ["done"] * 3
+    assert sum(w["page_offset"] for w in windows) == 200
+
+
+def test_interrupted_window_resumes_from_saved_page(start_mock, make_client, make_args, logger, caplog):
+    server = start_mock(size=300)
+    date_from = datetime.date.today() - datetime.timedelta(days=30)
+    args = make_args("--date-from", date_from.isoformat())
+
+    # Pierwszy przebieg: zapytanie o trzecią stronę okna kończy się błędem
+    first = make_client(server, max_retries=0)
+    offsets = _spy_queries(first, server, fail_offset=200)
+    ksef_client._download_all_invoices(first, args, logger)
+
+    assert offsets == [0, 100, 200]
+    assert _downloads(server) == 200
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert [(w["status"], w["page_offset"]) for w in _windows(index, args)] == [("pending", 200)]
+
+    # Drugi przebieg: tylko brakująca strona i jej faktury
+    server.reset_stats()
+    second = make_client(server)
+    offsets = _spy_queries(second, server)
+    with caplog.at_level(logging.INFO, logger="ksef_test"):
+        ksef_client._download_all_invoices(second, args, logger)
+
+    assert offsets == [200]
+    assert server.stats()["POST /invoices/query/metadata"] == {"200": 1}
+    assert _downloads(server) == 100
+    assert "wznowienie od pozycji 200" in caplog.text
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 300
+        assert [(w["status"], w["page_offset"]) for w in _windows(index, args)] == [("done", 300)]
+
+
+def test_window_with_download_errors_is_retried(start_mock, make_client, make_args, logger):
+    server = start_mock(size=30)
+    date_from = datetime.date.today() - datetime.timedelta(days=30)
+    args = make_args("--date-from", date_from.isoformat())
+    failing = server.corpus.metadata(7)["ksefNumber"]
+
+    server.inject_faults(503, endpoint=f"/invoices/ksef/{failing}")
+    ksef_client._download_all_invoices(make_client(server, max_retries=0), args, logger)
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 29
+        assert _windows(index, args)[0]["status"] == "error"
+
+    # Okno z błędami od początku — pobrane faktury pomija indeks
+    server.reset_stats()
+    ksef_client._download_all_invoices(make_client(server), args, logger)
+
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 1}
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.get(failing) is not None
+        assert _windows(index, args)[0]["status"] == "done"
+
+
+def test_completed_windows_are_skipped(start_mock, make_client, make_args, logger, caplog):
+    server = start_mock(size=120, days=120)
+    date_from = datetime.date.today() - datetime.timedelta(days=129)
+    args = make_args("--date-from", date_from.isoformat())
+    ksef_client._download_all_invoices(make_client(server), args, logger)
+
+    # Drugie okno cofnięte do "pending" — tylko ono jest pobierane ponownie
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        windows = ksef_client._split_date_range(date_from, datetime.date.today())
+        index.set_window(args.nip, args.subject, args.date_type, *windows[1], "pending", 0)
+
+    server.reset_stats()
+    with caplog.at_level(logging.INFO, logger="ksef_test"):
+        ksef_client._download_all_invoices(make_client(server), args, logger)
+
+    assert server.stats()["POST /invoices/query/metadata"] == {"200": 1}
+    assert _downloads(server) == 0
+    assert f"Okno {windows[0][0]}..{windows[0][1]}: pobrane wcześniej — pomijam" in caplog.text
+
+    server.reset_stats()
+    ksef_client._download_all_invoices(make_client(server), args, logger)
+    assert "POST /invoices/query/metadata" not in server.stats()
@@ -0,0 +1,143 @@
+"""Eksport paczek faktur: odszyfrowanie części AES-256-CBC, odczyt ZIP przez _ExportPartsReader."""
+
+import io
+import os
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import ksef_client
+
+
+def _split(tmp_path, data: bytes, sizes: list) -> list:
+    paths, offset = [], 0
+    for n, size in enumerate(sizes):
+        path = tmp_path / f"part-{n}"
+        path.write_bytes(data[offset:offset + size])
+        paths.append(path)
+        offset += size
+    return paths
+
+
+def test_parts_reader_reads_across_parts(tmp_path):
+    data = os.urandom(1000)
+    reader = ksef_client._ExportPartsReader(_split(tmp_path, data, [300, 1, 699]))
+    try:
+        assert reader.read() == data
+        assert reader.seek(-5, io.SEEK_END) == 995
+        assert reader.read(100) == data[995:]
+        assert reader.read(1) == b""
+
+        # Surowy odczyt kończy się na granicy części (krótki odczyt jak w RawIOBase)
+        reader.seek(290)
+        assert reader.read(20) == data[290:300]
+        reader.seek(5, io.SEEK_CUR)
+        assert reader.tell() == 305
+        assert reader.read(10) == data[305:315]
+    finally:
+        reader.close()
+
+    with io.BufferedReader(ksef_client._ExportPartsReader(_split(tmp_path, data, [300, 1, 699])), 64) as fh:
+        fh.seek(290)
+        assert fh.read(20) == data[290:310]
+
+
+def test_parts_reader_serves_zipfile(tmp_path):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for n in range(5):
+            archive.writestr(f"F-{n}.xml", os.urandom(500))
+    data = buffer.getvalue()
+
+    with io.BufferedReader(ksef_client._ExportPartsReader(_split(tmp_path, data, [700, 700, len(data)]))) as fh, \
+            zipfile.ZipFile(fh) as archive, zipfile.ZipFile(io.BytesIO(data)) as expected:
+        assert archive.namelist() == expected.namelist()
+        for name in archive.namelist():
+            assert archive.read(name) == expected.read(name)
+
+
+# ---------------------------------------------------------------------------
+# Eksport z serwera mock
+# ---------------------------------------------------------------------------
+
+def _export_mock(start_mock, **options):
+    # Części po 4 KiB — paczka 20 faktur to kilka części
+    return start_mock(size=20, export_delay_ms=0, export_part_size=4096, **options)
+
+
+def _single_downloads(server) -> int:
+    return sum(server.stats().get("GET /invoices/ksef/{ksefNumber}", {}).values())
+
+
+def _assert_complete(server, args):
+    output_dir = Path(args.output_dir)
+    with ksef_client.InvoiceIndex(output_dir) as index:
+        assert index.count() == len(server.corpus)
+        for i in range(len(server.corpus)):
+            entry = index.get(server.corpus.metadata(i)["ksefNumber"])
+            assert index.xml_path(entry).read_bytes() == server.corpus.invoice_xml(i)
+    assert not list(output_dir.glob(".export-*"))
+
+
+def test_export_downloads_decrypts_and_unpacks(start_mock, make_client, make_args, logger):
+    server = _export_mock(start_mock)
+    client = make_client(server)
+    args = make_args("--days", "10", "--export")
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    parts = server.stats()["GET /mock/exports/{referenceNumber}/parts/{n}"]["200"]
+    assert parts > 1
+    assert _single_downloads(server) == 0
+    _assert_complete(server, args)
+
+
+def test_truncated_part_is_retried(start_mock, make_client, make_args, logger):
+    server = _export_mock(start_mock)
+    client = make_client(server)
+    args = make_args("--days", "10", "--export", "--export-parts", "1")
+
+    server.inject_faults("truncate", 503, endpoint="/mock/exports/")
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert client.retry_policy.retries == 2
+    assert _single_downloads(server) == 0
+    _assert_complete(server, args)
+
+
+def test_failed_part_falls_back_to_single_downloads(start_mock, make_client, make_args, logger):
+    server = _export_mock(start_mock)
+    client = make_client(server, max_retries=0)
+    args = make_args("--days", "10", "--export")
+
+    server.inject_faults(503, endpoint="/mock/exports/")
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert _single_downloads(server) == len(server.corpus)
+    _assert_complete(server, args)
+
+
+def test_truncated_export_is_completed_by_single_downloads(start_mock, make_client, make_args, logger):
+    server = _export_mock(start_mock, result_limit=12)
+    client = make_client(server)
+    args = make_args("--days", "10", "--export")
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    # 12 faktur z paczki, reszta pojedynczo (zapytania dzielone po isTruncated)
+    assert _single_downloads(server) == len(server.corpus) - 12
+    _assert_complete(server, args)
+
+
+def test_wrong_key_is_rejected(start_mock, make_client, tmp_path):
+    server = _export_mock(start_mock)
+    client = make_client(server)
+    reference, key, iv = client.start_invoice_export()
+    part = client.wait_for_invoice_export(reference)["parts"][0]
+
+    with pytest.raises(ksef_client.KSeFError):
+        client.download_export_part(reference, part, tmp_path / "part", os.urandom(32), iv)
+    assert list(tmp_path.iterdir()) == []
+
+    assert client.download_export_part(reference, part, tmp_path / "part", key, iv) == part["partSize"]
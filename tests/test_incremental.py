@@ -0,0 +1,84 @@
+"""Synchronizacja przyrostowa: punkt kontrolny przesuwany tylko po stronach zapisanych w całości."""
+
+import datetime
+from pathlib import Path
+
+import ksef_client
+
+# Trzy strony zapytania (po 100 faktur) — błąd na drugiej
+CORPUS_SIZE = 250
+
+
+def _stored(server, i: int) -> datetime.datetime:
+    return ksef_client._parse_ksef_datetime(server.corpus.metadata(i)["permanentStorageDate"])
+
+
+def _checkpoint(args):
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        return index.get_checkpoint(args.nip, args.subject)
+
+
+def test_page_checkpoint_capped_by_hwm():
+    invoices = [{"permanentStorageDate": "2026-03-01T10:00:00+00:00"},
+                {"permanentStorageDate": "2026-03-01T12:00:00+00:00"},
+                {"permanentStorageDate": None}]
+    latest = datetime.datetime(2026, 3, 1, 12, tzinfo=datetime.timezone.utc)
+    assert ksef_client._page_checkpoint({}, invoices) == latest
+
+    hwm = {"permanentStorageHwmDate": "2026-03-01T11:00:00+00:00"}
+    assert ksef_client._page_checkpoint(hwm, invoices) == latest - datetime.timedelta(hours=1)
+    assert ksef_client._page_checkpoint(hwm, [{}]) is None
+
+
+def test_checkpoint_reaches_last_invoice(start_mock, make_client, make_args, logger):
+    server = start_mock(size=CORPUS_SIZE, lines=1)
+    client = make_client(server)
+    args = make_args("--incremental", "--days", "10")
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert _checkpoint(args) == _stored(server, CORPUS_SIZE - 1)
+    queries = server.stats()["POST /invoices/query/metadata"]
+    assert queries == {"200": 3}
+
+
+def test_failed_download_holds_checkpoint(start_mock, make_client, make_args, logger):
+    server = start_mock(size=CORPUS_SIZE, lines=1)
+    client = make_client(server, max_retries=0)
+    args = make_args("--incremental", "--days", "10")
+    failing = server.corpus.metadata(150)["ksefNumber"]
+
+    server.inject_faults(503, endpoint=f"/invoices/ksef/{failing}")
+    ksef_client._download_all_invoices(client, args, logger)
+
+    # Strona 1 zapisana w całości, strona 2 z błędem — dalej punkt kontrolny nie idzie,
+    # choć strona 3 też została pobrana
+    assert _checkpoint(args) == _stored(server, 99)
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == CORPUS_SIZE - 1
+        assert index.get(failing) is None
+
+    # Następny przebieg zaczyna od punktu kontrolnego i uzupełnia brakującą fakturę
+    server.reset_stats()
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 1}
+    assert _checkpoint(args) == _stored(server, CORPUS_SIZE - 1)
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.get(failing) is not None
+
+
+def test_overlap_does_not_move_checkpoint_back(start_mock, make_client, make_args, logger):
+    server = start_mock(size=20)
+    client = make_client(server)
+    args = make_args("--incremental", "--days", "10", "--overlap", "10")
+    # Ostatnia faktura w zakładce 10 min przed punktem kontrolnym
+    checkpoint = _stored(server, 19) + datetime.timedelta(minutes=5)
+    Path(args.output_dir).mkdir(parents=True)
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        index.set_checkpoint(args.nip, args.subject, checkpoint)
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 1}
+    assert _checkpoint(args) == checkpoint
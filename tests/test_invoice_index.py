@@ -0,0 +1,196 @@
+"""InvoiceIndex (SQLite w katalogu docelowym) i pomijanie pobranych faktur w przebiegu."""
+
+import datetime
+import hashlib
+import os
+from pathlib import Path
+
+import ksef_client
+
+
+def test_record_and_get(tmp_path):
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        assert index.get("X-1") is None
+        index.record_download("X-1", "5265877635/2026/03", "X-1.xml", "ab" * 32, 123, {"invoiceNumber": "FV/1"})
+        index.commit()
+        entry = index.get("X-1")
+
+    assert entry["subdir"] == "5265877635/2026/03"
+    assert entry["sha256"] == "ab" * 32
+    assert entry["size"] == 123
+    assert entry["pdf_status"] is None
+    assert '"FV/1"' in entry["metadata_json"]
+
+    index = ksef_client.InvoiceIndex.open_existing(tmp_path)
+    try:
+        assert index.get("X-1") == entry
+        assert index.xml_path(entry) == tmp_path / "5265877635/2026/03/X-1.xml"
+    finally:
+        index.close()
+
+
+def test_open_existing_does_not_create(tmp_path):
+    assert ksef_client.InvoiceIndex.open_existing(tmp_path) is None
+    assert not (tmp_path / ksef_client.INDEX_FILENAME).exists()
+
+
+def test_pdf_status_and_pending_entries(tmp_path):
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        for n in range(3):
+            index.record_download(f"X-{n}", "a", f"X-{n}.xml", None, 1)
+        index.set_pdf_status("X-0", "ok")
+        index.set_pdf_status("X-1", "error")
+
+        assert index.count() == 3
+        assert [e["ksef_number"] for e in index.entries(pdf_pending_only=True)] == ["X-1", "X-2"]
+
+
+def test_adopt_legacy_file(tmp_path):
+    xml_path = tmp_path / "a" / "X-1.xml"
+    xml_path.parent.mkdir()
+    xml_path.write_bytes(b"<Faktura/>")
+    mtime = datetime.datetime(2025, 6, 1, 12, 0, tzinfo=datetime.timezone.utc).timestamp()
+    os.utime(xml_path, (mtime, mtime))
+
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        index.adopt_file("X-1", "a", xml_path)
+        entry = index.get("X-1")
+        assert entry["sha256"] == hashlib.sha256(b"<Faktura/>").hexdigest()
+        assert entry["size"] == len(b"<Faktura/>")
+        assert entry["downloaded_at"] == "2025-06-01T12:00:00+00:00"
+        assert entry["pdf_status"] is None
+
+        # PDF obok XML (wygenerowany przed indeksem) — nie do ponownego generowania
+        xml_path.with_suffix(".pdf").write_bytes(b"%PDF")
+        index.adopt_file("X-1", "a", xml_path)
+        assert index.get("X-1")["pdf_status"] == "ok"
+
+
+def test_checkpoint_and_window_state(tmp_path):
+    checkpoint = datetime.datetime(2026, 3, 1, 10, 30, 0, 123456, tzinfo=datetime.timezone.utc)
+    window = (datetime.date(2026, 1, 1), datetime.date(2026, 3, 31))
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        assert index.get_checkpoint("5265877635", "Subject2") is None
+        index.set_checkpoint("5265877635", "Subject2", checkpoint)
+        index.set_window("5265877635", "Subject2", "Invoicing", *window, "pending", 200)
+
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        assert index.get_checkpoint("5265877635", "Subject2") == checkpoint
+        assert index.get_checkpoint("5265877635", "Subject1") is None
+        state = index.get_window("5265877635", "Subject2", "Invoicing", *window)
+        assert (state["status"], state["page_offset"]) == ("pending", 200)
+
+
+# ---------------------------------------------------------------------------
+# Przebieg z serwerem mock
+# ---------------------------------------------------------------------------
+
+def _download_requests(server) -> int:
+    return sum(server.stats().get("GET /invoices/ksef/{ksefNumber}", {}).values())
+
+
+def test_second_run_skips_indexed_invoices(start_mock, make_client, make_args, logger):
+    server = start_mock(size=12)
+    client = make_client(server)
+    args = make_args("--days", "10")
+
+    ksef_client._download_all_invoices(client, args, logger)
+    assert _download_requests(server) == 12
+
+    server.reset_stats()
+    ksef_client._download_all_invoices(client, args, logger)
+    assert _download_requests(server) == 0
+
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 12
+        for entry in index.entries():
+            assert hashlib.sha256(index.xml_path(entry).read_bytes()).hexdigest() == entry["sha256"]
+
+
+def test_legacy_archive_is_adopted_without_download(start_mock, make_client, make_args, logger):
+    server = start_mock(size=6)
+    client = make_client(server)
+    args = make_args("--days", "10")
+
+    # Archiwum sprzed indeksu: połowa faktur już na dysku, bez .ksef_index.sqlite
+    legacy = {}
+    for i in range(3):
+        meta = server.corpus.metadata(i)
+        subdir = ksef_client._invoice_subdir(args.nip, meta, meta["ksefNumber"], logger)
+        xml_path = Path(args.output_dir) / subdir / f"{meta['ksefNumber']}.xml"
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        xml_path.write_bytes(server.corpus.invoice_xml(i))
+        legacy[meta["ksefNumber"]] = xml_path
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert _download_requests(server) == 3
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 6
+        for ksef_nr, xml_path in legacy.items():
+            assert index.xml_path(index.get(ksef_nr)) == xml_path
+
+
+def test_missing_indexed_file_is_downloaded_again(start_mock, make_client, make_args, logger, caplog):
+    server = start_mock(size=5)
+    client = make_client(server)
+    args = make_args("--days", "10")
+    ksef_client._download_all_invoices(client, args, logger)
+
+    ksef_nr = server.corpus.metadata(2)["ksefNumber"]
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        removed = index.xml_path(index.get(ksef_nr))
+    removed.unlink()
+
+    server.reset_stats()
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 1}
+    assert removed.read_bytes() == server.corpus.invoice_xml(2)
+    assert "Brak pliku z indeksu" in caplog.text
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 5
+
+
+# ---------------------------------------------------------------------------
+# Generator PDF na katalogu z indeksem
+# ---------------------------------------------------------------------------
+
+def test_pdf_directory_renders_unindexed_xml(tmp_path, capsys):
+    import ksef_pdf
+    from conftest import FIXTURES_DIR
+
+    indexed = tmp_path / "5265877635" / "2026" / "03" / "fa2.xml"
+    manual = tmp_path / "recznie" / "fa3.xml"
+    for path, fixture in ((indexed, "fa2.xml"), (manual, "fa3.xml")):
+        path.parent.mkdir(parents=True)
+        path.write_bytes((FIXTURES_DIR / fixture).read_bytes())
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        index.record_download("FA2", "5265877635/2026/03", "fa2.xml",
+                              hashlib.sha256(indexed.read_bytes()).hexdigest(), indexed.stat().st_size)
+
+    ksef_pdf._process_directory(tmp_path, skip_existing=True, ksef_nr=None)
+
+    assert "Przetworzono: 2, pominięto: 0, błędy: 0" in capsys.readouterr().out
+    assert indexed.with_suffix(".pdf").exists()
+    assert manual.with_suffix(".pdf").exists()
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        assert index.get("fa3")["subdir"] == "recznie"
+        assert {e["pdf_status"] for e in index.entries()} == {"ok"}
+
+    # Skanowanie katalogu tylko raz — kolejny przebieg korzysta z indeksu
+    ksef_pdf._process_directory(tmp_path, skip_existing=True, ksef_nr=None)
+    assert "Przetworzono: 0, pominięto: 2, błędy: 0" in capsys.readouterr().out
+
+
+def test_adopt_untracked_key_collision(tmp_path):
+    for subdir in ("a", "b"):
+        (tmp_path / subdir).mkdir()
+        (tmp_path / subdir / "X-1.xml").write_bytes(subdir.encode())
+    with ksef_client.InvoiceIndex(tmp_path) as index:
+        index.record_download("X-1", "a", "X-1.xml", None, 1)
+
+        assert index.adopt_untracked() == 1
+        assert index.get("b/X-1.xml")["subdir"] == "b"
+        assert index.get("X-1")["subdir"] == "a"
+        assert index.adopt_untracked() == 0
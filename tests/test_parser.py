@@ -0,0 +1,121 @@
+"""Test różnicowy parserów faktur: strumieniowy parse_ksef_xml() vs _parse_ksef_xml_tree()."""
+
+import io
+from xml.etree.ElementTree import ParseError
+
+import pytest
+from defusedxml import DTDForbidden
+
+import ksef_pdf
+from conftest import FIXTURES_DIR
+
+FIXTURES = sorted(FIXTURES_DIR.glob("fa*.xml"))
+
+FA3_NS = "http://crd.gov.pl/wzor/2025/06/25/13775/"
+
+
+def test_fixtures_cover_every_schema():
+    namespaces = {ksef_pdf.parse_ksef_xml(path)["namespace"] for path in FIXTURES}
+    assert namespaces == ksef_pdf.KSEF_NAMESPACES
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: p.name)
+def test_streaming_parser_matches_tree_parser(path):
+    assert ksef_pdf.parse_ksef_xml(path) == ksef_pdf._parse_ksef_xml_tree(path)
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: p.name)
+def test_streaming_parser_accepts_bytes_and_file_objects(path):
+    expected = ksef_pdf._parse_ksef_xml_tree(path)
+    content = path.read_bytes()
+    assert ksef_pdf.parse_ksef_xml(content) == expected
+    assert ksef_pdf.parse_ksef_xml(io.BytesIO(content)) == expected
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: p.name)
+def test_fixture_sections_are_parsed(path):
+    # Sekcje, które parser strumieniowy obsługuje osobno — oba parsery muszą je widzieć
+    data = ksef_pdf.parse_ksef_xml(path)
+    assert [w["nr"] for w in data["wiersze"]] == ["1", "2", "3"]
+    assert data["wiersze"][1]["nazwa"] == 'Ksiazka "Podatki w praktyce" & aktualizacja'
+    assert [p["rola_kod"] for p in data["podmioty3"]] == ["2", "inna"]
+    assert data["podmioty3"][1]["rola"] == "Faktor"
+    assert data["podmiot_upowazniony"]["rola"] == "Komornik sadowy"
+    assert data["adnotacje"]["P_19A"] == "art. 43 ust. 1 pkt 37 ustawy o VAT"
+    assert data["stopka"] == {
+        "tekst": "Dziekujemy za zakupy. Reklamacje: reklamacje@example.pl",
+        "krs": "0000123456",
+        "regon": "146123456",
+        "bdo": "000012345",
+    }
+    # Rozliczenie nie trafia do wyniku, ale nie może zaburzyć sąsiednich sekcji Fa
+    assert data["platnosc"]["nr_rachunku"] == "61109010140000071219812874"
+    assert data["zamowienia"] == [{"data": "2025-03-02", "numer": "ZAM/311"}]
+
+
+def test_many_lines_and_sections_out_of_order():
+    # Wiele pozycji FaWiersz, Stopka przed Fa i powtórzony Podmiot1 (liczy się pierwszy)
+    content = (FIXTURES_DIR / "fa3.xml").read_bytes().decode("utf-8")
+    rows = "".join(
+        f"<FaWiersz><NrWierszaFa>{n}</NrWierszaFa><P_7>Pozycja {n}</P_7><P_11>{n}.00</P_11>"
+        f"<P_12>23</P_12></FaWiersz>"
+        for n in range(4, 504)
+    )
+    content = content.replace("<Rozliczenie>", rows + "<Rozliczenie>")
+    content = content.replace(
+        "<Fa>", "<Stopka><Rejestry><BDO>1</BDO></Rejestry></Stopka><Podmiot1><NrKlienta>X</NrKlienta></Podmiot1><Fa>"
+    )
+    xml = content.encode("utf-8")
+
+    data = ksef_pdf.parse_ksef_xml(xml)
+    assert data == ksef_pdf._parse_ksef_xml_tree(xml)
+    assert len(data["wiersze"]) == 503
+    assert data["stopka"] == {"krs": None, "regon": None, "bdo": "1"}
+
+
+def test_invoice_without_fa():
+    xml = f'<Faktura xmlns="{FA3_NS}"><Podmiot1/><Stopka><Rejestry><KRS>1</KRS></Rejestry></Stopka></Faktura>'.encode()
+    data = ksef_pdf.parse_ksef_xml(xml)
+    assert data == ksef_pdf._parse_ksef_xml_tree(xml)
+    assert data["stopka"] == {}
+
+
+# ---------------------------------------------------------------------------
+# Odrzucane dane wejściowe
+# ---------------------------------------------------------------------------
+
+HOSTILE = {
+    "entity-expansion": (
+        '<?xml version="1.0"?><!DOCTYPE Faktura [<!ENTITY a "aaaaaaaaaa">'
+        '<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+        f'<Faktura xmlns="{FA3_NS}"><Fa><P_2>&b;</P_2></Fa></Faktura>'
+    ),
+    "external-entity": (
+        '<?xml version="1.0"?><!DOCTYPE Faktura [<!ENTITY e SYSTEM "file:///etc/passwd">]>'
+        f'<Faktura xmlns="{FA3_NS}"><Fa><P_2>&e;</P_2></Fa></Faktura>'
+    ),
+    "external-dtd": (
+        '<?xml version="1.0"?><!DOCTYPE Faktura SYSTEM "http://example.invalid/fa.dtd">'
+        f'<Faktura xmlns="{FA3_NS}"/>'
+    ),
+    "parameter-entity": (
+        '<?xml version="1.0"?><!DOCTYPE Faktura [<!ENTITY % p SYSTEM "http://example.invalid/x.dtd">%p;]>'
+        f'<Faktura xmlns="{FA3_NS}"/>'
+    ),
+}
+
+
+@pytest.mark.parametrize("name", sorted(HOSTILE))
+@pytest.mark.parametrize("parser", [ksef_pdf.parse_ksef_xml, ksef_pdf._parse_ksef_xml_tree],
+                         ids=["iterparse", "tree"])
+def test_dtd_payloads_are_rejected(parser, name):
+    # Faktura KSeF nie ma DTD — DOCTYPE jest odrzucany, zanim dojdzie do encji
+    with pytest.raises(DTDForbidden):
+        parser(HOSTILE[name].encode())
+
+
+def test_unknown_namespace_and_broken_xml():
+    with pytest.raises(ValueError, match="Nieznany namespace KSeF"):
+        ksef_pdf.parse_ksef_xml(b'<Potwierdzenie xmlns="http://example.invalid/upo"><A/></Potwierdzenie>')
+    with pytest.raises(ParseError):
+        ksef_pdf.parse_ksef_xml(f'<Faktura xmlns="{FA3_NS}"><Fa>'.encode())
@@ -0,0 +1,70 @@
+"""Równoległe generowanie PDF (generate_pdfs, --jobs): te same wyniki co w jednym procesie."""
+
+import re
+
+import pytest
+
+import ksef_client
+import ksef_pdf
+from conftest import FIXTURES_DIR
+
+FIXTURES = ("fa1.xml", "fa2.xml", "fa3.xml")
+
+
+def _archive(directory):
+    """Katalog z fakturami z tests/fixtures i jednym uszkodzonym XML, wszystkie w indeksie."""
+    subdir = directory / "5265877635" / "2026" / "03"
+    subdir.mkdir(parents=True)
+    for name in FIXTURES:
+        (subdir / name).write_bytes((FIXTURES_DIR / name).read_bytes())
+    (subdir / "uszkodzona.xml").write_bytes(b"<Faktura><Fa>urwany plik")
+    with ksef_client.InvoiceIndex(directory) as index:
+        for xml_path in sorted(subdir.glob("*.xml")):
+            index.adopt_file(xml_path.stem, "5265877635/2026/03", xml_path)
+    return subdir
+
+
+def _statuses(directory) -> dict:
+    with ksef_client.InvoiceIndex(directory) as index:
+        return {e["ksef_number"]: e["pdf_status"] for e in index.entries()}
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_generate_pdfs_results(tmp_path, jobs):
+    subdir = _archive(tmp_path)
+    xml_paths = sorted(subdir.glob("*.xml"))
+    manifest = ksef_pdf.PdfManifest(tmp_path)
+
+    results = {xml_path.name: (pdf_path, error)
+               for xml_path, pdf_path, error in ksef_pdf.generate_pdfs(xml_paths, jobs, manifest=manifest)}
+
+    assert sorted(results) == sorted(p.name for p in xml_paths)
+    for name in FIXTURES:
+        pdf_path, error = results[name]
+        assert error is None
+        assert pdf_path.read_bytes().startswith(b"%PDF")
+        assert not manifest.is_stale(subdir / name)
+    assert results["uszkodzona.xml"][1]
+    assert not (subdir / "uszkodzona.pdf").exists()
+    assert manifest.get(subdir / "uszkodzona.xml") is None
+
+
+def test_directory_jobs_give_same_counters_and_statuses(tmp_path, capsys):
+    outcomes = {}
+    for jobs in (1, 2):
+        directory = tmp_path / f"jobs{jobs}"
+        subdir = _archive(directory)
+        capsys.readouterr()
+
+        ksef_pdf._process_directory(directory, skip_existing=True, ksef_nr=None, jobs=jobs)
+
+        out = capsys.readouterr().out
+        counters = re.search(r"Przetworzono: (\d+), pominięto: (\d+), błędy: (\d+)", out).groups()
+        pdfs = sorted(p.name for p in subdir.glob("*.pdf"))
+        outcomes[jobs] = (counters, _statuses(directory), pdfs)
+
+    assert outcomes[1] == outcomes[2]
+    counters, statuses, pdfs = outcomes[1]
+    assert counters == ("3", "0", "1")
+    assert statuses == {"fa1": "ok", "fa2": "ok", "fa3": "ok", "uszkodzona": "error"}
+    assert pdfs == ["fa1.pdf", "fa2.pdf", "fa3.pdf"]
@@ -0,0 +1,119 @@
+"""PdfManifest.is_stale() i potok PDF zasilany pobieraniem z serwera mock."""
+
+import hashlib
+from pathlib import Path
+
+import pytest
+
+import ksef_client
+import ksef_pdf
+from conftest import FIXTURES_DIR
+
+
+@pytest.fixture
+def rendered(tmp_path):
+    """Faktura z PDF obok i wpisem w manifeście: (manifest, ścieżka XML, SHA-256 XML)."""
+    xml_path = tmp_path / "2026" / "fa2.xml"
+    xml_path.parent.mkdir()
+    xml_path.write_bytes((FIXTURES_DIR / "fa2.xml").read_bytes())
+    xml_path.with_suffix(".pdf").write_bytes(b"%PDF-1.4 test")
+    xml_sha256 = hashlib.sha256(xml_path.read_bytes()).hexdigest()
+
+    manifest = ksef_pdf.PdfManifest(tmp_path)
+    manifest.record(xml_path, xml_sha256, len(b"%PDF-1.4 test"))
+    return manifest, xml_path, xml_sha256
+
+
+def test_missing_entry_is_stale(tmp_path):
+    assert ksef_pdf.PdfManifest(tmp_path).is_stale(tmp_path / "a.xml")
+
+
+def test_recorded_pdf_is_fresh(rendered):
+    manifest, xml_path, xml_sha256 = rendered
+    assert not manifest.is_stale(xml_path)
+    assert not manifest.is_stale(xml_path, xml_sha256)
+    assert manifest.get(xml_path)["renderer"] == ksef_pdf.RENDERER_VERSION
+
+
+def test_changed_xml_is_stale(rendered):
+    manifest, xml_path, xml_sha256 = rendered
+    assert manifest.is_stale(xml_path, "00" * 32)
+
+    xml_path.write_bytes(xml_path.read_bytes().replace(b"</Faktura>", b"<!-- zmiana --></Faktura>"))
+    assert manifest.is_stale(xml_path)
+
+
+def test_renderer_upgrade_makes_pdf_stale(rendered, monkeypatch):
+    manifest, xml_path, xml_sha256 = rendered
+    monkeypatch.setattr(ksef_pdf, "RENDERER_VERSION", ksef_pdf.RENDERER_VERSION + "-nowy")
+    assert manifest.is_stale(xml_path, xml_sha256)
+
+
+def test_missing_or_truncated_pdf_is_stale(rendered):
+    manifest, xml_path, xml_sha256 = rendered
+    pdf_path = xml_path.with_suffix(".pdf")
+    pdf_path.write_bytes(b"%PDF")
+    assert manifest.is_stale(xml_path, xml_sha256)
+
+    pdf_path.unlink()
+    assert manifest.is_stale(xml_path, xml_sha256)
+
+
+def test_missing_xml_is_stale(rendered):
+    manifest, xml_path, _ = rendered
+    xml_path.unlink()
+    assert manifest.is_stale(xml_path)
+
+
+def test_save_and_reload(rendered, tmp_path):
+    manifest, xml_path, xml_sha256 = rendered
+    manifest.save()
+
+    reloaded = ksef_pdf.PdfManifest(tmp_path)
+    assert reloaded.get(xml_path) == manifest.get(xml_path)
+    assert not reloaded.is_stale(xml_path, xml_sha256)
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".part")] == []
+
+    reloaded.discard(xml_path)
+    reloaded.save()
+    assert ksef_pdf.PdfManifest(tmp_path).get(xml_path) is None
+
+
+def test_corrupt_manifest_starts_empty(tmp_path):
+    (tmp_path / ksef_pdf.PDF_MANIFEST_FILENAME).write_text("{nie json", encoding="utf-8")
+    assert ksef_pdf.PdfManifest(tmp_path).get(tmp_path / "a.xml") is None
+
+
+# ---------------------------------------------------------------------------
+# Potok PDF przy pobieraniu z serwera mock
+# ---------------------------------------------------------------------------
+
+def test_pipeline_records_manifest_and_rebuild_skips_fresh(start_mock, make_client, make_args, logger,
+                                                           capsys, monkeypatch):
+    server = start_mock(size=4)
+    client = make_client(server)
+    args = make_args("--days", "10", "--pdf")
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True)
+    manifest = ksef_pdf.PdfManifest(output_dir)
+    pipeline = ksef_pdf.PdfPipeline(logger=logger, manifest=manifest)
+
+    ksef_client._download_all_invoices(client, args, logger, pdf_pipeline=pipeline)
+
+    assert pipeline.processed == 4 and pipeline.errors == 0
+    with ksef_client.InvoiceIndex(output_dir) as index:
+        entries = index.entries()
+        assert {e["pdf_status"] for e in entries} == {"ok"}
+    saved = ksef_pdf.PdfManifest(output_dir)
+    for entry in entries:
+        xml_path = output_dir / entry["subdir"] / entry["file_name"]
+        assert not saved.is_stale(xml_path, entry["sha256"])
+
+    capsys.readouterr()
+    ksef_pdf._process_directory(output_dir, skip_existing=True, ksef_nr=None, rebuild_stale=True)
+    assert "Przetworzono: 0, pominięto: 4" in capsys.readouterr().out
+
+    # Nowa wersja renderera — wszystkie PDF do ponownego wygenerowania
+    monkeypatch.setattr(ksef_pdf, "RENDERER_VERSION", ksef_pdf.RENDERER_VERSION + "-nowy")
+    ksef_pdf._process_directory(output_dir, skip_existing=True, ksef_nr=None, rebuild_stale=True)
+    assert "Przetworzono: 4, pominięto: 0" in capsys.readouterr().out
@@ -0,0 +1,107 @@
+"""Pobieranie stron metadanych z wyprzedzeniem (_prefetch_pages, --prefetch)."""
+
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+import ksef_client
+
+# Błąd producenta ma dotrzeć do konsumenta, a nie go zawiesić
+TIMEOUT_S = 10
+
+
+def _consume(pages, depth: int, delay: float = 0.0) -> list:
+    """Odbierz strony z _prefetch_pages w osobnym wątku (z limitem czasu zamiast zawieszenia)."""
+
+    def _run():
+        received = []
+        try:
+            for page in ksef_client._prefetch_pages(pages, depth):
+                received.append(page)
+                time.sleep(delay)
+        except ksef_client.KSeFError as exc:
+            return received, exc
+        return received, None
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(_run).result(timeout=TIMEOUT_S)
+
+
+def _pages(count: int, error: Exception = None, produced: list = None):
+    try:
+        for n in range(count):
+            if produced is not None:
+                produced.append(n)
+            yield n
+        if error is not None:
+            raise error
+    finally:
+        if produced is not None:
+            produced.append("closed")
+
+
+@pytest.mark.parametrize("depth", [0, 1, 2])
+def test_pages_in_order(depth):
+    assert _consume(_pages(7), depth) == (list(range(7)), None)
+
+
+@pytest.mark.parametrize("depth", [0, 1, 2])
+def test_producer_error_reaches_consumer(depth):
+    error = ksef_client.KSeFError("KSeF API HTTP 503", 503)
+
+    # Wolny konsument — producent kończy się błędem przy pełnej kolejce
+    received, raised = _consume(_pages(4, error), depth, delay=0.01)
+
+    assert received == [0, 1, 2, 3]
+    assert raised is error
+
+
+def test_queue_is_bounded_and_producer_stops_with_consumer():
+    produced = []
+    pages = ksef_client._prefetch_pages(_pages(100, produced=produced), 2)
+
+    assert next(pages) == 0
+    deadline = time.monotonic() + TIMEOUT_S
+    while len(produced) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    # Odebrana strona + 2 w kolejce + 1 czekająca na miejsce
+    assert len(produced) == 4
+
+    pages.close()
+    assert produced[-1] == "closed"
+    assert not [t for t in threading.enumerate() if t.name == "ksef-prefetch"]
+
+
+# ---------------------------------------------------------------------------
+# Przebieg z serwerem mock
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("prefetch", ["0", "2"])
+def test_sync_downloads_all_pages(start_mock, make_client, make_args, logger, prefetch):
+    server = start_mock(size=250)
+    client = make_client(server)
+    args = make_args("--days", "10", "--prefetch", prefetch)
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert server.stats()["POST /invoices/query/metadata"] == {"200": 3}
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 250}
+
+
+def test_failed_query_is_raised_not_hung(start_mock, make_client, make_args, logger):
+    server = start_mock(size=250)
+    client = make_client(server, max_retries=0)
+    args = make_args("--days", "10")
+    assert args.prefetch == ksef_client.DEFAULT_PREFETCH_PAGES
+
+    server.inject_faults(503, endpoint="/invoices/query/")
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        future = executor.submit(ksef_client._download_all_invoices, client, args, logger)
+        with pytest.raises(ksef_client.KSeFError) as excinfo:
+            future.result(timeout=TIMEOUT_S)
+
+    assert excinfo.value.status_code == 503
+    assert "GET /invoices/ksef/{ksefNumber}" not in server.stats()
@@ -0,0 +1,151 @@
+"""RateLimiter (token bucket per klasa endpointu) i obsługa HTTP 429 z Retry-After."""
+
+import datetime
+import email.utils
+import time
+
+import pytest
+
+import ksef_client
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_nominal_rate():
+    clock = FakeClock()
+    limiter = ksef_client.RateLimiter({"query": (2.0, 4)}, clock=clock)
+
+    assert [limiter.reserve("query") for _ in range(4)] == [0.0] * 4
+    # Kolejne rezerwacje ustawiają się w kolejce co 1/rate
+    assert limiter.reserve("query") == pytest.approx(0.5)
+    assert limiter.reserve("query") == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert limiter.reserve("query") == pytest.approx(0.5)
+
+
+def test_unlimited_bucket_never_waits():
+    limiter = ksef_client.RateLimiter({}, clock=FakeClock())
+    assert all(limiter.reserve("download") == 0.0 for _ in range(100))
+
+
+def test_pause_blocks_bucket_and_restarts_empty():
+    clock = FakeClock()
+    limiter = ksef_client.RateLimiter({"download": (4.0, 8)}, clock=clock)
+
+    limiter.pause("download", 3.0)
+    # Po pauzie bez zapasu burst — pierwsze żądanie po 3 s + 1/rate
+    assert limiter.reserve("download") == pytest.approx(3.25)
+    state = limiter.state()["download"]
+    assert state["throttled"] == 1
+    assert state["paused_for_s"] == pytest.approx(3.0)
+
+    clock.now += 10.0
+    assert limiter.reserve("download") == 0.0
+
+
+def test_pause_applies_to_unlimited_bucket():
+    clock = FakeClock()
+    limiter = ksef_client.RateLimiter({}, clock=clock)
+    limiter.pause("other", 2.0)
+    assert limiter.reserve("other") == pytest.approx(2.0)
+    clock.now += 2.0
+    assert limiter.reserve("other") == 0.0
+
+
+def test_shorter_pause_does_not_shorten_longer_one():
+    clock = FakeClock()
+    limiter = ksef_client.RateLimiter({}, clock=clock)
+    limiter.pause("query", 5.0)
+    limiter.pause("query", 1.0)
+    assert limiter.reserve("query") == pytest.approx(5.0)
+    assert limiter.state()["query"]["throttled"] == 2
+
+
+def test_parse_rate_limits():
+    limits = ksef_client.parse_rate_limits(["query=1/3", "download=5", "auth=0"])
+    assert limits["query"] == (1.0, 3.0)
+    assert limits["download"] == (5.0, 5.0)
+    assert limits["auth"] == (None, None)
+
+    with pytest.raises(ValueError):
+        ksef_client.parse_rate_limits(["query"])
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("7", 7.0),
+    ("0.5", 0.5),
+    ("-3", 0.0),
+    (None, ksef_client.DEFAULT_RETRY_AFTER_S),
+    ("", ksef_client.DEFAULT_RETRY_AFTER_S),
+    ("jutro", ksef_client.DEFAULT_RETRY_AFTER_S),
+])
+def test_retry_after_seconds(value, expected):
+    assert ksef_client._retry_after_seconds(value) == pytest.approx(expected)
+
+
+def test_retry_after_http_date():
+    when = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    seconds = ksef_client._retry_after_seconds(email.utils.format_datetime(when, usegmt=True))
+    assert 28 <= seconds <= 30
+
+    past = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    assert ksef_client._retry_after_seconds(email.utils.format_datetime(past, usegmt=True)) == 0.0
+
+
+# ---------------------------------------------------------------------------
+# HTTP 429 z serwera mock
+# ---------------------------------------------------------------------------
+
+def test_429_pauses_bucket_for_retry_after(start_mock, make_client, tmp_path):
+    server = start_mock(retry_after=1)
+    client = make_client(server)
+    ksef_nr = server.corpus.metadata(0)["ksefNumber"]
+
+    server.inject_faults(429, endpoint="/invoices/ksef/")
+    started = time.monotonic()
+    sha256, size = client.download_invoice_xml_to(ksef_nr, tmp_path / "a.xml")
+    elapsed = time.monotonic() - started
+
+    assert elapsed >= 0.9
+    assert size == server.corpus.metadata(0)["fileSize"]
+    state = client.rate_limiter.state()
+    assert state["download"]["throttled"] == 1
+    assert state["download"]["waited_s"] >= 0.9
+    # 429 nie zużywa budżetu ponowień błędów przejściowych
+    assert client.retry_policy.retries == 0
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"429": 1, "200": 1}
+
+
+def test_429_on_query_is_retried(start_mock, make_client):
+    server = start_mock(retry_after=0)
+    client = make_client(server)
+
+    server.inject_faults(429, 429, 429, endpoint="/invoices/query")
+    result = client.query_invoices(date_from=datetime.date.today() - datetime.timedelta(days=10),
+                                   date_to=datetime.date.today())
+
+    assert len(result["invoices"]) == len(server.corpus)
+    state = client.rate_limiter.state()
+    assert state["query"]["throttled"] == 3
+    # Pauza dotyczy tylko klasy endpointu, która dostała 429
+    assert state["auth"]["throttled"] == 0
+
+
+def test_429_gives_up_after_max_throttle_retries(start_mock, make_client):
+    server = start_mock(retry_after=0)
+    client = make_client(server)
+
+    server.inject_faults(*[429] * (ksef_client.MAX_THROTTLE_RETRIES + 1), endpoint="/invoices/query")
+    with pytest.raises(ksef_client.KSeFError) as excinfo:
+        client.query_invoices()
+
+    assert excinfo.value.status_code == 429
+    assert server.pending_faults() == 0
+    assert client.rate_limiter.state()["query"]["throttled"] == ksef_client.MAX_THROTTLE_RETRIES
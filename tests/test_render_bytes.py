@@ -0,0 +1,72 @@
+"""Renderowanie PDF z bajtów XML (render_pdf, render_invoice_pdf) i URL kodu QR z treści."""
+
+import base64
+import hashlib
+
+import pytest
+
+import ksef_pdf
+from conftest import FIXTURES_DIR
+
+FIXTURES = sorted(FIXTURES_DIR.glob("fa*.xml"))
+
+
+def _qr_args(path) -> tuple:
+    data = ksef_pdf.parse_ksef_xml(path)
+    return data["sprzedawca"]["nip"], data["data_wystawienia"]
+
+
+@pytest.fixture
+def qr_urls(monkeypatch):
+    """URL-e kodów QR wyliczone podczas renderowania."""
+    urls = []
+    compute_qr_url = ksef_pdf._compute_qr_url
+
+    def _spy(*args, **kwargs):
+        urls.append(compute_qr_url(*args, **kwargs))
+        return urls[-1]
+
+    monkeypatch.setattr(ksef_pdf, "_compute_qr_url", _spy)
+    return urls
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: p.name)
+def test_render_pdf_from_bytes(path):
+    content = path.read_bytes()
+
+    pdf = ksef_pdf.render_pdf(content, ksef_nr="5265877635-20260301-0100A0B1C2D3-E4")
+
+    assert pdf.startswith(b"%PDF")
+    assert pdf.rstrip().endswith(b"%%EOF")
+    assert ksef_pdf.render_invoice_pdf(bytearray(content)).startswith(b"%PDF")
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: p.name)
+def test_qr_url_from_bytes_hash_and_path_match(path):
+    content = path.read_bytes()
+    nip, date_str = _qr_args(path)
+    digest = hashlib.sha256(content)
+
+    from_bytes = ksef_pdf._compute_qr_url(None, nip, date_str, xml_bytes=content)
+    from_hash = ksef_pdf._compute_qr_url(None, nip, date_str, sha256=digest.hexdigest())
+    from_path = ksef_pdf._compute_qr_url(path, nip, date_str)
+
+    assert from_bytes == from_hash == from_path
+    assert from_bytes.endswith("/" + base64.urlsafe_b64encode(digest.digest()).rstrip(b"=").decode("ascii"))
+
+
+def test_rendered_qr_matches_file_render(tmp_path, qr_urls):
+    path = FIXTURES_DIR / "fa2.xml"
+    content = path.read_bytes()
+
+    ksef_pdf.generate_pdf(path, tmp_path / "fa2.pdf")
+    ksef_pdf.render_pdf(content)
+    ksef_pdf.render_pdf(content, xml_sha256=hashlib.sha256(content).hexdigest())
+
+    assert len(qr_urls) == 3
+    assert len(set(qr_urls)) == 1
+
+
+def test_render_invoice_pdf_rejects_other_xml():
+    with pytest.raises(ValueError):
+        ksef_pdf.render_invoice_pdf(b"<Dokument><Naglowek/></Dokument>")
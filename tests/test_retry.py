@@ -0,0 +1,120 @@
+"""RetryPolicy (exponential backoff z pełnym jitterem, budżet ponowień) i ponawianie 5xx w kliencie."""
+
+import random
+
+import pytest
+
+import ksef_client
+
+
+def test_delay_within_full_jitter_bounds():
+    random.seed(1)
+    policy = ksef_client.RetryPolicy(max_retries=5, base_delay=0.5, max_delay=3.0, budget=None)
+    for attempt in range(5):
+        cap = min(3.0, 0.5 * 2 ** attempt)
+        delays = [policy.next_delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        # Pełny jitter — opóźnienia rozłożone w całym przedziale, nie stałe
+        assert max(delays) - min(delays) > cap / 2
+    assert policy.retries == 1000
+    assert policy.remaining is None
+
+
+def test_retry_after_sets_floor_capped_by_max_delay():
+    policy = ksef_client.RetryPolicy(max_retries=3, base_delay=0.01, max_delay=5.0)
+    assert policy.next_delay(0, retry_after=2.0) >= 2.0
+    assert policy.next_delay(0, retry_after=60.0) == 5.0
+
+
+def test_max_retries_per_request():
+    policy = ksef_client.RetryPolicy(max_retries=2, budget=10)
+    assert policy.next_delay(1) is not None
+    assert policy.next_delay(2) is None
+    # Odmowa nie zużywa budżetu
+    assert policy.retries == 1
+    assert policy.remaining == 9
+
+
+def test_budget_shared_across_requests():
+    policy = ksef_client.RetryPolicy(max_retries=3, base_delay=0.001, budget=3)
+    assert [policy.next_delay(0) is not None for _ in range(4)] == [True, True, True, False]
+    assert policy.remaining == 0
+    assert policy.retries == 3
+
+
+# ---------------------------------------------------------------------------
+# Błędy przejściowe z serwera mock
+# ---------------------------------------------------------------------------
+
+def test_5xx_on_download_is_retried(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server)
+    ksef_nr = server.corpus.metadata(0)["ksefNumber"]
+
+    server.inject_faults(503, 502, endpoint="/invoices/ksef/")
+    assert client.download_invoice_xml(ksef_nr) == server.corpus.invoice_xml(0)
+
+    assert client.retry_policy.retries == 2
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"503": 1, "502": 1, "200": 1}
+
+
+def test_5xx_on_query_is_retried(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server)
+
+    server.inject_faults(504, endpoint="/invoices/query")
+    assert len(client.query_invoices()["invoices"]) == len(server.corpus)
+    assert client.retry_policy.retries == 1
+
+
+def test_truncated_response_is_retried(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server)
+
+    server.inject_faults("truncate", endpoint="/invoices/query")
+    assert len(client.query_invoices()["invoices"]) == len(server.corpus)
+    assert client.retry_policy.retries == 1
+
+
+def test_5xx_gives_up_after_max_retries(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server, max_retries=2)
+    ksef_nr = server.corpus.metadata(0)["ksefNumber"]
+
+    server.inject_faults(503, 503, 503, endpoint="/invoices/ksef/")
+    with pytest.raises(ksef_client.KSeFError) as excinfo:
+        client.download_invoice_xml(ksef_nr)
+
+    assert excinfo.value.status_code == 503
+    assert client.retry_policy.retries == 2
+    assert server.pending_faults() == 0
+
+
+def test_exhausted_budget_fails_fast(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server, budget=2)
+    numbers = [server.corpus.metadata(i)["ksefNumber"] for i in range(3)]
+
+    for ksef_nr in numbers[:2]:
+        server.inject_faults(503, endpoint="/invoices/ksef/")
+        client.download_invoice_xml(ksef_nr)
+    # Budżet zużyty — trzecia faktura bez ponowienia
+    server.inject_faults(503, endpoint="/invoices/ksef/")
+    with pytest.raises(ksef_client.KSeFError):
+        client.download_invoice_xml(numbers[2])
+
+    assert client.retry_policy.remaining == 0
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"503": 3, "200": 2}
+
+
+def test_non_idempotent_request_is_not_retried(start_mock, make_client):
+    server = start_mock()
+    client = make_client(server)
+
+    server.inject_faults(503, endpoint="/invoices/exports")
+    with pytest.raises(ksef_client.KSeFError) as excinfo:
+        client.start_invoice_export()
+
+    assert excinfo.value.status_code == 503
+    assert client.retry_policy.retries == 0
+    assert server.stats()["POST /invoices/exports"] == {"503": 1}
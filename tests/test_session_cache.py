@@ -0,0 +1,160 @@
+"""SessionCache (tokeny sesji szyfrowane AES-256-GCM) i wznawianie sesji w kliencie."""
+
+import datetime
+import stat
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+import ksef_client
+import ksef_mock
+
+NIP = ksef_mock.DEFAULT_MOCK_NIP
+
+
+@pytest.fixture
+def key_path(tmp_path):
+    path = tmp_path / "session.key"
+    ksef_client.generate_aes_key(str(path))
+    return str(path)
+
+
+def _session(valid_for: datetime.timedelta) -> dict:
+    until = datetime.datetime.now(datetime.timezone.utc) + valid_for
+    return {
+        "nip": NIP,
+        "environment": "local",
+        "access_token": "access-1",
+        "access_token_valid_until": until.isoformat(),
+        "refresh_token": "refresh-1",
+        "refresh_token_valid_until": (until + datetime.timedelta(days=7)).isoformat(),
+    }
+
+
+def test_password_round_trip(key_path):
+    first = ksef_client.encrypt_password("zażółć gęślą jaźń", key_path)
+    second = ksef_client.encrypt_password("zażółć gęślą jaźń", key_path)
+    # Losowy nonce — ten sam tekst daje różne szyfrogramy
+    assert first != second
+    assert ksef_client.decrypt_password(first, key_path) == "zażółć gęślą jaźń"
+
+
+def test_wrong_or_invalid_key(key_path, tmp_path):
+    encrypted = ksef_client.encrypt_password("sekret", key_path)
+    other = tmp_path / "other.key"
+    ksef_client.generate_aes_key(str(other))
+    with pytest.raises(InvalidTag):
+        ksef_client.decrypt_password(encrypted, str(other))
+
+    short = tmp_path / "short.key"
+    short.write_bytes(b"x" * 16)
+    with pytest.raises(ValueError):
+        ksef_client.encrypt_password("sekret", str(short))
+
+
+def test_cache_round_trip(tmp_path, key_path):
+    cache = ksef_client.SessionCache(tmp_path / "state", NIP, "local", key_path)
+    assert cache.load() is None
+
+    data = _session(datetime.timedelta(hours=1))
+    cache.save(data)
+
+    assert cache.load() == data
+    assert stat.S_IMODE(cache.path.stat().st_mode) == 0o600
+    # Na dysku tylko szyfrogram
+    assert "access-1" not in cache.path.read_text(encoding="ascii")
+
+    cache.clear()
+    assert not cache.path.exists()
+    cache.clear()
+
+
+def test_unreadable_cache_is_ignored(tmp_path, key_path, caplog):
+    cache = ksef_client.SessionCache(tmp_path, NIP, "local", key_path)
+    cache.save(_session(datetime.timedelta(hours=1)))
+
+    other = tmp_path / "other.key"
+    ksef_client.generate_aes_key(str(other))
+    assert ksef_client.SessionCache(tmp_path, NIP, "local", str(other)).load() is None
+
+    cache.path.write_text("to nie jest base64!", encoding="ascii")
+    assert cache.load() is None
+    assert "nieczytelny" in caplog.text
+
+
+def test_restore_rejects_other_tenant():
+    client = ksef_client.KSeFClient(NIP, environment="local")
+    try:
+        assert not client.restore_session(dict(_session(datetime.timedelta(hours=1)), nip="1111111111"))
+        assert not client.restore_session(dict(_session(datetime.timedelta(hours=1)), environment="prod"))
+        assert client.restore_session(_session(datetime.timedelta(hours=1)))
+        assert client._reusable_session() == "access"
+        # accessToken wygasa w marginesie — do odnowienia refresh tokenem
+        assert client.restore_session(_session(datetime.timedelta(seconds=30)))
+        assert client._reusable_session() == "refresh"
+    finally:
+        client.close()
+
+
+# ---------------------------------------------------------------------------
+# Wznawianie sesji z serwerem mock
+# ---------------------------------------------------------------------------
+
+def _auth_requests(server) -> dict:
+    return {endpoint: sum(codes.values()) for endpoint, codes in server.stats().items()
+            if endpoint.startswith("POST /auth/")}
+
+
+@pytest.fixture
+def session_args(make_args, key_path, tmp_path):
+    return make_args("--session-cache", "--session-keyfile", key_path, "--state-dir", str(tmp_path / "state"))
+
+
+def test_second_run_reuses_cached_session(start_mock, make_client, session_args, logger):
+    server = start_mock()
+    first = make_client(server, authenticate=False)
+    ksef_client._open_session(first, session_args, logger)
+    ksef_client._close_session(first)
+    assert _auth_requests(server)["POST /auth/ksef-token"] == 1
+
+    server.reset_stats()
+    second = make_client(server, authenticate=False)
+    ksef_client._open_session(second, session_args, logger)
+
+    assert _auth_requests(server) == {}
+    assert second.access_token == first.access_token
+    assert second.query_invoices()["invoices"]
+
+
+def test_expiring_session_is_refreshed(start_mock, make_client, session_args, logger):
+    # accessToken krótszy niż margines odnowienia — kolejny przebieg użyje refresh tokenu
+    server = start_mock(access_ttl=60)
+    first = make_client(server, authenticate=False)
+    ksef_client._open_session(first, session_args, logger)
+
+    server.reset_stats()
+    second = make_client(server, authenticate=False)
+    ksef_client._open_session(second, session_args, logger)
+
+    assert _auth_requests(server) == {"POST /auth/token/refresh": 1}
+    assert second.access_token != first.access_token
+    # Odnowiona sesja trafia z powrotem do cache
+    assert second.session_cache.load()["access_token"] == second.access_token
+
+
+def test_revoked_cached_session_reauthenticates(start_mock, make_client, session_args, logger):
+    first = make_client(start_mock(), authenticate=False)
+    ksef_client._open_session(first, session_args, logger)
+
+    # Nowy serwer nie zna tokenów z cache: 401, nieudany refresh, pełne uwierzytelnienie
+    server = start_mock()
+    second = make_client(server, authenticate=False)
+    ksef_client._open_session(second, session_args, logger)
+    assert _auth_requests(server) == {}
+
+    assert second.query_invoices()["invoices"]
+    stats = server.stats()
+    assert stats["POST /invoices/query/metadata"] == {"401": 1, "200": 1}
+    assert stats["POST /auth/token/refresh"] == {"401": 1}
+    assert stats["POST /auth/ksef-token"] == {"202": 1}
+    assert second.session_cache.load()["access_token"] == second.access_token
@@ -0,0 +1,88 @@
+"""Bisekcja okien z obciętym wynikiem (isTruncated) i usuwanie duplikatów z granic podokien."""
+
+import datetime
+import logging
+
+import ksef_client
+
+
+def _invoicing(server, i: int) -> datetime.datetime:
+    return ksef_client._parse_ksef_datetime(server.corpus.metadata(i)["invoicingDate"])
+
+
+def _pages(client, args, logger, date_from, date_to):
+    return list(ksef_client._iter_invoice_pages(client, args, logger, date_from, date_to, "Invoicing"))
+
+
+def test_truncated_window_is_bisected(start_mock, make_client, make_args, logger, caplog):
+    server = start_mock(size=200, result_limit=30)
+    client = make_client(server)
+    today = datetime.date.today()
+
+    with caplog.at_level(logging.INFO, logger="ksef_test"):
+        pages = _pages(client, make_args(), logger, today - datetime.timedelta(days=10), today)
+
+    numbers = [inv["ksefNumber"] for _, fresh, _ in pages for inv in fresh]
+    assert sorted(numbers) == sorted(server.corpus.metadata(i)["ksefNumber"] for i in range(200))
+    # Strony z podokien bez offsetu wznowienia
+    assert all(offset is None for _, _, offset in pages)
+    assert all(not result["isTruncated"] for result, _, _ in pages)
+    assert "dzielę zakres dat" in caplog.text
+
+
+def test_boundary_duplicates_are_skipped(start_mock, make_client, make_args, logger):
+    server = start_mock(size=200, days=1, result_limit=10)
+    client = make_client(server)
+    # Środek okna dokładnie na fakturze 100 — trafia do obu połówek
+    middle = _invoicing(server, 100)
+    hour = datetime.timedelta(hours=1)
+
+    pages = _pages(client, make_args(), logger, middle - hour, middle + hour)
+
+    returned = [inv["ksefNumber"] for result, _, _ in pages for inv in result["invoices"]]
+    fresh = [inv["ksefNumber"] for _, invoices, _ in pages for inv in invoices]
+    duplicate = server.corpus.metadata(100)["ksefNumber"]
+    assert returned.count(duplicate) == 2
+    assert fresh.count(duplicate) == 1
+    assert len(fresh) == len(set(fresh)) == len(set(returned))
+
+
+def test_window_too_small_to_split(start_mock, make_client, make_args, logger, caplog, monkeypatch):
+    server = start_mock(size=50, result_limit=20)
+    client = make_client(server)
+    monkeypatch.setattr(ksef_client, "MIN_SPLIT_WINDOW", datetime.timedelta(days=365))
+    today = datetime.date.today()
+
+    with caplog.at_level(logging.WARNING, logger="ksef_test"):
+        pages = _pages(client, make_args(), logger, today - datetime.timedelta(days=10), today)
+
+    # Bez podziału — to, co KSeF zwrócił, z ostrzeżeniem
+    assert sum(len(fresh) for _, fresh, _ in pages) == 20
+    assert "nie można go dalej dzielić" in caplog.text
+
+
+def test_split_leaves_are_chronological(start_mock, make_client, make_args, logger):
+    server = start_mock(size=100, result_limit=15)
+    client = make_client(server)
+    today = datetime.date.today()
+
+    leaves = ksef_client._split_truncated_window(client, make_args(), logger,
+                                                 today - datetime.timedelta(days=10), today, "Invoicing")
+
+    assert len(leaves) > 1
+    assert all(not result["isTruncated"] for _, _, result in leaves)
+    assert [leaf[0] for leaf in leaves] == sorted(leaf[0] for leaf in leaves)
+    for (_, prev_to, _), (next_from, _, _) in zip(leaves, leaves[1:]):
+        assert prev_to == next_from
+
+
+def test_truncated_sync_downloads_everything(start_mock, make_client, make_args, logger):
+    server = start_mock(size=120, result_limit=25)
+    client = make_client(server)
+    args = make_args("--days", "10")
+
+    ksef_client._download_all_invoices(client, args, logger)
+
+    assert server.stats()["GET /invoices/ksef/{ksefNumber}"] == {"200": 120}
+    with ksef_client.InvoiceIndex(args.output_dir) as index:
+        assert index.count() == 120